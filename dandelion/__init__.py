@@ -8,6 +8,6 @@ from . import preprocessing as pp
 from . import utilities as utl
 from . import tools as tl
 from . import plotting as pl
-from .utilities import read_pkl, read_h5, read_10x_airr, from_scirpy, to_scirpy, Dandelion, update_metadata, concat, load_data
+from .utilities import read_pkl, read_h5, query_h5, read_store, convert_to_store, read_10x_airr, read_samples, from_scirpy, to_scirpy, Dandelion, update_metadata, concat, load_data
 from .logging import __version__, __author__, __email__, __url__, __docs__, __classifiers__
 from . import logging
@@ -10,7 +10,7 @@ import numpy as np
 from ..utilities._utilities import *
 from ..utilities._core import *
 from ..utilities._io import *
-from ..tools._diversity import rarefun
+from ..tools._diversity import rarefaction_curves
 from scanpy.plotting._tools.scatterplots import embedding
 import matplotlib.pyplot as plt
 from anndata import AnnData
@@ -26,7 +26,7 @@ from matplotlib.axes import Axes
 from matplotlib.figure import Figure
 
 
-def clone_rarefaction(self: Union[AnnData, Dandelion], color: str, clone_key: Union[None, str] = None, palette: Union[None, Sequence] = None, figsize: Tuple[Union[int, float], Union[int, float]] = (6, 4), save: Union[None, str] = None) -> ggplot:
+def clone_rarefaction(self: Union[AnnData, Dandelion], color: str, clone_key: Union[None, str] = None, diversity_key: Union[None, str] = None, palette: Union[None, Sequence] = None, figsize: Tuple[Union[int, float], Union[int, float]] = (6, 4), save: Union[None, str] = None) -> ggplot:
     """
     Plots rarefaction curve for cell numbers vs clone size.
 
@@ -38,6 +38,8 @@ def clone_rarefaction(self: Union[AnnData, Dandelion], color: str, clone_key: Un
         Column name to split the calculation of clone numbers for a given number of cells for e.g. sample, patient etc.
     clone_key : str, optional
         Column name specifying the clone_id column in metadata/obs.
+    diversity_key : str, optional
+        key for 'diversity' results in AnnData's `.uns`. Rarefaction curves stored there by `tl.clone_rarefaction` for the same `color` and `clone_key` are reused instead of recomputed.
     palette : Sequence, optional
         Color mapping for unique elements in color. Will try to retrieve from AnnData `.uns` slot if present.
     figsize :  Tuple[Union[int,float], Union[int,float]]
@@ -59,38 +61,21 @@ def clone_rarefaction(self: Union[AnnData, Dandelion], color: str, clone_key: Un
     else:
         clonekey = clone_key
 
-    groups = list(set(metadata[color]))
-    metadata = metadata[metadata['bcr_QC_pass'].isin([True, 'True'])]
-    metadata[clonekey] = metadata[clonekey].cat.remove_unused_categories()
-    res = {}
-    for g in groups:
-        _metadata = metadata[metadata[color] == g]
-        res[g] = _metadata[clonekey].value_counts()
-    res_ = pd.DataFrame.from_dict(res, orient='index')
-
-    # remove those with no counts
-    rowsum = res_.sum(axis=1)
-    print('removing due to zero counts:', ', '.join(
-        [res_.index[i] for i, x in enumerate(res_.sum(axis=1) == 0) if x]))
-    sleep(0.5)
-    res_ = res_[~(res_.sum(axis=1) == 0)]
-
-    # set up for calculating rarefaction
-    tot = res_.apply(sum, axis=1)
-    S = res_.apply(lambda x: x[x > 0].shape[0], axis=1)
-    nr = res_.shape[0]
-
-    # append the results to a dictionary
-    rarecurve = {}
-    for i in tqdm(range(0, nr), desc='Calculating rarefaction curve '):
-        n = np.arange(1, tot[i], step=10)
-        if (n[-1:] != tot[i]):
-            n = np.append(n, tot[i])
-        rarecurve[res_.index[i]] = [
-            rarefun(np.array(res_.iloc[i, ]), z) for z in n]
-    y = pd.DataFrame([rarecurve[c] for c in rarecurve]).T
-    pred = pd.DataFrame([np.append(np.arange(1, s, 10), s)
-                         for s in res_.sum(axis=1)], index=res_.index).T
+    if diversity_key is None:
+        diversitykey = 'diversity'
+    else:
+        diversitykey = diversity_key
+
+    res = None
+    if self.__class__ == AnnData:
+        if diversitykey in self.uns:
+            cached = self.uns[diversitykey]
+            if ('rarefaction_clones_y' in cached) and (cached.get('rarefaction_groupby') == color) and (cached.get('rarefaction_clone_key') == clonekey):
+                res = cached
+    if res is None:
+        res = rarefaction_curves(metadata, groupby=color, clone_key=clonekey)
+    y = res['rarefaction_clones_y']
+    pred = res['rarefaction_cells_x'].copy()
 
     y = y.melt()
     pred = pred.melt()
@@ -16,6 +16,7 @@ from collections import OrderedDict
 from time import sleep
 from ..utilities._utilities import *
 from ..utilities._core import *
+from ..utilities._core import _ContigIndex, _try_initialize
 from ..utilities._io import *
 from .external._preprocessing import assigngenes_igblast, makedb_igblast, parsedb_heavy, parsedb_light, tigger_genotype, creategermlines
 from plotnine import ggplot, geom_bar, geom_col, ggtitle, scale_fill_manual, coord_flip, options, element_blank, aes, xlab, ylab, facet_wrap, facet_grid, theme_classic, theme, annotate, theme_bw, geom_histogram, geom_vline, save_as_pdf_pages
@@ -1429,12 +1430,7 @@ def create_germlines(self: Union[Dandelion, pd.DataFrame, str], germline: Union[
             datx = load_data(self)
             for x in germline_df.columns:
                 datx[x] = pd.Series(germline_df[x])
-            try:
-                output = Dandelion(
-                    data=datx, germline=reference_dict, initialize=True)
-            except:
-                output = Dandelion(
-                    data=datx, germline=reference_dict, initialize=False)
+            output = _try_initialize(data=datx, germline=reference_dict)
             return(output)
         sleep(0.5)
         logg.info(' finished', time=start,
@@ -1540,12 +1536,7 @@ def create_germlines(self: Union[Dandelion, pd.DataFrame, str], germline: Union[
                 out.update({key: annotations})
         germline_df = pd.DataFrame.from_dict(out, orient='index')
 
-        try:
-            out = Dandelion(data=file, germline=reference_dict,
-                            initialize=True)
-        except:
-            out = Dandelion(data=file, germline=reference_dict,
-                            initialize=False)
+        out = _try_initialize(data=file, germline=reference_dict)
         for x in germline_df.columns:
             out.data[x] = pd.Series(germline_df[x])
 
@@ -1644,6 +1635,7 @@ def filter_bcr(data: Union[Dandelion, pd.DataFrame, str], adata: AnnData, filter
     if 'cell_id' not in dat.columns:
         raise AttributeError(
             "VDJ data does not contain 'cell_id' column. Please make sure this is populated before filtering.")
+    contigs = _ContigIndex(dat)
     if 'filter_rna' not in adata_.obs:
         adata_.obs['filter_rna'] = False
 
@@ -1676,25 +1668,17 @@ def filter_bcr(data: Union[Dandelion, pd.DataFrame, str], adata: AnnData, filter
     def parallel_marking(b):
         poor_qual, h_doublet, l_doublet, drop_contig = [], [], [], []
 
-        hc_id = list(dat[(dat['cell_id'].isin([b])) & (
-            dat['locus'] == 'IGH')]['sequence_id'])
-        hc_umi = [int(x) for x in dat[(dat['cell_id'].isin([b]))
-                                      & (dat['locus'] == 'IGH')]['umi_count']]
+        hc_id = list(dat.iloc[contigs.rows(b, ['IGH'])]['sequence_id'])
+        hc_umi = [int(x) for x in dat.iloc[contigs.rows(b, ['IGH'])]['umi_count']]
         if 'sequence_alignment' in dat:
-            hc_seq = [x for x in dat[(dat['cell_id'].isin([b])) & (
-                dat['locus'] == 'IGH')]['sequence_alignment']]
-        hc_dup = [int(x) for x in dat[(dat['cell_id'].isin([b]))
-                                      & (dat['locus'] == 'IGH')]['duplicate_count']]
-        hc_ccall = [x for x in dat[(dat['cell_id'].isin([b])) & (
-            dat['locus'] == 'IGH')]['c_call']]
-
-        lc_id = list(dat[(dat['cell_id'].isin([b])) & (
-            dat['locus'].isin(['IGK', 'IGL']))]['sequence_id'])
-        lc_umi = [int(x) for x in dat[(dat['cell_id'].isin([b])) & (
-            dat['locus'].isin(['IGK', 'IGL']))]['umi_count']]
+            hc_seq = [x for x in dat.iloc[contigs.rows(b, ['IGH'])]['sequence_alignment']]
+        hc_dup = [int(x) for x in dat.iloc[contigs.rows(b, ['IGH'])]['duplicate_count']]
+        hc_ccall = [x for x in dat.iloc[contigs.rows(b, ['IGH'])]['c_call']]
+
+        lc_id = list(dat.iloc[contigs.rows(b, ['IGK', 'IGL'])]['sequence_id'])
+        lc_umi = [int(x) for x in dat.iloc[contigs.rows(b, ['IGK', 'IGL'])]['umi_count']]
         if 'sequence_alignment' in dat:
-            lc_seq = [x for x in dat[(dat['cell_id'].isin([b])) & (
-                dat['locus'].isin(['IGK', 'IGL']))]['sequence_alignment']]
+            lc_seq = [x for x in dat.iloc[contigs.rows(b, ['IGK', 'IGL'])]['sequence_alignment']]
 
         h[b] = hc_id
         h_umi[b] = hc_umi
@@ -1721,12 +1705,9 @@ def filter_bcr(data: Union[Dandelion, pd.DataFrame, str], adata: AnnData, filter
                     keep_hc_contig = h[b][keep_index_h]
                     dat.at[keep_hc_contig, 'duplicate_count'] = int(
                         np.sum(h_umi[b][:keep_index_h] + h_umi[b][keep_index_h + 1:]))
-                    hc_id = list(dat[(dat['cell_id'].isin([b])) & (
-                        dat['locus'] == 'IGH')]['sequence_id'])
-                    hc_umi = [int(x) for x in dat[(dat['cell_id'].isin([b])) & (
-                        dat['locus'] == 'IGH')]['umi_count']]
-                    hc_dup = [int(x) for x in dat[(dat['cell_id'].isin([b])) & (
-                        dat['locus'] == 'IGH')]['duplicate_count']]
+                    hc_id = list(dat.iloc[contigs.rows(b, ['IGH'])]['sequence_id'])
+                    hc_umi = [int(x) for x in dat.iloc[contigs.rows(b, ['IGH'])]['umi_count']]
+                    hc_dup = [int(x) for x in dat.iloc[contigs.rows(b, ['IGH'])]['duplicate_count']]
                     h[b] = hc_id
                     h_umi[b] = hc_umi
                     h_dup[b] = hc_dup
@@ -1793,10 +1774,8 @@ def filter_bcr(data: Union[Dandelion, pd.DataFrame, str], adata: AnnData, filter
                     keep_lc_contig = l[b][keep_index_l]
                     dat.at[keep_lc_contig, 'duplicate_count'] = int(
                         np.sum(l_umi[b][:keep_index_l] + l_umi[b][keep_index_l + 1:]))
-                    lc_id = list(dat[(dat['cell_id'].isin([b])) & (
-                        dat['locus'].isin(['IGK', 'IGL']))]['sequence_id'])
-                    lc_umi = [int(x) for x in dat[(dat['cell_id'].isin([b])) & (
-                        dat['locus'].isin(['IGK', 'IGL']))]['umi_count']]
+                    lc_id = list(dat.iloc[contigs.rows(b, ['IGK', 'IGL'])]['sequence_id'])
+                    lc_umi = [int(x) for x in dat.iloc[contigs.rows(b, ['IGK', 'IGL'])]['umi_count']]
                     l[b] = lc_id
                     l_umi[b] = lc_umi
                     l_seq[b] = lc_seq
@@ -1942,25 +1921,17 @@ def filter_bcr(data: Union[Dandelion, pd.DataFrame, str], adata: AnnData, filter
         poor_qual, h_doublet, l_doublet, drop_contig = [], [], [], []
 
         for b in tqdm(barcode, desc='Scanning for poor quality/ambiguous contigs'):
-            hc_id = list(dat[(dat['cell_id'].isin([b])) & (
-                dat['locus'] == 'IGH')]['sequence_id'])
-            hc_umi = [int(x) for x in dat[(dat['cell_id'].isin([b]))
-                                          & (dat['locus'] == 'IGH')]['umi_count']]
+            hc_id = list(dat.iloc[contigs.rows(b, ['IGH'])]['sequence_id'])
+            hc_umi = [int(x) for x in dat.iloc[contigs.rows(b, ['IGH'])]['umi_count']]
             if 'sequence_alignment' in dat:
-                hc_seq = [x for x in dat[(dat['cell_id'].isin([b])) & (
-                    dat['locus'] == 'IGH')]['sequence_alignment']]
-            hc_dup = [int(x) for x in dat[(dat['cell_id'].isin([b])) & (
-                dat['locus'] == 'IGH')]['duplicate_count']]
-            hc_ccall = [x for x in dat[(dat['cell_id'].isin([b])) & (
-                dat['locus'] == 'IGH')]['c_call']]
-
-            lc_id = list(dat[(dat['cell_id'].isin([b])) & (
-                dat['locus'].isin(['IGK', 'IGL']))]['sequence_id'])
-            lc_umi = [int(x) for x in dat[(dat['cell_id'].isin([b])) & (
-                dat['locus'].isin(['IGK', 'IGL']))]['umi_count']]
+                hc_seq = [x for x in dat.iloc[contigs.rows(b, ['IGH'])]['sequence_alignment']]
+            hc_dup = [int(x) for x in dat.iloc[contigs.rows(b, ['IGH'])]['duplicate_count']]
+            hc_ccall = [x for x in dat.iloc[contigs.rows(b, ['IGH'])]['c_call']]
+
+            lc_id = list(dat.iloc[contigs.rows(b, ['IGK', 'IGL'])]['sequence_id'])
+            lc_umi = [int(x) for x in dat.iloc[contigs.rows(b, ['IGK', 'IGL'])]['umi_count']]
             if 'sequence_alignment' in dat:
-                lc_seq = [x for x in dat[(dat['cell_id'].isin([b])) & (
-                    dat['locus'].isin(['IGK', 'IGL']))]['sequence_alignment']]
+                lc_seq = [x for x in dat.iloc[contigs.rows(b, ['IGK', 'IGL'])]['sequence_alignment']]
 
             h[b] = hc_id
             h_umi[b] = hc_umi
@@ -1989,12 +1960,9 @@ def filter_bcr(data: Union[Dandelion, pd.DataFrame, str], adata: AnnData, filter
                         dat.at[keep_hc_contig, 'duplicate_count'] = int(
                             np.sum(h_umi[b][:keep_index_h] + h_umi[b][keep_index_h + 1:]))
 
-                        hc_id = list(dat[(dat['cell_id'].isin([b])) & (
-                            dat['locus'] == 'IGH')]['sequence_id'])
-                        hc_umi = [int(x) for x in dat[(dat['cell_id'].isin([b])) & (
-                            dat['locus'] == 'IGH')]['umi_count']]
-                        hc_dup = [int(x) for x in dat[(dat['cell_id'].isin([b])) & (
-                            dat['locus'] == 'IGH')]['duplicate_count']]
+                        hc_id = list(dat.iloc[contigs.rows(b, ['IGH'])]['sequence_id'])
+                        hc_umi = [int(x) for x in dat.iloc[contigs.rows(b, ['IGH'])]['umi_count']]
+                        hc_dup = [int(x) for x in dat.iloc[contigs.rows(b, ['IGH'])]['duplicate_count']]
                         h[b] = hc_id
                         h_umi[b] = hc_umi
                         h_dup[b] = hc_dup
@@ -2063,10 +2031,8 @@ def filter_bcr(data: Union[Dandelion, pd.DataFrame, str], adata: AnnData, filter
                         keep_lc_contig = l[b][keep_index_l]
                         dat.at[keep_lc_contig, 'duplicate_count'] = int(
                             np.sum(l_umi[b][:keep_index_l] + l_umi[b][keep_index_l + 1:]))
-                        lc_id = list(dat[(dat['cell_id'].isin([b])) & (
-                            dat['locus'].isin(['IGK', 'IGL']))]['sequence_id'])
-                        lc_umi = [int(x) for x in dat[(dat['cell_id'].isin([b])) & (
-                            dat['locus'].isin(['IGK', 'IGL']))]['umi_count']]
+                        lc_id = list(dat.iloc[contigs.rows(b, ['IGK', 'IGL'])]['sequence_id'])
+                        lc_umi = [int(x) for x in dat.iloc[contigs.rows(b, ['IGK', 'IGL'])]['umi_count']]
                         l[b] = lc_id
                         l_umi[b] = lc_umi
                         l_seq[b] = lc_seq
@@ -2232,11 +2198,10 @@ def filter_bcr(data: Union[Dandelion, pd.DataFrame, str], adata: AnnData, filter
 
         # final check
         barcodes_final = list(set(_dat['cell_id']))
+        final_contigs = _ContigIndex(_dat)
         filter_ids2 = []
         for b in barcodes_final:
-            check_dat = _dat[(_dat['locus'].isin(['IGH'])) &
-                             (_dat['cell_id'].isin([b]))].copy()
-            if check_dat.shape[0] < 1:
+            if len(final_contigs.rows(b, ['IGH'])) < 1:
                 filter_ids2.append(b)
         _dat = _dat[~(_dat['cell_id'].isin(filter_ids2))].copy()
 
@@ -6,4 +6,4 @@
 
 from ._tools import find_clones, transfer, define_clones, clone_size, clone_overlap
 from ._network import extract_edge_weights, clone_degree, clone_centrality, generate_network
-from ._diversity import clone_diversity, clone_rarefaction
+from ._diversity import clone_diversity, clone_diversity_profile, clone_diversity_sketch, clone_rarefaction
@@ -10,10 +10,14 @@ import networkx as nx
 from ..utilities._utilities import *
 from ..utilities._core import *
 from ..utilities._io import *
-from ..tools._network import clone_centrality, clone_degree, generate_network
+from ..tools._network import clone_centrality, clone_degree, generate_network, _induced_network, _induces_groups
 from scipy.special import gammaln
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
+from scipy.spatial.distance import pdist, squareform
+from polyleven import levenshtein
 from anndata import AnnData
-from skbio.diversity.alpha import chao1, gini_index, shannon
+from skbio.diversity.alpha import gini_index
 from tqdm import tqdm
 from time import sleep
 try:
@@ -47,43 +51,14 @@ def clone_rarefaction(self: Union[Dandelion, AnnData], groupby: str, clone_key:
 
     if self.__class__ == AnnData:
         metadata = self.obs.copy()
+    elif self.__class__ == Dandelion:
+        metadata = self.metadata.copy()
     if clone_key is None:
         clonekey = 'clone_id'
     else:
         clonekey = clone_key
 
-    groups = list(set(metadata[groupby]))
-    metadata = metadata[metadata['bcr_QC_pass'].isin([True, 'True'])]
-    metadata[clonekey] = metadata[clonekey].cat.remove_unused_categories()
-    res = {}
-    for g in groups:
-        _metadata = metadata[metadata[groupby] == g]
-        res[g] = _metadata[clonekey].value_counts()
-    res_ = pd.DataFrame.from_dict(res, orient='index')
-
-    # remove those with no counts
-    rowsum = res_.sum(axis=1)
-    print('removing due to zero counts:', ', '.join(
-        [res_.index[i] for i, x in enumerate(res_.sum(axis=1) == 0) if x]))
-    res_ = res_[~(res_.sum(axis=1) == 0)]
-
-    # set up for calculating rarefaction
-    tot = res_.apply(sum, axis=1)
-    S = res_.apply(lambda x: x[x > 0].shape[0], axis=1)
-    nr = res_.shape[0]
-
-    # append the results to a dictionary
-    rarecurve = {}
-    sleep(0.5)
-    for i in tqdm(range(0, nr), desc='Calculating rarefaction curve '):
-        n = np.arange(1, tot[i], step=10)
-        if (n[-1:] != tot[i]):
-            n = np.append(n, tot[i])
-        rarecurve[res_.index[i]] = [
-            rarefun(np.array(res_.iloc[i, ]), z) for z in n]
-    y = pd.DataFrame([rarecurve[c] for c in rarecurve]).T
-    pred = pd.DataFrame([np.append(np.arange(1, s, 10), s)
-                         for s in res_.sum(axis=1)], index=res_.index).T
+    res = rarefaction_curves(metadata, groupby=groupby, clone_key=clonekey)
 
     if diversity_key is None:
         diversitykey = 'diversity'
@@ -93,15 +68,63 @@ def clone_rarefaction(self: Union[Dandelion, AnnData], groupby: str, clone_key:
     if self.__class__ == AnnData:
         if diversitykey not in self.uns:
             self.uns[diversitykey] = {}
-        self.uns[diversitykey] = {
-            'rarefaction_cells_x': pred, 'rarefaction_clones_y': y}
+        self.uns[diversitykey].update(res)
     logg.info(' finished', time=start,
               deep=('updated `.uns` with rarefaction curves.\n'))
     if self.__class__ == Dandelion:
-        return({'rarefaction_cells_x': pred, 'rarefaction_clones_y': y})
+        return(res)
+
+
+def rarefaction_curves(metadata: pd.DataFrame, groupby: str, clone_key: Union[None, str] = None, step: int = 10, chunk_size: int = 10000000) -> Dict:
+    """
+    Calculates the rarefaction curves and their variance for each group in a metadata table.
+
+    Parameters
+    ----------
+    metadata : DataFrame
+        `Dandelion` metadata or `AnnData` obs table.
+    groupby : str
+        Column name to split the calculation of clone numbers for a given number of cells for e.g. sample, patient etc.
+    clone_key : str, optional
+        Column name specifying the clone_id column in metadata/obs.
+    step : int
+        Interval between the numbers of cells at which the curves are evaluated.
+    chunk_size : int
+        Maximum number of elements of the (cell numbers x clone sizes) grid evaluated at once.
+
+    Returns
+    -------
+    Dictionary containing the numbers of cells (`rarefaction_cells_x`), the expected numbers of clones (`rarefaction_clones_y`) and their variance (`rarefaction_clones_var`) for each group, as well as the `groupby` and `clone_key` used.
+    """
+    if clone_key is None:
+        clonekey = 'clone_id'
+    else:
+        clonekey = clone_key
+
+    if 'bcr_QC_pass' in metadata:
+        metadata = metadata[metadata['bcr_QC_pass'].isin([True, 'True'])]
+    res_ = metadata.groupby([groupby, clonekey], observed=True).size().unstack(
+        fill_value=0)
 
+    # remove those with no counts
+    print('removing due to zero counts:', ', '.join(
+        [str(res_.index[i]) for i, x in enumerate(res_.sum(axis=1) == 0) if x]))
+    res_ = res_[~(res_.sum(axis=1) == 0)]
 
-def clone_diversity(self: Union[Dandelion, AnnData], groupby: str, method: Literal['gini', 'chao1', 'shannon'] = 'gini', metric: Literal['clone_vertexsize', 'clone_degree', 'clone_centrality'] = None, clone_key: Union[None, str] = None, update_obs_meta: bool = True, diversity_key: Union[None, str] = None, resample: bool = False, downsample: Union[None, int] = None, n_resample: int = 50, normalize: bool = True, reconstruct_network: bool = True, expanded_only: bool = False, use_contracted: bool = False, key_added: Union[None, str] = None) -> Union[pd.DataFrame, Dandelion, AnnData]:
+    rarecurve, rarevar, pred = {}, {}, {}
+    sleep(0.5)
+    for g, counts in tqdm(res_.iterrows(), total=res_.shape[0], desc='Calculating rarefaction curve '):
+        tot = counts.sum()
+        n = np.append(np.arange(1, tot, step=step), tot)
+        pred[g] = n
+        rarecurve[g], rarevar[g] = rarefy(np.array(counts), n, chunk_size=chunk_size)
+    pred = pd.DataFrame.from_dict(pred, orient='index').T
+    y = pd.DataFrame.from_dict(rarecurve, orient='index').T
+    v = pd.DataFrame.from_dict(rarevar, orient='index').T
+    return({'rarefaction_cells_x': pred, 'rarefaction_clones_y': y, 'rarefaction_clones_var': v, 'rarefaction_groupby': groupby, 'rarefaction_clone_key': clonekey})
+
+
+def clone_diversity(self: Union[Dandelion, AnnData], groupby: str, method: Literal['gini', 'chao1', 'shannon'] = 'gini', metric: Literal['clone_vertexsize', 'clone_degree', 'clone_centrality'] = None, clone_key: Union[None, str] = None, update_obs_meta: bool = True, diversity_key: Union[None, str] = None, resample: bool = False, downsample: Union[None, int] = None, n_resample: int = 50, normalize: bool = True, base: float = 2, reconstruct_network: bool = True, expanded_only: bool = False, use_contracted: bool = False, key_added: Union[None, str] = None, random_state: Union[None, int] = None) -> Union[pd.DataFrame, Dandelion, AnnData]:
     """
     Compute B cell clones diversity : Gini indices, Chao1 estimates, or Shannon entropy.
 
@@ -129,14 +152,18 @@ def clone_diversity(self: Union[Dandelion, AnnData], groupby: str, method: Liter
         Number of times to perform resampling. Default is 50.
     normalize : bool
         Whether or not to return normalized Shannon Entropy according to https://math.stackexchange.com/a/945172. Default is True.
+    base : float
+        Base of the logarithm for Shannon entropy that is not normalized. Default is 2, the default of `skbio.diversity.alpha.shannon` before scikit-bio 0.6.
     reconstruct_network : bool
-        Whether or not to reconstruct the network for Gini Index based measures. Default is True and will reconstruct for each group specified by groupby option.
+        Whether or not to reconstruct the network for Gini Index based measures. Default is True and will reconstruct for each group specified by groupby option. If the network has already been generated with the same `clone_key` and no clone has cells in more than one group, the network for each group is sliced out as the induced subgraph instead of being regenerated.
     expanded_only : bool
         Whether or not to calculate gini indices using expanded clones only. Default is False i.e. use all cells/clones.
     use_contracted : bool
         Whether or not to perform the gini calculation after contraction of clone network. Only applies to calculation of clone size gini index. Default is False. This is to try and preserve the single-cell properties of the network.
     key_added : str, list, optional
         column names for output.
+    random_state : int, optional
+        Seed for the random number generator used for resampling.
 
     Returns
     -------
@@ -147,111 +174,285 @@ def clone_diversity(self: Union[Dandelion, AnnData], groupby: str, method: Liter
     if method == 'gini':
         if update_obs_meta:
             diversity_gini(self, groupby=groupby, metric=metric, clone_key=clone_key, update_obs_meta=update_obs_meta, diversity_key=diversity_key, resample=resample,
-                           n_resample=n_resample, downsample=downsample, reconstruct_network=reconstruct_network, expanded_only=expanded_only, use_contracted=use_contracted, key_added=key_added)
+                           n_resample=n_resample, downsample=downsample, reconstruct_network=reconstruct_network, expanded_only=expanded_only, use_contracted=use_contracted, key_added=key_added, random_state=random_state)
         else:
-            return(diversity_gini(self, groupby=groupby, metric=metric, clone_key=clone_key, update_obs_meta=update_obs_meta, diversity_key=diversity_key, resample=resample, n_resample=n_resample, downsample=downsample, reconstruct_network=reconstruct_network, expanded_only=expanded_only, use_contracted=use_contracted, key_added=key_added))
+            return(diversity_gini(self, groupby=groupby, metric=metric, clone_key=clone_key, update_obs_meta=update_obs_meta, diversity_key=diversity_key, resample=resample, n_resample=n_resample, downsample=downsample, reconstruct_network=reconstruct_network, expanded_only=expanded_only, use_contracted=use_contracted, key_added=key_added, random_state=random_state))
     if method == 'chao1':
         if update_obs_meta:
             diversity_chao1(self, groupby=groupby, clone_key=clone_key, update_obs_meta=update_obs_meta,
-                            diversity_key=diversity_key, resample=resample, n_resample=n_resample, downsample=downsample, key_added=key_added)
+                            diversity_key=diversity_key, resample=resample, n_resample=n_resample, downsample=downsample, key_added=key_added, random_state=random_state)
         else:
-            return(diversity_chao1(self, groupby=groupby, clone_key=clone_key, update_obs_meta=update_obs_meta, diversity_key=diversity_key, resample=resample, n_resample=n_resample, downsample=downsample, key_added=key_added))
+            return(diversity_chao1(self, groupby=groupby, clone_key=clone_key, update_obs_meta=update_obs_meta, diversity_key=diversity_key, resample=resample, n_resample=n_resample, downsample=downsample, key_added=key_added, random_state=random_state))
     if method == 'shannon':
         if update_obs_meta:
             diversity_shannon(self, groupby=groupby, clone_key=clone_key, update_obs_meta=update_obs_meta, diversity_key=diversity_key,
-                              resample=resample, n_resample=n_resample, normalize=normalize, downsample=downsample, key_added=key_added)
+                              resample=resample, n_resample=n_resample, normalize=normalize, base=base, downsample=downsample, key_added=key_added, random_state=random_state)
         else:
-            return(diversity_shannon(self, groupby=groupby, clone_key=clone_key, update_obs_meta=update_obs_meta, diversity_key=diversity_key, resample=resample, n_resample=n_resample, normalize=normalize, downsample=downsample, key_added=key_added))
+            return(diversity_shannon(self, groupby=groupby, clone_key=clone_key, update_obs_meta=update_obs_meta, diversity_key=diversity_key, resample=resample, n_resample=n_resample, normalize=normalize, base=base, downsample=downsample, key_added=key_added, random_state=random_state))
+
+
+def clone_networkstats(self: Dandelion, expanded_only: bool = False, network_clustersize: bool = False, verbose: bool = True) -> Tuple[pd.Series, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Calculates the cluster sizes and the vertex sizes after contraction of identical nodes in the BCR network.
+
+    Both are worked out in a single pass with `scipy.sparse.csgraph.connected_components` on the full and the zero weight edges in `.edges`.
 
+    Parameters
+    ----------
+    self : Dandelion
+        `Dandelion` object after `tl.generate_network` has been run.
+    expanded_only : bool
+        Whether or not to only use the trimmed network containing expanded clones.
+    network_clustersize : bool
+        Whether or not to report the cluster sizes as the number of vertices after contraction.
+    verbose : bool
+        Whether or not to show logging information.
 
-def clone_networkstats(self: Dandelion, expanded_only: bool = False, network_clustersize: bool = False, verbose: bool = True):
+    Returns
+    -------
+    cluster code of each node as a `pandas` series, the cluster code and size of each vertex, and the size of each cluster.
+    """
     if verbose:
         start = logg.info('Calculating vertex size of nodes after contraction')
 
     if self.__class__ == Dandelion:
-        try:
+        if self.graph is not None:
             if expanded_only:
-                G = self.graph[1]
+                nodes = pd.Index(self.graph[1].nodes)
             else:
-                G = self.graph[0]
-        except:
-            dist = np.sum([self.distance[x].toarray() for x in self.distance if type(
-                self.distance[x]) is csr_matrix], axis=0)
-            A = csr_matrix(dist)
-            G = nx.Graph()
-            G.add_weighted_edges_from(
-                zip(list(self.metadata.index), list(self.metadata.index), A.data))
-
-        if len(G) == 0:
+                nodes = pd.Index(self.graph[0].nodes)
+        elif expanded_only and self.edges is not None:
+            nodes = pd.Index(pd.unique(pd.concat(
+                [self.edges['source'], self.edges['target']])))
+        else:
+            nodes = pd.Index(self.metadata.index)
+
+        if len(nodes) == 0:
             raise AttributeError(
                 'Graph not found. Plase run tl.generate_network.')
         else:
-            remove_edges = defaultdict(list)
-            vertexsizes = defaultdict(list)
-            clustersizes = defaultdict(list)
-            nodes_names = defaultdict(list)
-
-            if verbose:
-                for subg in tqdm(nx.connected_components(G), desc='Reducing graph '):
-                    nodes = sorted(list(subg))
-                    # just assign the value in a single cell, because this will be representative of the clone
-                    tmp = nodes[0]
-                    for n in nodes:
-                        nodes_names[n] = tmp  # keep so i can reference later
-                    if len(nodes) > 1:
-                        G_ = G.subgraph(nodes).copy()
-                        remove_edges[tmp] = [(e[0], e[1]) for e in G_.edges(
-                            data=True) if e[2]['weight'] > 0]
-                        if len(remove_edges[tmp]) > 0:
-                            G_.remove_edges_from(remove_edges[tmp])
-                            for connected in nx.connected_components(G_):
-                                vertexsizes[tmp].append(len(connected))
-                            vertexsizes[tmp] = sorted(
-                                vertexsizes[tmp], reverse=True)
-                        else:
-                            vertexsizes[tmp] = [
-                                1 for i in range(len(G_.edges(data=True)))]
-                        if network_clustersize:
-                            clustersizes[tmp] = len(vertexsizes[tmp])
-                        else:
-                            clustersizes[tmp] = len(nodes)
-                    else:
-                        vertexsizes[tmp] = [1]
-                        clustersizes[tmp] = [1]
+            if self.edges is not None:
+                source = nodes.get_indexer(self.edges['source'])
+                target = nodes.get_indexer(self.edges['target'])
+                weight = np.array(self.edges['weight'])
+                keep = (source >= 0) & (target >= 0) & (source != target)
+                # the graph is undirected so drop duplicated node pairs
+                pairs = np.vstack([np.minimum(source[keep], target[keep]), np.maximum(
+                    source[keep], target[keep])])
+                _, first = np.unique(pairs, axis=1, return_index=True)
+                source, target, weight = pairs[0][first], pairs[1][first], weight[keep][first]
             else:
-                for subg in nx.connected_components(G):
-                    nodes = sorted(list(subg))
-                    # just assign the value in a single cell, because this will be representative of the clone
-                    tmp = nodes[0]
-                    for n in nodes:
-                        nodes_names[n] = tmp  # keep so i can reference later
-                    if len(nodes) > 1:
-                        G_ = G.subgraph(nodes).copy()
-                        remove_edges[tmp] = [(e[0], e[1]) for e in G_.edges(
-                            data=True) if e[2]['weight'] > 0]
-                        if len(remove_edges[tmp]) > 0:
-                            G_.remove_edges_from(remove_edges[tmp])
-                            for connected in nx.connected_components(G_):
-                                vertexsizes[tmp].append(len(connected))
-                            vertexsizes[tmp] = sorted(
-                                vertexsizes[tmp], reverse=True)
-                        else:
-                            vertexsizes[tmp] = [
-                                1 for i in range(len(G_.edges(data=True)))]
-                        if network_clustersize:
-                            clustersizes[tmp] = len(vertexsizes[tmp])
-                        else:
-                            clustersizes[tmp] = len(nodes)
-                    else:
-                        vertexsizes[tmp] = [1]
-                        clustersizes[tmp] = [1]
-
-            return(nodes_names, vertexsizes, clustersizes)
+                source, target, weight = np.array([], dtype=int), np.array(
+                    [], dtype=int), np.array([])
+            cluster, vertex_cluster, vertexsizes, clustersizes = _network_sizes(
+                len(nodes), source, target, weight, network_clustersize=network_clustersize)
+            nodes_names = pd.Series(cluster, index=nodes)
+            if verbose:
+                logg.info(' finished', time=start)
+            return(nodes_names, vertex_cluster, vertexsizes, clustersizes)
     else:
         raise TypeError('Input object must be of {}'.format(Dandelion))
 
 
-def diversity_gini(self: Union[Dandelion, AnnData], groupby: str, metric: Union[None, str] = None, clone_key: Union[None, str] = None, update_obs_meta: bool = False, diversity_key: Union[None, str] = None, resample: bool = False, n_resample: int = 50, downsample: Union[None, int] = None, reconstruct_network: bool = True, expanded_only: bool = False, use_contracted: bool = False, key_added: Union[None, str] = None)->Union[pd.DataFrame, Dandelion]:
+def _network_sizes(n_nodes: int, source: np.ndarray, target: np.ndarray, weight: np.ndarray, network_clustersize: bool = False) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Cluster and vertex sizes of a network given as integer coded edge arrays.
+
+    Clusters are the connected components of the network and vertices are the connected components after dropping all edges with non-zero weight, i.e. the nodes that would be contracted together. Singletons have a vertex size of 1 and clusters linked only by zero weight edges report one vertex of size 1 per edge.
+
+    Parameters
+    ----------
+    n_nodes : int
+        number of nodes in the network.
+    source : np.ndarray
+        integer codes of the source node of each edge.
+    target : np.ndarray
+        integer codes of the target node of each edge.
+    weight : np.ndarray
+        weight of each edge.
+    network_clustersize : bool
+        whether or not to report the cluster size as the number of vertices after contraction.
+
+    Returns
+    -------
+    cluster code of each node, cluster code of each vertex, size of each vertex and size of each cluster.
+    """
+    source, target, weight = np.asarray(source, dtype=int), np.asarray(target, dtype=int), np.asarray(weight)
+    full = csr_matrix((np.ones(len(source)), (source, target)), shape=(n_nodes, n_nodes))
+    n_clusters, cluster = connected_components(full, directed=False)
+    nonzero = weight != 0
+    zero = csr_matrix((np.ones((~nonzero).sum()), (source[~nonzero], target[~nonzero])), shape=(n_nodes, n_nodes))
+    n_vertices, vertex = connected_components(zero, directed=False)
+
+    cluster_nodes = np.bincount(cluster, minlength=n_clusters)
+    cluster_edges = np.bincount(cluster[source], minlength=n_clusters)
+    cluster_nonzero = np.bincount(cluster[source[nonzero]], minlength=n_clusters)
+    vertex_sizes = np.bincount(vertex, minlength=n_vertices)
+    vertex_cluster = np.zeros(n_vertices, dtype=int)
+    vertex_cluster[vertex] = cluster
+
+    # clusters linked only by zero weight edges count each edge as a vertex of size 1
+    allzero = (cluster_nodes > 1) & (cluster_nonzero == 0)
+    keep = ~allzero[vertex_cluster]
+    vertex_cluster = np.concatenate([vertex_cluster[keep], np.repeat(
+        np.where(allzero)[0], cluster_edges[allzero])])
+    vertex_sizes = np.concatenate([vertex_sizes[keep], np.ones(
+        cluster_edges[allzero].sum(), dtype=int)])
+    order = np.argsort(vertex_cluster, kind='stable')
+    vertex_cluster, vertex_sizes = vertex_cluster[order], vertex_sizes[order]
+
+    if network_clustersize:
+        cluster_sizes = np.bincount(vertex_cluster, minlength=n_clusters)
+    else:
+        cluster_sizes = cluster_nodes
+    return(cluster, vertex_cluster, vertex_sizes, cluster_sizes)
+
+
+def _network_gini(cluster: np.ndarray, vertex_cluster: np.ndarray, vertex_sizes: np.ndarray, cluster_sizes: np.ndarray) -> Tuple[np.ndarray, float]:
+    """
+    Vertex size Gini index of each node's cluster and the cluster size Gini index of the network.
+
+    Parameters
+    ----------
+    cluster : np.ndarray
+        cluster code of each node.
+    vertex_cluster : np.ndarray
+        cluster code of each vertex.
+    vertex_sizes : np.ndarray
+        size of each vertex.
+    cluster_sizes : np.ndarray
+        size of each cluster.
+
+    Returns
+    -------
+    vertex size Gini index for each node and the cluster size Gini index.
+    """
+    g_c_v = np.zeros(len(cluster_sizes))
+    if len(vertex_cluster) > 0:
+        # vertices are sorted by cluster so each cluster is a contiguous block
+        bounds = np.flatnonzero(np.diff(vertex_cluster)) + 1
+        for c, v_sizes in zip(vertex_cluster[np.r_[0, bounds]], np.split(vertex_sizes, bounds)):
+            if len(v_sizes) > 1:
+                v_sizes = np.append(v_sizes, 0)
+            g_c_v[c] = gini_index(v_sizes, method='trapezoids')
+    g_c_v[(g_c_v < 0) | np.isnan(g_c_v)] = 0
+    c_sizes = np.sort(cluster_sizes)[::-1]
+    if len(c_sizes) > 1:
+        c_sizes = np.append(c_sizes, 0)
+    g_c_c = gini_index(c_sizes, method='trapezoids') if len(c_sizes) > 0 else 0
+    if g_c_c < 0 or np.isnan(g_c_c):
+        g_c_c = 0
+    return(g_c_v[cluster], g_c_c)
+
+
+def _network_structure(self: Dandelion, cells: Sequence, clone_key: Union[None, str] = None, key: Union[None, str] = None) -> Dict:
+    """
+    Precomputes the clone membership and within-clone distances needed to rebuild the network of any subsample of cells.
+
+    Edges in the network only ever link cells of the same clone, so the distances within each clone are all that is needed to recover the minimum spanning trees and zero distance links of a subsample.
+
+    Parameters
+    ----------
+    self : Dandelion
+        `Dandelion` object.
+    cells : Sequence
+        cell barcodes to consider.
+    clone_key : str, optional
+        column name of clone id. None defaults to 'clone_id'.
+    key : str, optional
+        column name for distance calculations. None defaults to 'sequence_alignment_aa'.
+
+    Returns
+    -------
+    Dictionary holding the cell barcodes, the integer coded clone (`clone`) and linked clone group (`cluster`) of each cell, and the member positions and distance matrix of each linked clone group with more than one cell (`blocks`).
+    """
+    if clone_key is None:
+        clonekey = 'clone_id'
+    else:
+        clonekey = clone_key
+    if key is None:
+        key_ = 'sequence_alignment_aa'
+    else:
+        key_ = key
+    # only cells with a heavy chain contig are drawn when downsampling the network
+    heavy = self.data.loc[self.data['locus'] == 'IGH', 'cell_id']
+    cells = pd.Index(cells)
+    cells = cells[cells.isin(heavy)]
+    clones = self.metadata.loc[cells, clonekey].astype(str)
+
+    # clones joined by cells with multiple clone calls are linked into one group
+    tokens = clones.str.split('|', expand=False).explode()
+    token_codes, token_names = pd.factorize(tokens)
+    cell_codes = cells.get_indexer(tokens.index)
+    n, m = len(cells), len(token_names)
+    link = csr_matrix((np.ones(len(token_codes)), (cell_codes, token_codes + n)), shape=(n + m, n + m))
+    _, cluster = connected_components(link, directed=False)
+    cluster = pd.factorize(cluster[:n])[0]
+    clone = pd.Series(pd.factorize(clones)[0], index=cells)
+    clone[clones.isin(['nan', 'None', ''])] = -1
+
+    dat = self.data[self.data['cell_id'].isin(cells)]
+    dat_seq = retrieve_metadata(dat, query=key_, split=True, collapse=False)
+    dat_seq = dat_seq.reindex(cells)
+    blocks = {}
+    order = np.argsort(cluster, kind='stable')
+    bounds = np.flatnonzero(np.diff(cluster[order])) + 1
+    for members in np.split(order, bounds):
+        if len(members) > 1:
+            d_mat = np.zeros((len(members), len(members)), dtype=int)
+            for x in dat_seq.columns:
+                tdarray = np.array(dat_seq[x].iloc[members]).reshape(-1, 1)
+                d_mat += squareform(pdist(tdarray, lambda x, y: levenshtein(
+                    x[0], y[0]) if (x[0] == x[0]) and (y[0] == y[0]) else 0)).astype(int)
+            blocks[cluster[members[0]]] = (members, d_mat)
+    return({'cells': cells, 'clone': np.array(clone), 'cluster': cluster, 'blocks': blocks})
+
+
+def _resampled_network(structure: Dict, sample: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Rebuilds the edges of the network of a subsample of cells from precomputed clone distances, without constructing a graph or layout.
+
+    Parameters
+    ----------
+    structure : Dict
+        output of `_network_structure`.
+    sample : np.ndarray
+        positions of the sampled cells in `structure['cells']`.
+
+    Returns
+    -------
+    source, target and weight of each edge, with nodes coded by their position in `sample`.
+    """
+    position = np.full(len(structure['cells']), -1)
+    position[sample] = np.arange(len(sample))
+    source, target, weight = [], [], []
+    for c in np.unique(structure['cluster'][sample]):
+        if c not in structure['blocks']:
+            continue
+        members, d_mat = structure['blocks'][c]
+        keep = position[members] >= 0
+        if keep.sum() < 2:
+            continue
+        local = position[members[keep]]
+        d_mat = d_mat[np.ix_(keep, keep)]
+        # minimum spanning tree over the non-zero distances
+        tree = minimum_spanning_tree(np.triu(d_mat)).tocoo()
+        source.append(local[tree.row])
+        target.append(local[tree.col])
+        weight.append(tree.data.astype(int))
+        # plus all links between identical cells
+        i, j = np.triu_indices(len(local), 1)
+        identical = d_mat[i, j] == 0
+        source.append(local[i[identical]])
+        target.append(local[j[identical]])
+        weight.append(np.zeros(identical.sum(), dtype=int))
+    if len(source) > 0:
+        return(np.concatenate(source), np.concatenate(target), np.concatenate(weight))
+    else:
+        return(np.array([], dtype=int), np.array([], dtype=int), np.array([], dtype=int))
+
+
+def diversity_gini(self: Union[Dandelion, AnnData], groupby: str, metric: Union[None, str] = None, clone_key: Union[None, str] = None, update_obs_meta: bool = False, diversity_key: Union[None, str] = None, resample: bool = False, n_resample: int = 50, downsample: Union[None, int] = None, reconstruct_network: bool = True, expanded_only: bool = False, use_contracted: bool = False, key_added: Union[None, str] = None, random_state: Union[None, int] = None)->Union[pd.DataFrame, Dandelion]:
     """
     Compute B cell clones Gini indices.
 
@@ -270,19 +471,21 @@ def diversity_gini(self: Union[Dandelion, AnnData], groupby: str, metric: Union[
     diversity_key : str, optional
         Key for 'diversity' results in `.uns`.
     resample : bool
-        Whether or not to randomly sample cells without replacement to the minimum size of groups for the diversity calculation. Default is False. Resampling will automatically trigger reconstruction of network.
+        Whether or not to randomly sample cells without replacement to the minimum size of groups for the diversity calculation. Default is False. The network statistics of each subsample are rebuilt from the distances within clones, without constructing the graph or layout.
     n_resample : int
         Number of times to perform resampling. Default is 50.
     downsample : int, optional
         number of cells to downsample to. If None, defaults to size of smallest group.
     reconstruct_network : bool
-        Whether or not to reconstruct the network for Gini Index based measures. Default is True and will reconstruct for each group specified by groupby option.
+        Whether or not to reconstruct the network for Gini Index based measures. Default is True and will reconstruct for each group specified by groupby option. If the network has already been generated with the same `clone_key` and no clone has cells in more than one group, the network for each group is sliced out as the induced subgraph instead of being regenerated.
     expanded_only : bool
         Whether or not to calculate gini indices using expanded clones only. Default is False i.e. use all cells/clones.
     use_contracted : bool
         Whether or not to perform the gini calculation after contraction of clone network. Only applies to calculation of clone size gini index. Default is False. This is to try and preserve the single-cell properties of the network.
     key_added : str, list, optional
         column names for output.
+    random_state : int, optional
+        Seed for the random number generator used for resampling.
 
     Returns
     -------
@@ -290,7 +493,7 @@ def diversity_gini(self: Union[Dandelion, AnnData], groupby: str, metric: Union[
     """
     start = logg.info('Calculating Gini indices')
 
-    def gini_indices(self: Dandelion, groupby: str, metric: Union[None, str] = None, clone_key: Union[None, str] = None, resample: bool = False, n_resample: int = 50, downsample: Union[None, int] = None, reconstruct_network: bool = True, expanded_only: bool = False, contracted: bool = False, key_added: Union[None, str] = None)->pd.DataFrame:
+    def gini_indices(self: Dandelion, groupby: str, metric: Union[None, str] = None, clone_key: Union[None, str] = None, resample: bool = False, n_resample: int = 50, downsample: Union[None, int] = None, reconstruct_network: bool = True, expanded_only: bool = False, contracted: bool = False, key_added: Union[None, str] = None, random_state: Union[None, int] = None)->pd.DataFrame:
         if self.__class__ == AnnData:
             raise TypeError('Only Dandelion class object accepted.')
         elif self.__class__ == Dandelion:
@@ -323,36 +526,20 @@ def diversity_gini(self: Union[Dandelion, AnnData], groupby: str, metric: Union[
                 groupby, minsize, metadata[groupby].value_counts().idxmin()))
 
         res1 = {}
+        # the groups' networks can only be sliced out of the full network if they are the same as regenerating them
+        induced = self.__class__ == Dandelion and met == 'clone_network' and reconstruct_network and _induces_groups(
+            self, groupby, clonekey)
         sleep(0.5)
         if met == 'clone_network':
             print("Computing Gini indices for cluster and vertex size using network.")
             if not reconstruct_network:
-                n_n, v_s, c_s = clone_networkstats(
+                n_n, v_c, v_s, c_s = clone_networkstats(
                     self, expanded_only=expanded_only, network_clustersize=contracted, verbose=True)
-                g_c_v = defaultdict(dict)
-                g_c_v_res, g_c_c_res = {}, {}
-                for vs in v_s:
-                    v_sizes = np.array(v_s[vs])
-                    if len(v_sizes) > 1:
-                        v_sizes = np.append(v_sizes, 0)
-                    g_c_v[vs] = gini_index(v_sizes, method='trapezoids')
-                    if g_c_v[vs] < 0 or np.isnan(g_c_v[vs]):
-                        g_c_v[vs] = 0
-                    for cell in n_n:
-                        g_c_v_res.update({cell: g_c_v[n_n[cell]]})
-                c_sizes = np.array(
-                    np.array(sorted(list(flatten(c_s.values())), reverse=True)))
-                if len(c_sizes) > 1:
-                    c_sizes = np.append(c_sizes, 0)
-                g_c_c = gini_index(c_sizes, method='trapezoids')
-                if g_c_c < 0 or np.isnan(g_c_c):
-                    g_c_c = 0
-                for cell in n_n:
-                    g_c_c_res.update({cell: g_c_c})
+                g_c_v, g_c_c = _network_gini(n_n.values, v_c, v_s, c_s)
                 self.metadata['clone_network_vertex_size_gini'] = pd.Series(
-                    g_c_v_res)
+                    g_c_v, index=n_n.index)
                 self.metadata['clone_network_cluster_size_gini'] = pd.Series(
-                    g_c_c_res)
+                    g_c_c, index=n_n.index)
         elif met == 'clone_size':
             print("Computing gini indices for clone size using metadata.")
         elif met == 'clone_centrality':
@@ -369,6 +556,7 @@ def diversity_gini(self: Union[Dandelion, AnnData], groupby: str, metric: Union[
         if resample:
             print("Downsampling each group specified in `{}` to {} cells for calculating gini indices.".format(
                 groupby, minsize))
+            rng = np.random.default_rng(random_state)
         sleep(0.5)
         for g in groups:
             # clone size distribution
@@ -377,120 +565,76 @@ def diversity_gini(self: Union[Dandelion, AnnData], groupby: str, metric: Union[
             ddl_dat = Dandelion(_data, metadata=_dat)
             if resample:
                 sizelist = []
-                if self.__class__ == Dandelion:
-                    graphlist = []
+                graphlist = []
+                if met not in ['clone_network', 'clone_centrality', 'clone_degree']:
+                    raise ValueError(
+                        'Unknown metric for calculating network stats. Please specify one of `clone_centrality` or `clone_degree`.')
+                # clone membership and within clone distances only need to be worked out once per group
+                structure = _network_structure(
+                    ddl_dat, _dat.index, clone_key=clonekey)
+                n_cells = len(structure['cells'])
+                if met != 'clone_network':
+                    # clone size gini of all subsamples from a single batch of clone size counts
+                    clones = structure['clone']
+                    sizelist = list(_gini_rows(_resample_counts(np.bincount(
+                        clones[clones >= 0]), np.sum(clones < 0), minsize, n_resample, rng)))
                 for i in tqdm(range(0, n_resample)):
-                    if self.__class__ == Dandelion:
-                        resampled = generate_network(
-                            ddl_dat, clone_key=clonekey, downsample=minsize, verbose=False)
-                        if met == 'clone_network':
-                            n_n, v_s, c_s = clone_networkstats(
-                                resampled, expanded_only=expanded_only, network_clustersize=contracted, verbose=False)
-                            g_c_v = defaultdict(dict)
-                            g_c_v_res, g_c_c_res = {}, {}
-                            for vs in v_s:
-                                v_sizes = np.array(v_s[vs])
-                                if len(v_sizes) > 1:
-                                    v_sizes = np.append(v_sizes, 0)
-                                g_c_v[vs] = gini_index(
-                                    v_sizes, method='trapezoids')
-                                if g_c_v[vs] < 0 or np.isnan(g_c_v[vs]):
-                                    g_c_v[vs] = 0
-                                for cell in n_n:
-                                    g_c_v_res.update({cell: g_c_v[n_n[cell]]})
-                            c_sizes = np.array(
-                                sorted(list(flatten(c_s.values())), reverse=True))
-                            if len(c_sizes) > 1:
-                                c_sizes = np.append(c_sizes, 0)
-                            g_c_c = gini_index(c_sizes, method='trapezoids')
-                            if g_c_c < 0 or np.isnan(g_c_c):
-                                g_c_c = 0
-                            for cell in n_n:
-                                g_c_c_res.update({cell: g_c_c})
-                            resampled.metadata['clone_network_vertex_size_gini'] = pd.Series(
-                                g_c_v_res)
-                            resampled.metadata['clone_network_cluster_size_gini'] = pd.Series(
-                                g_c_c_res)
-                        elif met == 'clone_centrality':
-                            clone_centrality(resampled, verbose=False)
-                        elif met == 'clone_degree':
-                            clone_degree(resampled, verbose=False)
+                    if minsize < n_cells:
+                        sample = np.sort(rng.choice(
+                            n_cells, minsize, replace=False))
+                    else:
+                        sample = np.arange(n_cells)
+                    source, target, weight = _resampled_network(
+                        structure, sample)
+                    if met == 'clone_network':
+                        if expanded_only:
+                            # equivalent to the trimmed graph without isolated nodes
+                            nodes = np.unique(np.concatenate([source, target]))
+                            source, target = np.searchsorted(
+                                nodes, source), np.searchsorted(nodes, target)
                         else:
-                            raise ValueError(
-                                'Unknown metric for calculating network stats. Please specify one of `clone_centrality` or `clone_degree`.')
-                        # clone size gini
-                        _dat = resampled.metadata.copy()
-                        _tab = _dat[clonekey].value_counts()
-                        if 'nan' in _tab.index or np.nan in _tab.index:
-                            try:
-                                _tab.drop('nan', inplace=True)
-                            except:
-                                _tab.drop(np.nan, inplace=True)
-                        if met == 'clone_network':
-                            sizelist.append(
-                                _dat[met+'_cluster_size_gini'].mean())
-                        elif met == 'clone_size':
-                            clonesizecounts = np.array(_tab)
-                            clonesizecounts = clonesizecounts[clonesizecounts > 0]
-                            if len(clonesizecounts) > 1:
-                                # append a single zero for lorenz curve calculation
-                                clonesizecounts = np.append(clonesizecounts, 0)
-                            if len(clonesizecounts) > 0:
-                                g_c = gini_index(
-                                    clonesizecounts, method='trapezoids')
-                                # probably not needed anymore but keep just in case
-                                if g_c < 0 or np.isnan(g_c):
-                                    g_c = 0
-                            else:
-                                g_c = 0
-                            sizelist.append(g_c)
+                            nodes = sample
+                        cluster, v_c, v_s, c_s = _network_sizes(
+                            len(nodes), source, target, weight, network_clustersize=contracted)
+                        g_c_v, g_c_c = _network_gini(cluster, v_c, v_s, c_s)
+                        if len(nodes) > 0:
+                            sizelist.append(g_c_c)
+                            graphlist.append(g_c_v.mean())
                         else:
-                            clonesizecounts = np.array(_tab)
-                            clonesizecounts = clonesizecounts[clonesizecounts > 0]
-                            if len(clonesizecounts) > 1:
-                                # append a single zero for lorenz curve calculation
-                                clonesizecounts = np.append(clonesizecounts, 0)
-                            if len(clonesizecounts) > 0:
-                                g_c = gini_index(
-                                    clonesizecounts, method='trapezoids')
-                                # probably not needed anymore but keep just in case
-                                if g_c < 0 or np.isnan(g_c):
-                                    g_c = 0
-                            else:
-                                g_c = 0
-                            sizelist.append(g_c)
-
-                        if met == 'clone_network':
-                            graphlist.append(
-                                _dat[met+'_vertex_size_gini'].mean())
+                            sizelist.append(np.nan)
+                            graphlist.append(np.nan)
+                    else:
+                        # vertex closeness centrality or weighted degree distribution
+                        # only calculate for expanded clones. If including non-expanded clones, the centrality is just zero which doesn't help.
+                        if met == 'clone_degree':
+                            stat = np.bincount(np.concatenate(
+                                [source, target]), minlength=len(sample))
                         else:
-                            # vertex closeness centrality or weighted degree distribution
-                            # only calculate for expanded clones. If including non-expanded clones, the centrality is just zero which doesn't help.
-                            connectednodes = resampled.metadata[met][resampled.metadata[met] > 0]
-                            graphcounts = np.array(
-                                connectednodes.value_counts())
-                            # graphcounts = np.append(graphcounts, 0) # if I add a  zero here, it will skew the results when the centrality measure is uniform.... so leave it out for now.
-                            if len(graphcounts) > 0:
-                                g_c = gini_index(
-                                    graphcounts, method='trapezoids')
-                                if g_c < 0 or np.isnan(g_c):
-                                    g_c = 0
-                            else:
+                            G = nx.Graph()
+                            G.add_nodes_from(range(len(sample)))
+                            G.add_edges_from(zip(source, target))
+                            stat = np.array(
+                                list(nx.closeness_centrality(G).values()))
+                        connectednodes = pd.Series(stat[stat > 0])
+                        graphcounts = np.array(connectednodes.value_counts())
+                        # graphcounts = np.append(graphcounts, 0) # if I add a  zero here, it will skew the results when the centrality measure is uniform.... so leave it out for now.
+                        if len(graphcounts) > 0:
+                            g_c = gini_index(graphcounts, method='trapezoids')
+                            if g_c < 0 or np.isnan(g_c):
                                 g_c = 0
-                            graphlist.append(g_c)
+                        else:
+                            g_c = 0
+                        graphlist.append(g_c)
                 try:
                     g_c = sum(sizelist)/len(sizelist)
                 except:
                     g_c = 0
-
                 res1.update({g: g_c})
-                if 'graphlist' in locals():
+                try:
                     g_c = sum(graphlist)/len(graphlist)
-                    try:
-                        g_c = sum(graphlist)/len(graphlist)
-                    except:
-                        g_c = 0
-                    res2.update({g: g_c})
+                except:
+                    g_c = 0
+                res2.update({g: g_c})
             else:
                 _tab = _dat[clonekey].value_counts()
                 if 'nan' in _tab.index or np.nan in _tab.index:
@@ -515,35 +659,17 @@ def diversity_gini(self: Union[Dandelion, AnnData], groupby: str, metric: Union[
                 if self.__class__ == Dandelion:
                     if met == 'clone_network':
                         if reconstruct_network:
-                            generate_network(
-                                ddl_dat, clone_key=clonekey, verbose=False)
-                            n_n, v_s, c_s = clone_networkstats(
+                            if induced:
+                                ddl_dat = _induced_network(self, _dat.index)
+                            else:
+                                generate_network(
+                                    ddl_dat, clone_key=clonekey, verbose=False)
+                            n_n, v_c, v_s, c_s = clone_networkstats(
                                 ddl_dat, expanded_only=expanded_only, network_clustersize=contracted, verbose=False)
-                            g_c_v = defaultdict(dict)
-                            g_c_v_res, g_c_c_res = {}, {}
-                            for vs in v_s:
-                                v_sizes = np.array(v_s[vs])
-                                if len(v_sizes) > 1:
-                                    v_sizes = np.append(v_sizes, 0)
-                                g_c_v[vs] = gini_index(
-                                    v_sizes, method='trapezoids')
-                                if g_c_v[vs] < 0 or np.isnan(g_c_v[vs]):
-                                    g_c_v[vs] = 0
-                                for cell in n_n:
-                                    g_c_v_res.update({cell: g_c_v[n_n[cell]]})
-                            c_sizes = np.array(
-                                sorted(list(flatten(c_s.values())), reverse=True))
-                            if len(c_sizes) > 1:
-                                c_sizes = np.append(c_sizes, 0)
-                            g_c_c = gini_index(c_sizes, method='trapezoids')
-                            if g_c_c < 0 or np.isnan(g_c_c):
-                                g_c_c = 0
-                            for cell in n_n:
-                                g_c_c_res.update({cell: g_c_c})
-                            # ddl_dat.metadata['clone_network_vertex_size_gini'] = pd.Series(g_c_v_res)
-                            # ddl_dat.metadata['clone_network_cluster_size_gini'] = pd.Series(g_c_c_res)
-                            res2.update({g: pd.Series(g_c_v_res).mean()})
-                            res1.update({g: pd.Series(g_c_c_res).mean()})
+                            g_c_v, g_c_c = _network_gini(
+                                n_n.values, v_c, v_s, c_s)
+                            res2.update({g: g_c_v.mean()})
+                            res1.update({g: g_c_c})
                         else:
                             res2.update(
                                 {g: _dat[met+'_vertex_size_gini'].mean()})
@@ -593,20 +719,8 @@ def diversity_gini(self: Union[Dandelion, AnnData], groupby: str, metric: Union[
                         'Please provide {} key(s) for new column names.'.format(len(res_df.columns)))
         return(res_df)
 
-    def transfer_gini_indices(self: Dandelion, gini_results: pd.DataFrame, groupby: str) -> Dandelion:
-        metadata = self.metadata.copy()
-
-        groups = list(set(metadata[groupby]))
-        for c in gini_results.columns:
-            metadata[c] = np.nan
-            for g in groups:
-                for i in metadata.index:
-                    if metadata.at[i, groupby] == g:
-                        metadata.at[i, c] = gini_results[c][g]
-        self.metadata = metadata.copy()
-
     res = gini_indices(self, groupby=groupby, clone_key=clone_key, metric=metric, resample=resample, n_resample=n_resample, downsample=downsample,
-                       reconstruct_network=reconstruct_network, expanded_only=expanded_only, contracted=use_contracted, key_added=key_added)
+                       reconstruct_network=reconstruct_network, expanded_only=expanded_only, contracted=use_contracted, key_added=key_added, random_state=random_state)
 
     if diversity_key is None:
         diversitykey = 'diversity'
@@ -615,7 +729,7 @@ def diversity_gini(self: Union[Dandelion, AnnData], groupby: str, metric: Union[
 
     if update_obs_meta:
         res_ = res.copy()
-        transfer_gini_indices(self, res_, groupby)
+        _transfer_diversity_results(self, res_, groupby)
         sleep(0.5)
         if self.__class__ == Dandelion:
             logg.info(' finished', time=start,
@@ -627,7 +741,7 @@ def diversity_gini(self: Union[Dandelion, AnnData], groupby: str, metric: Union[
         return(res_)
 
 
-def diversity_chao1(self: Union[Dandelion, AnnData], groupby: str, clone_key: Union[None, str] = None, update_obs_meta: bool = False, diversity_key: Union[None, str] = None, resample: bool = False, n_resample: int = 50, downsample: Union[None, int] = None, key_added: Union[None, str] = None) -> Union[pd.DataFrame, Dandelion, AnnData]:
+def diversity_chao1(self: Union[Dandelion, AnnData], groupby: str, clone_key: Union[None, str] = None, update_obs_meta: bool = False, diversity_key: Union[None, str] = None, resample: bool = False, n_resample: int = 50, downsample: Union[None, int] = None, key_added: Union[None, str] = None, random_state: Union[None, int] = None) -> Union[pd.DataFrame, Dandelion, AnnData]:
     """
     Compute B cell clones Chao1 estimates.
 
@@ -651,6 +765,8 @@ def diversity_chao1(self: Union[Dandelion, AnnData], groupby: str, clone_key: Un
         number of cells to downsample to. If None, defaults to size of smallest group.
     key_added : str, list, optional
         column names for output.
+    random_state : int, optional
+        Seed for the random number generator used for resampling.
 
     Returns
     -------
@@ -658,7 +774,7 @@ def diversity_chao1(self: Union[Dandelion, AnnData], groupby: str, clone_key: Un
     """
     start = logg.info('Calculating Chao1 estimates')
 
-    def chao1_estimates(self: Union[Dandelion, AnnData], groupby: str, clone_key: Union[None, str] = None, resample: bool = False, n_resample: int = 50, downsample: Union[None, int] = None, key_added: Union[None, str] = None) -> pd.DataFrame:
+    def chao1_estimates(self: Union[Dandelion, AnnData], groupby: str, clone_key: Union[None, str] = None, resample: bool = False, n_resample: int = 50, downsample: Union[None, int] = None, key_added: Union[None, str] = None, random_state: Union[None, int] = None) -> pd.DataFrame:
         if self.__class__ == AnnData:
             metadata = self.obs.copy()
         elif self.__class__ == Dandelion:
@@ -689,47 +805,19 @@ def diversity_chao1(self: Union[Dandelion, AnnData], groupby: str, clone_key: Un
             print("Downsampling each group specified in `{}` to {} cells for calculating Chao1 estimates.".format(
                 groupby, minsize))
         res1 = {}
+        rng = np.random.default_rng(random_state)
         sleep(0.5)
         for g in groups:
             # clone size distribution
             _dat = metadata[metadata[groupby] == g]
+            counts, n_missing = _clone_counts(_dat[clonekey])
             if resample:
-                sizelist = []
-                graphlist = []
-                for i in tqdm(range(0, n_resample)):
-                    _dat = _dat.sample(minsize)
-                    _tab = _dat[clonekey].value_counts()
-                    if 'nan' in _tab.index or np.nan in _tab.index:
-                        try:
-                            _tab.drop('nan', inplace=True)
-                        except:
-                            _tab.drop(np.nan, inplace=True)
-                    clonesizecounts = np.array(_tab)
-                    clonesizecounts = clonesizecounts[clonesizecounts > 0]
-                    if len(clonesizecounts) > 0:
-                        g_c = chao1(clonesizecounts)
-                    else:
-                        g_c = 0
-                    sizelist.append(g_c)
-                try:
-                    g_c = sum(sizelist)/len(sizelist)
-                except:
-                    g_c = 0
-                res1.update({g: g_c})
+                # all subsamples are drawn at once as rows of clone size counts
+                counts = _resample_counts(
+                    counts, n_missing, minsize, n_resample, rng)
             else:
-                _tab = _dat[clonekey].value_counts()
-                if 'nan' in _tab.index or np.nan in _tab.index:
-                    try:
-                        _tab.drop('nan', inplace=True)
-                    except:
-                        _tab.drop(np.nan, inplace=True)
-                clonesizecounts = np.array(_tab)
-                clonesizecounts = clonesizecounts[clonesizecounts > 0]
-                if len(clonesizecounts) > 0:
-                    g_c = chao1(clonesizecounts)
-                else:
-                    g_c = 0
-                res1.update({g: g_c})
+                counts = counts[None, :]
+            res1.update({g: _chao1_rows(counts).mean()})
 
         res_df = pd.DataFrame.from_dict([res1]).T
         if key_added is None:
@@ -742,26 +830,8 @@ def diversity_chao1(self: Union[Dandelion, AnnData], groupby: str, clone_key: Un
 
         return(res_df)
 
-    def transfer_chao1_estimates(self: Union[Dandelion, AnnData], chao1_results: pd.DataFrame, groupby: str):
-        if self.__class__ == AnnData:
-            metadata = self.obs.copy()
-        elif self.__class__ == Dandelion:
-            metadata = self.metadata.copy()
-
-        groups = list(set(metadata[groupby]))
-        for c in chao1_results.columns:
-            metadata[c] = np.nan
-            for g in groups:
-                for i in metadata.index:
-                    if metadata.at[i, groupby] == g:
-                        metadata.at[i, c] = chao1_results[c][g]
-        if self.__class__ == AnnData:
-            self.obs = metadata.copy()
-        elif self.__class__ == Dandelion:
-            self.metadata = metadata.copy()
-
     res = chao1_estimates(self, groupby=groupby, clone_key=clone_key,
-                          resample=resample, n_resample=n_resample, downsample=downsample)
+                          resample=resample, n_resample=n_resample, downsample=downsample, random_state=random_state)
 
     if diversity_key is None:
         diversitykey = 'diversity'
@@ -775,7 +845,7 @@ def diversity_chao1(self: Union[Dandelion, AnnData], groupby: str, clone_key: Un
 
     if update_obs_meta:
         res_ = res.copy()
-        transfer_chao1_estimates(self, res_, groupby)
+        _transfer_diversity_results(self, res_, groupby)
         sleep(0.5)
         if self.__class__ == Dandelion:
             logg.info(' finished', time=start,
@@ -794,7 +864,7 @@ def diversity_chao1(self: Union[Dandelion, AnnData], groupby: str, clone_key: Un
         return(res_)
 
 
-def diversity_shannon(self: Union[Dandelion, AnnData], groupby: str, clone_key: Union[None, str] = None, update_obs_meta: bool = False, diversity_key: Union[None, str] = None, resample: bool = False, n_resample: int = 50, normalize: bool = True, downsample: Union[None, int] = None, key_added: Union[None, str] = None) -> Union[pd.DataFrame, Dandelion, AnnData]:
+def diversity_shannon(self: Union[Dandelion, AnnData], groupby: str, clone_key: Union[None, str] = None, update_obs_meta: bool = False, diversity_key: Union[None, str] = None, resample: bool = False, n_resample: int = 50, normalize: bool = True, base: float = 2, downsample: Union[None, int] = None, key_added: Union[None, str] = None, random_state: Union[None, int] = None) -> Union[pd.DataFrame, Dandelion, AnnData]:
     """
     Compute B cell clones Shannon entropy.
 
@@ -816,10 +886,14 @@ def diversity_shannon(self: Union[Dandelion, AnnData], groupby: str, clone_key:
         Number of times to perform resampling. Default is 50.
     normalize : bool
         Whether or not to return normalized Shannon Entropy according to https://math.stackexchange.com/a/945172. Default is True.
+    base : float
+        Base of the logarithm for Shannon entropy that is not normalized. Default is 2, the default of `skbio.diversity.alpha.shannon` before scikit-bio 0.6.
     downsample : int, optional
         number of cells to downsample to. If None, defaults to size of smallest group.
     key_added : str, list, optional
         column names for output.
+    random_state : int, optional
+        Seed for the random number generator used for resampling.
 
     Returns
     -------
@@ -827,7 +901,7 @@ def diversity_shannon(self: Union[Dandelion, AnnData], groupby: str, clone_key:
     """
     start = logg.info('Calculating Shannon entropy')
 
-    def shannon_entropy(self: Union[Dandelion, AnnData], groupby: str, clone_key: Union[None, str] = None, resample: bool = False, n_resample: int = 50, normalize: bool = True, downsample: Union[None, int] = None, key_added: Union[None, str] = None) -> pd.DataFrame:
+    def shannon_entropy(self: Union[Dandelion, AnnData], groupby: str, clone_key: Union[None, str] = None, resample: bool = False, n_resample: int = 50, normalize: bool = True, base: float = 2, downsample: Union[None, int] = None, key_added: Union[None, str] = None, random_state: Union[None, int] = None) -> pd.DataFrame:
         if self.__class__ == AnnData:
             metadata = self.obs.copy()
         elif self.__class__ == Dandelion:
@@ -859,72 +933,19 @@ def diversity_shannon(self: Union[Dandelion, AnnData], groupby: str, clone_key:
                 groupby, minsize))
 
         res1 = {}
+        rng = np.random.default_rng(random_state)
         sleep(0.5)
         for g in groups:
             # clone size distribution
             _dat = metadata[metadata[groupby] == g]
+            counts, n_missing = _clone_counts(_dat[clonekey])
             if resample:
-                sizelist = []
-                graphlist = []
-
-                for i in tqdm(range(0, n_resample)):
-                    _dat = _dat.sample(minsize)
-                    _tab = _dat[clonekey].value_counts()
-                    if 'nan' in _tab.index or np.nan in _tab.index:
-                        try:
-                            _tab.drop('nan', inplace=True)
-                        except:
-                            _tab.drop(np.nan, inplace=True)
-                    clonesizecounts = np.array(_tab)
-                    clonesizecounts = clonesizecounts[clonesizecounts > 0]
-                    if len(clonesizecounts) > 0:
-                        if normalize:
-                            if len(clonesizecounts) == 1:
-                                g_c = 0
-                            else:
-                                clonesizecounts_freqs = clonesizecounts / \
-                                    np.sum(clonesizecounts)
-                                g_c = -np.sum((clonesizecounts_freqs * np.log(
-                                    clonesizecounts_freqs)) / np.log(len(clonesizecounts_freqs)))
-                        else:
-                            g_c = shannon(clonesizecounts)
-                    else:
-                        if normalize:
-                            g_c = 1
-                        else:
-                            g_c = 0
-                    sizelist.append(g_c)
-                try:
-                    g_c = sum(sizelist)/len(sizelist)
-                except:
-                    g_c = 0
-                res1.update({g: g_c})
+                # all subsamples are drawn at once as rows of clone size counts
+                counts = _resample_counts(
+                    counts, n_missing, minsize, n_resample, rng)
             else:
-                _tab = _dat[clonekey].value_counts()
-                if 'nan' in _tab.index or np.nan in _tab.index:
-                    try:
-                        _tab.drop('nan', inplace=True)
-                    except:
-                        _tab.drop(np.nan, inplace=True)
-                clonesizecounts = np.array(_tab)
-                clonesizecounts = clonesizecounts[clonesizecounts > 0]
-                if len(clonesizecounts) > 0:
-                    if normalize:
-                        if len(clonesizecounts) == 1:
-                            g_c = 0
-                        else:
-                            clonesizecounts_freqs = clonesizecounts / \
-                                np.sum(clonesizecounts)
-                            g_c = -np.sum((clonesizecounts_freqs * np.log(
-                                clonesizecounts_freqs)) / np.log(len(clonesizecounts_freqs)))
-                    else:
-                        g_c = shannon(clonesizecounts)
-                else:
-                    if normalize:
-                        g_c = 1
-                    else:
-                        g_c = 0
-                res1.update({g: g_c})
+                counts = counts[None, :]
+            res1.update({g: _shannon_rows(counts, normalize=normalize, base=base).mean()})
 
         res_df = pd.DataFrame.from_dict([res1]).T
         if key_added is None:
@@ -940,26 +961,8 @@ def diversity_shannon(self: Union[Dandelion, AnnData], groupby: str, clone_key:
 
         return(res_df)
 
-    def transfer_shannon_entropy(self: Union[Dandelion, AnnData], shannon_results: pd.DataFrame, groupby: str):
-        if self.__class__ == AnnData:
-            metadata = self.obs.copy()
-        elif self.__class__ == Dandelion:
-            metadata = self.metadata.copy()
-
-        groups = list(set(metadata[groupby]))
-        for c in shannon_results.columns:
-            metadata[c] = np.nan
-            for g in groups:
-                for i in metadata.index:
-                    if metadata.at[i, groupby] == g:
-                        metadata.at[i, c] = shannon_results[c][g]
-        if self.__class__ == AnnData:
-            self.obs = metadata.copy()
-        elif self.__class__ == Dandelion:
-            self.metadata = metadata.copy()
-
     res = shannon_entropy(self, groupby=groupby, clone_key=clone_key, resample=resample,
-                          n_resample=n_resample, normalize=normalize, downsample=downsample)
+                          n_resample=n_resample, normalize=normalize, base=base, downsample=downsample, random_state=random_state)
 
     if diversity_key is None:
         diversitykey = 'diversity'
@@ -973,7 +976,7 @@ def diversity_shannon(self: Union[Dandelion, AnnData], groupby: str, clone_key:
 
     if update_obs_meta:
         res_ = res.copy()
-        transfer_shannon_entropy(self, res_, groupby)
+        _transfer_diversity_results(self, res_, groupby)
         sleep(0.5)
         if self.__class__ == Dandelion:
             if normalize:
@@ -1004,6 +1007,291 @@ def diversity_shannon(self: Union[Dandelion, AnnData], groupby: str, clone_key:
         return(res_)
 
 
+def clone_diversity_profile(self: Union[Dandelion, AnnData], groupby: str, q: Sequence = (0, 1, 2), clone_key: Union[None, str] = None, update_obs_meta: bool = False, diversity_key: Union[None, str] = None, resample: bool = False, n_resample: int = 50, normalize: bool = True, base: float = 2, downsample: Union[None, int] = None, random_state: Union[None, int] = None) -> Union[pd.DataFrame, Dandelion, AnnData]:
+    """
+    Compute a diversity profile of B cell clones : Hill numbers, Simpson index, Chao1 estimates, Shannon entropy and Gini indices in one go.
+
+    All metrics are calculated from a single (group x clone) count matrix and, if resampling, from the same subsamples.
+
+    Parameters
+    ----------
+    self : Dandelion, AnnData
+        `Dandelion` or `AnnData` object.
+    groupby : str
+        Column name to calculate the diversity profile on, for e.g. sample, patient etc.
+    q : Sequence
+        Orders of the Hill numbers. Default is (0, 1, 2) i.e. clone richness, exponential of Shannon entropy and inverse Simpson index.
+    clone_key : str, optional
+        Column name specifying the clone_id column in metadata.
+    update_obs_meta : bool
+        If True, a `pandas` dataframe is returned. If False, function will try to populate the input object's metadata/obs slot.
+    diversity_key : str, optional
+        key for 'diversity' results in `.uns`.
+    resample : bool
+        Whether or not to randomly sample cells without replacement to the minimum size of groups for the diversity calculation. Default is False.
+    n_resample : int
+        Number of times to perform resampling. Default is 50.
+    normalize : bool
+        Whether or not to return normalized Shannon Entropy according to https://math.stackexchange.com/a/945172. Default is True.
+    base : float
+        Base of the logarithm for Shannon entropy that is not normalized. Default is 2, the default of `skbio.diversity.alpha.shannon` before scikit-bio 0.6.
+    downsample : int, optional
+        number of cells to downsample to. If None, defaults to size of smallest group.
+    random_state : int, optional
+        Seed for the random number generator used for resampling.
+
+    Returns
+    -------
+    `pandas` dataframe, `Dandelion` object with updated `.metadata` slot or `AnnData` object with updated `.obs` slot.
+    """
+    start = logg.info('Calculating diversity profile')
+    if self.__class__ == AnnData:
+        metadata = self.obs.copy()
+    elif self.__class__ == Dandelion:
+        metadata = self.metadata.copy()
+    if clone_key is None:
+        clonekey = 'clone_id'
+    else:
+        clonekey = clone_key
+    if downsample is not None:
+        resample = True
+
+    counts, groups, n_missing = _clone_count_matrix(metadata, groupby, clonekey)
+    groupsizes = np.asarray(counts.sum(axis=1)).reshape(-1) + n_missing
+    if downsample is None:
+        minsize = groupsizes.min()
+    else:
+        minsize = downsample
+        if minsize > groupsizes.min():
+            print('Downsampling size provided of {} was larger than the smallest group size. Defaulting to the smallest group size for downsampling.'.format(downsample))
+            minsize = groupsizes.min()
+
+    if minsize < 100:
+        warnings.warn('The minimum cell numbers when grouped by {} is {}. Exercise caution when interpreting diversity measures.'.format(
+            groupby, minsize))
+
+    if resample:
+        print("Downsampling each group specified in `{}` to {} cells for calculating diversity profile.".format(
+            groupby, minsize))
+    rng = np.random.default_rng(random_state)
+    q = np.asarray(q, dtype=float).reshape(-1)
+    if normalize:
+        shannonkey = 'clone_size_normalized_shannon'
+    else:
+        shannonkey = 'clone_size_shannon'
+    columns = ['clone_size_hill_q'+'{:g}'.format(x) for x in q] + \
+        ['clone_size_simpson', 'clone_size_chao1', shannonkey, 'clone_size_gini']
+
+    res = np.zeros((len(groups), len(columns)))
+    sleep(0.5)
+    for i in range(len(groups)):
+        # only the clones present in the group
+        _counts = counts.data[counts.indptr[i]:counts.indptr[i+1]]
+        if resample:
+            _counts = _resample_counts(
+                _counts, n_missing[i], minsize, n_resample, rng)
+        else:
+            _counts = _counts[None, :]
+        res[i] = np.column_stack([_hill_rows(_counts, q), _simpson_rows(_counts), _chao1_rows(_counts), _shannon_rows(
+            _counts, normalize=normalize, base=base), _gini_rows(_counts)]).mean(axis=0)
+    res = pd.DataFrame(res, index=groups, columns=columns)
+
+    if diversity_key is None:
+        diversitykey = 'diversity'
+    else:
+        diversitykey = diversity_key
+
+    if self.__class__ == AnnData:
+        if diversitykey not in self.uns:
+            self.uns[diversitykey] = {}
+        self.uns[diversitykey].update({'profile': res})
+
+    if update_obs_meta:
+        _transfer_diversity_results(self, res, groupby)
+        sleep(0.5)
+        if self.__class__ == Dandelion:
+            logg.info(' finished', time=start,
+                      deep=('updated `.metadata` with diversity profile.\n'))
+        elif self.__class__ == AnnData:
+            logg.info(' finished', time=start,
+                      deep=('updated `.obs` and `.uns` with diversity profile.\n'))
+    else:
+        sleep(0.5)
+        if self.__class__ == AnnData:
+            logg.info(' finished', time=start,
+                      deep=('updated `.uns` with diversity profile.\n'))
+        else:
+            logg.info(' finished', time=start)
+        return(res)
+
+
+def clone_diversity_sketch(data: Union[str, pd.DataFrame, Dandelion, AnnData], groupby: str, clone_key: Union[None, str] = None, normalize: bool = True, base: float = 2, chunksize: int = 1000000, precision: int = 11, top_k: int = 128, sample_size: int = 256) -> pd.DataFrame:
+    """
+    Approximate clone richness and Shannon entropy of very large repertoires with streaming sketches.
+
+    Cells are read in chunks and each group only keeps fixed size sketches of its clones, i.e. about 8 kilobytes per group with the default settings regardless of the number of cells. When reading an AIRR table, each cell is counted once through its heavy chain (IGH, TRB or TRD) contig.
+
+    Richness is estimated with a HyperLogLog sketch, with a standard error of 1.04/sqrt(2**precision). For the Shannon entropy, the largest clones are tracked with a Misra-Gries heavy hitter sketch of `top_k` counters and the remaining clones are represented by a uniform sample of `sample_size` distinct clones (the clones with the smallest hash values) whose sizes are counted exactly. The standard error of the entropy is that of the ratio estimate from this sample.
+
+    Parameters
+    ----------
+    data : str, DataFrame, Dandelion, AnnData
+        Path to AIRR table, AIRR or metadata table, `Dandelion` or `AnnData` object.
+    groupby : str
+        Column name to calculate the estimates on, for e.g. sample, patient etc.
+    clone_key : str, optional
+        Column name specifying the clone_id column.
+    normalize : bool
+        Whether or not to return normalized Shannon Entropy according to https://math.stackexchange.com/a/945172. Default is True.
+    base : float
+        Base of the logarithm for Shannon entropy that is not normalized. Default is 2, the default of `skbio.diversity.alpha.shannon` before scikit-bio 0.6.
+    chunksize : int
+        Number of rows read at a time.
+    precision : int
+        HyperLogLog uses 2**precision registers of 1 byte each.
+    top_k : int
+        Number of counters for tracking the largest clones.
+    sample_size : int
+        Number of distinct clones sampled.
+
+    Returns
+    -------
+    `pandas` dataframe with the estimates for each group.
+    """
+    start = logg.info('Calculating sketch-based diversity estimates')
+    if clone_key is None:
+        clonekey = 'clone_id'
+    else:
+        clonekey = clone_key
+
+    if type(data) is str:
+        chunks = pd.read_csv(data, sep='\t', chunksize=chunksize, dtype='object',
+                             usecols=lambda x: x in [groupby, clonekey, 'locus'])
+    else:
+        if data.__class__ == AnnData:
+            dat = data.obs
+        elif data.__class__ == Dandelion:
+            dat = data.metadata
+        else:
+            dat = data
+        chunks = (dat.iloc[i:i+chunksize]
+                  for i in range(0, dat.shape[0], chunksize))
+
+    sketches = {}
+    for chunk in chunks:
+        if 'locus' in chunk:
+            chunk = chunk[chunk['locus'].isin(['IGH', 'TRB', 'TRD'])]
+        chunk = chunk[chunk[groupby].notna() & chunk[clonekey].notna() & (
+            chunk[clonekey].astype(str) != 'nan')]
+        for g, _chunk in chunk.groupby(groupby, observed=True):
+            if g not in sketches:
+                sketches[g] = _CloneSketch(
+                    precision=precision, top_k=top_k, sample_size=sample_size)
+            sketches[g].update(np.array(_chunk[clonekey]))
+
+    res = pd.DataFrame([sketches[g].estimate(normalize=normalize, base=base)
+                        for g in sketches], index=pd.Index(list(sketches)))
+    logg.info(' finished', time=start)
+    return(res)
+
+
+class _CloneSketch:
+    """
+    Fixed size sketches of the clones of one group : HyperLogLog for the number of clones, Misra-Gries for the largest clones and a bottom-k sample of clones with exact sizes.
+    """
+
+    def __init__(self, precision: int = 11, top_k: int = 128, sample_size: int = 256):
+        self.precision = precision
+        self.registers = np.zeros(2 ** precision, dtype=np.uint8)
+        self.top_k = top_k
+        self.top_hashes = np.array([], dtype=np.uint64)
+        self.top_counts = np.array([], dtype=np.int64)
+        # every tracked clone size is underestimated by at most top_error
+        self.top_error = 0
+        self.sample_size = sample_size
+        self.sample_hashes = np.array([], dtype=np.uint64)
+        self.sample_counts = np.array([], dtype=np.int64)
+        self.n = 0
+
+    def update(self, clones: np.ndarray):
+        hashes, sizes = np.unique(pd.util.hash_array(
+            clones.astype(str).astype(object)), return_counts=True)
+        self.n += int(sizes.sum())
+        # hyperloglog : the top bits pick the register, the rank is taken from the lower 32 bits
+        idx = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        low = (hashes & np.uint64(0xFFFFFFFF)).astype(np.float64)
+        bitlength = np.where(low > 0, np.floor(
+            np.log2(np.maximum(low, 1))) + 1, 0)
+        np.maximum.at(self.registers, idx, (33 - bitlength).astype(np.uint8))
+        # misra-gries, merged a chunk at a time
+        merged, counts = self._merge(
+            self.top_hashes, self.top_counts, hashes, sizes)
+        if len(merged) > self.top_k:
+            decrement = np.partition(counts, -(self.top_k + 1))[-(self.top_k + 1)]
+            counts = counts - decrement
+            merged, counts = merged[counts > 0], counts[counts > 0]
+            self.top_error += decrement
+        self.top_hashes, self.top_counts = merged, counts
+        # bottom-k sample. A clone that ends up in the sample was below the threshold since it was first seen, so its size is exact.
+        merged, counts = self._merge(
+            self.sample_hashes, self.sample_counts, hashes, sizes)
+        self.sample_hashes = merged[:self.sample_size]
+        self.sample_counts = counts[:self.sample_size]
+
+    @staticmethod
+    def _merge(hashes1: np.ndarray, counts1: np.ndarray, hashes2: np.ndarray, counts2: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        merged, inverse = np.unique(np.concatenate(
+            [hashes1, hashes2]), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate(
+            [counts1, counts2])).astype(np.int64)
+        return(merged, counts)
+
+    def richness(self) -> Tuple[float, float]:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        est = alpha * m * m / np.sum(2.0 ** -self.registers.astype(float))
+        zeros = np.sum(self.registers == 0)
+        if est <= 2.5 * m and zeros > 0:
+            # small range correction
+            est = m * np.log(m / zeros)
+        return(est, est * 1.04 / np.sqrt(m))
+
+    def shannon(self, richness: float) -> Tuple[float, float]:
+        # H = log(n) - sum(c * log(c)) / n over all clones
+        # only clones well above the misra-gries error are taken as the largest clones
+        heavy = self.top_counts >= 4 * self.top_error
+        top = self.top_counts[heavy] + self.top_error / 2
+        x = self.sample_counts[~np.isin(
+            self.sample_hashes, self.top_hashes[heavy])].astype(float)
+        rest = self.n - top.sum()
+        if len(x) == 0 or rest <= 0:
+            return(np.log(self.n) - np.sum(top * np.log(top)) / self.n, 0)
+        y = x * np.log(x)
+        # ratio estimate of sum(c * log(c)) over the remaining clones
+        ratio = y.sum() / x.sum()
+        f = min(len(x) / max(richness - len(top), len(x)), 1)
+        if len(x) > 1:
+            var = (1 - f) / len(x) * np.var(y - ratio * x, ddof=1) / x.mean() ** 2
+        else:
+            var = 0
+        h = np.log(self.n) - (np.sum(top * np.log(top)) + rest * ratio) / self.n
+        return(h, rest / self.n * np.sqrt(var))
+
+    def estimate(self, normalize: bool = True, base: float = 2) -> Dict:
+        richness, richness_se = self.richness()
+        h, h_se = self.shannon(richness)
+        if normalize:
+            if richness > 1:
+                h, h_se = h / np.log(richness), h_se / np.log(richness)
+            else:
+                h, h_se = 0, 0
+            key = 'clone_size_normalized_shannon'
+        else:
+            h, h_se = h / np.log(base), h_se / np.log(base)
+            key = 'clone_size_shannon'
+        return({'n_cells': self.n, 'clone_size_richness': richness, 'clone_size_richness_se': richness_se, key: h, key+'_se': h_se})
+
+
 def chooseln(N, k):
     '''
     R's lchoose in python
@@ -1012,19 +1300,233 @@ def chooseln(N, k):
     return gammaln(N+1) - gammaln(N-k+1) - gammaln(k+1)
 
 
+def _transfer_diversity_results(self: Union[Dandelion, AnnData], results: pd.DataFrame, groupby: str):
+    """
+    Transfers diversity results of each group to the cells in the metadata/obs slot.
+
+    Parameters
+    ----------
+    self : Dandelion, AnnData
+        `Dandelion` or `AnnData` object.
+    results : DataFrame
+        diversity results with groups as index and one column per metric.
+    groupby : str
+        Column name in metadata/obs containing the groups.
+    """
+    if self.__class__ == AnnData:
+        metadata = self.obs
+    elif self.__class__ == Dandelion:
+        metadata = self.metadata
+
+    # one lookup of every cell's group for all metrics; cells in groups without results get NaN
+    res = results[~results.index.isna()].reindex(np.array(metadata[groupby]))
+    for c in res.columns:
+        metadata[c] = np.array(res[c])
+
+
+def _clone_counts(clones: pd.Series) -> Tuple[np.ndarray, int]:
+    """
+    Clone size counts of a group of cells.
+
+    Parameters
+    ----------
+    clones : pd.Series
+        clone_id of each cell.
+
+    Returns
+    -------
+    size of each clone and the number of cells without a clone.
+    """
+    _tab = clones.value_counts()
+    _tab = _tab[~(_tab.index.isna() | (_tab.index.astype(str) == 'nan'))]
+    counts = np.array(_tab[_tab > 0])
+    return(counts, len(clones) - counts.sum())
+
+
+def _resample_counts(counts: np.ndarray, n_missing: int, size: int, n_resample: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Clone size counts of random subsamples of cells drawn without replacement.
+
+    All subsamples are drawn at once from a multivariate hypergeometric distribution, which is the same as sampling the cells and counting their clones.
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        size of each clone.
+    n_missing : int
+        number of cells without a clone. These can be drawn but are not counted.
+    size : int
+        number of cells in each subsample.
+    n_resample : int
+        number of subsamples.
+    rng : np.random.Generator
+        random number generator.
+
+    Returns
+    -------
+    (n_resample x clones) array of clone size counts.
+    """
+    pool = np.append(counts, n_missing).astype(np.int64)
+    if size >= pool.sum():
+        return(np.tile(counts, (n_resample, 1)))
+    return(rng.multivariate_hypergeometric(pool, size, size=n_resample)[:, :-1])
+
+
+def _clone_count_matrix(metadata: pd.DataFrame, groupby: str, clone_key: str) -> Tuple[csr_matrix, pd.Index, np.ndarray]:
+    """
+    Sparse (group x clone) matrix of clone size counts.
+
+    Parameters
+    ----------
+    metadata : DataFrame
+        `Dandelion` metadata or `AnnData` obs table.
+    groupby : str
+        Column name of the groups.
+    clone_key : str
+        Column name specifying the clone_id column.
+
+    Returns
+    -------
+    count matrix, the groups for the rows and the number of cells without a clone in each group.
+    """
+    group_codes, groups = pd.factorize(metadata[groupby], sort=True)
+    clones = metadata[clone_key]
+    missing = np.array(clones.isna() | (clones.astype(str) == 'nan'))
+    clone_codes, _ = pd.factorize(clones.where(~missing))
+    keep = group_codes >= 0
+    n_missing = np.bincount(
+        group_codes[keep & missing], minlength=len(groups))
+    keep &= ~missing
+    counts = csr_matrix((np.ones(keep.sum(), dtype=np.int64), (group_codes[keep], clone_codes[keep])), shape=(
+        len(groups), clone_codes.max() + 1 if len(clone_codes) > 0 else 0))
+    counts.sum_duplicates()
+    counts.eliminate_zeros()
+    return(counts, pd.Index(groups), n_missing)
+
+
+def _hill_rows(counts: np.ndarray, q: np.ndarray) -> np.ndarray:
+    """
+    Hill numbers of order q for each row of clone size counts. Rows without clones are 0.
+    """
+    counts = counts.astype(float)
+    observed = np.sum(counts > 0, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        freqs = counts / counts.sum(axis=1, keepdims=True)
+        # (rows x q); only clones with cells are summed so that q = 0 counts the clones
+        power = np.sum(np.where(counts[:, :, None] > 0, freqs[:, :, None] ** q[None, None, :], 0), axis=1)
+        logfreqs = np.where(counts > 0, np.log(freqs), 0)
+        entropy = -np.sum(np.where(counts > 0, freqs * logfreqs, 0), axis=1)
+        hill = np.where(q[None, :] == 1, np.exp(entropy)[:, None],
+                        power ** (1 / (1 - q[None, :])))
+    return(np.where(observed[:, None] > 0, hill, 0))
+
+
+def _simpson_rows(counts: np.ndarray) -> np.ndarray:
+    """
+    Simpson index (1 - dominance) of each row of clone size counts, as in `skbio.diversity.alpha.simpson`. Rows without clones are 0.
+    """
+    counts = counts.astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        freqs = counts / counts.sum(axis=1, keepdims=True)
+    return(np.where(counts.sum(axis=1) > 0, 1 - np.nansum(freqs ** 2, axis=1), 0))
+
+
+def _chao1_rows(counts: np.ndarray) -> np.ndarray:
+    """
+    Bias-corrected Chao1 estimate of each row of clone size counts, as in `skbio.diversity.alpha.chao1`.
+    """
+    observed = np.sum(counts > 0, axis=1)
+    singles = np.sum(counts == 1, axis=1)
+    doubles = np.sum(counts == 2, axis=1)
+    return(observed + singles * (singles - 1) / (2 * (doubles + 1)))
+
+
+def _shannon_rows(counts: np.ndarray, normalize: bool = True, base: float = 2) -> np.ndarray:
+    """
+    Shannon entropy of each row of clone size counts.
+
+    If normalize, the entropy is divided by its maximum (https://math.stackexchange.com/a/945172); rows with one clone are 0 and rows without clones are 1. Otherwise it is in the provided base, and rows without clones are 0.
+    """
+    counts = counts.astype(float)
+    observed = np.sum(counts > 0, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        freqs = counts / counts.sum(axis=1, keepdims=True)
+        entropy = -np.sum(np.where(counts > 0, freqs *
+                                   np.log(freqs), 0), axis=1)
+        if normalize:
+            return(np.where(observed > 1, entropy / np.log(observed), np.where(observed == 1, 0, 1)))
+    return(np.where(observed > 0, entropy / np.log(base), 0))
+
+
+def _gini_rows(counts: np.ndarray) -> np.ndarray:
+    """
+    Gini index of each row of clone size counts.
+
+    Same as `skbio.diversity.alpha.gini_index` with method='trapezoids' on the non-zero counts, with a single zero appended when there is more than one clone.
+    """
+    counts = np.sort(counts, axis=1).astype(float)
+    observed = np.sum(counts > 0, axis=1)
+    n = np.where(observed > 1, observed + 1, observed)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # leading zeros do not add to the area under the lorenz curve
+        lorenz = np.cumsum(counts, axis=1) / counts.sum(axis=1, keepdims=True)
+        area = (np.sum(lorenz, axis=1) - 0.5) / n
+    return(np.where(observed > 0, np.clip(1 - 2 * area, 0, None), 0))
+
+
+def rarefy(y: np.ndarray, samples: Sequence, chunk_size: int = 10000000) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Expected number of clones and its variance when drawing a number of cells without replacement.
+
+    Adapted from rarefy in vegan (https://github.com/vegandevs/vegan/blob/master/R/rarefy.R) but evaluated for all sample sizes at once as a broadcasted grid of log-gamma terms. Clones of the same size share the same terms, so the grid is only as wide as the number of distinct clone sizes.
+
+    Parameters
+    ----------
+    y : np.ndarray
+        clone size counts.
+    samples : Sequence
+        numbers of cells drawn.
+    chunk_size : int
+        Maximum number of elements of the grid evaluated at once.
+
+    Returns
+    -------
+    expected number of clones and its variance for each number of cells drawn.
+    """
+    y = np.asarray(y)
+    y = y[y > 0]
+    J = np.sum(y)
+    sizes, mult = np.unique(y, return_counts=True)
+    # pairs of clones, grouped by their combined size
+    u, v = np.triu_indices(len(sizes))
+    pair_sizes = sizes[u] + sizes[v]
+    pair_mult = np.where(u == v, mult[u] * (mult[u] - 1) / 2, mult[u] * mult[v])
+
+    samples = np.asarray(samples, dtype=float).reshape(-1)
+    richness = np.zeros(len(samples))
+    variance = np.zeros(len(samples))
+    rows = max(1, int(chunk_size // max(1, len(sizes) + len(pair_sizes))))
+
+    def _missed(d, n, ldiv):
+        # probability that all n cells are drawn from the d cells outside the clone(s)
+        return(np.where(d < n, 0, np.exp(chooseln(np.maximum(d, n), n) - ldiv)))
+
+    for i in range(0, len(samples), rows):
+        n = samples[i:i+rows, None]
+        ldiv = chooseln(J, n)
+        p1 = _missed(J - sizes[None, :], n, ldiv)
+        richness[i:i+rows] = np.sum(mult * (1 - p1), axis=1)
+        sp = np.sum(mult * p1, axis=1)
+        sp2 = np.sum(mult * p1 ** 2, axis=1)
+        p2 = _missed(J - pair_sizes[None, :], n, ldiv)
+        variance[i:i+rows] = (sp - sp2) + 2 * (np.sum(pair_mult * p2, axis=1) - (sp ** 2 - sp2) / 2)
+    return(richness, np.clip(variance, 0, None))
+
+
 def rarefun(y, sample):
     '''
     Adapted from rarefun from vegan:
     https://github.com/vegandevs/vegan/blob/master/R/rarefy.R
     '''
-    res = []
-    y = y[y > 0]
-    J = np.sum(y)
-    ldiv = chooseln(J, sample)
-    for d in J - y:
-        if d < sample:
-            res.append(0)
-        else:
-            res.append(np.exp(chooseln(d, sample) - ldiv))
-    out = np.sum(1 - np.array(res))
+    out = rarefy(y, [sample])[0][0]
     return(out)
@@ -284,6 +284,9 @@ def generate_network(self: Union[Dandelion, pd.DataFrame, str], key: Union[None,
     # and now to actually generate the network
     g, g_, lyt, lyt_ = generate_layout(
         vertice_list, edge_list_final, min_size=min_size, weight=None, verbose=verbose, **kwargs)
+    # record how the network was built, for `_induced_network`
+    for G in (g, g_):
+        G.graph.update({'clone_key': clonekey, 'min_size': min_size})
 
     # convert distance matrices to sparse
     for x in dmat:
@@ -325,6 +328,52 @@ def generate_network(self: Union[Dandelion, pd.DataFrame, str], key: Union[None,
         return(out)
 
 
+def _induced_network(self: Dandelion, cells: Sequence) -> Dandelion:
+    """
+    Slices an existing network down to the subgraph induced by the provided cells.
+
+    Edges are only drawn between cells of the same clone, so if no clone has cells both inside and outside of `cells`, the network generated from `cells` is the subgraph of the full network induced by them. `_induces_groups` checks this for the groups of a column. This avoids recalculating distances, minimum spanning trees and layouts.
+
+    Parameters
+    ----------
+    self : Dandelion
+        `Dandelion` object after `tl.generate_network` has been run.
+    cells : Sequence
+        cell barcodes to keep.
+
+    Returns
+    -------
+    `Dandelion` object holding the induced `.edges`, `.layout` and `.graph` slots.
+    """
+    cells = pd.Index(cells)
+    metadata = self.metadata[self.metadata.index.isin(cells)]
+    data = self.data[self.data['cell_id'].isin(cells)]
+    if self.edges is not None:
+        keep = self.edges['source'].isin(cells) & self.edges['target'].isin(cells)
+        edges = self.edges[keep.values]
+    else:
+        edges = None
+    if self.layout is not None:
+        layout = tuple({k: l[k] for k in cells if k in l} for l in self.layout)
+    else:
+        layout = None
+    graph = tuple(g.subgraph([c for c in cells if c in g]) for g in self.graph)
+    out = Dandelion(data=data, metadata=metadata, edges=edges,
+                    layout=layout, graph=graph, initialize=False)
+    return(out)
+
+
+def _induces_groups(self: Dandelion, groupby: str, clone_key: str) -> bool:
+    # whether the network of each group in `groupby` is the subgraph of `.graph` induced by the group's cells, i.e. `.graph` was built by `generate_network` with this `clone_key` and the default `min_size` and no clone has cells in more than one group
+    if self.graph is None or any(g.graph.get('clone_key') != clone_key or g.graph.get('min_size') != 2 for g in self.graph):
+        return(False)
+    clones = self.metadata[clone_key].dropna().astype(str).str.split('|').explode()
+    clones = clones[~clones.isin(['', 'nan', 'None'])]
+    groups = pd.DataFrame({'clone': clones.values, 'group': self.metadata.loc[clones.index, groupby].values})
+    # cells without a group are in no group's network, so they count as a group of their own
+    return(bool((groups.groupby('clone')['group'].nunique(dropna=False) <= 1).all()))
+
+
 def mst(mat: dict) -> Tree:
     """
     Construct minimum spanning tree based on supplied matrix in dictionary.
@@ -563,45 +563,18 @@ def find_clones(self: Union[Dandelion, pd.DataFrame], identity: float = 0.85, ke
                     '   \'data\', contig-indexed clone table\n'
                     '   \'metadata\', cell-indexed clone table\n'))
     if self.__class__ == Dandelion:
-        if self.germline is not None:
-            germline_ = self.germline
-        else:
-            germline_ = None
-        if self.distance is not None:
-            dist_ = self.distance
-        else:
-            dist_ = None
-        if self.edges is not None:
-            edge_ = self.edges
-        else:
-            edge_ = None
-        if self.layout is not None:
-            layout_ = self.layout
-        else:
-            layout_ = None
-        if self.graph is not None:
-            graph_ = self.graph
-        else:
-            graph_ = None
-        if self.threshold is not None:
-            threshold_ = self.threshold
-        else:
-            threshold_ = None
+        # the metadata is only recomputed for cells whose contigs changed
         if ('clone_id' in self.data.columns) and (key_added is None):
             # TODO: need to check the following bits if it works properly if only heavy chain tables are provided
-            self.__init__(data=dat_, germline=germline_, distance=dist_,
-                          edges=edge_, layout=layout_, graph=graph_)
+            self.data = dat_
             update_metadata(self, reinitialize=True)
         elif ('clone_id' in self.data.columns) and (key_added is not None):
-            self.__init__(data=dat_, germline=germline_, distance=dist_,
-                          edges=edge_, layout=layout_, graph=graph_)
+            self.data = dat_
             update_metadata(self, reinitialize=True, clone_key='clone_id',
                             retrieve=clone_key, split=False, collapse=True, combine=True)
         else:
-            self.__init__(data=dat_, germline=germline_, distance=dist_, edges=edge_,
-                          layout=layout_, graph=graph_, clone_key=clone_key)
+            self.data = dat_
             update_metadata(self, reinitialize=True, clone_key=clone_key)
-        self.threshold = threshold_
 
     else:
         out = Dandelion(data=dat_, clone_key=clone_key, retrieve=clone_key,
@@ -1024,41 +997,18 @@ def define_clones(self: Union[Dandelion, pd.DataFrame, str], dist: Union[None, f
     dat[str(clone_key)] = pd.Series(cloned_['clone_id'])
 
     if self.__class__ == Dandelion:
-        if self.germline is not None:
-            germline_ = self.germline
-        else:
-            germline_ = None
-        if self.distance is not None:
-            dist_ = self.distance
-        else:
-            dist_ = None
-        if self.edges is not None:
-            edge_ = self.edges
-        else:
-            edge_ = None
-        if self.layout is not None:
-            layout_ = self.layout
-        else:
-            layout_ = None
-        if self.graph is not None:
-            graph_ = self.graph
-        else:
-            graph_ = None
-        if self.threshold is not None:
-            threshold_ = self.threshold
-        else:
-            threshold_ = None
-
+        # the metadata is only recomputed for cells whose contigs changed
         if ('clone_id' in self.data.columns) and (clone_key is not None):
-            self.__init__(data=dat, germline=germline_, distance=dist_, edges=edge_, layout=layout_,
-                          graph=graph_, initialize=True, retrieve=clone_key, split=False, collapse=True, combine=True)
+            self.data = dat
+            update_metadata(self, reinitialize=True, retrieve=clone_key,
+                            split=False, collapse=True, combine=True)
         elif ('clone_id' not in self.data.columns) and (clone_key is not None):
-            self.__init__(data=dat, germline=germline_, distance=dist_, edges=edge_, layout=layout_, graph=graph_,
-                          initialize=True, clone_key=clone_key, retrieve=clone_key, split=False, collapse=True, combine=True)
+            self.data = dat
+            update_metadata(self, reinitialize=True, clone_key=clone_key,
+                            retrieve=clone_key, split=False, collapse=True, combine=True)
         else:
-            self.__init__(data=dat, germline=germline_, distance=dist_, edges=edge_,
-                          layout=layout_, graph=graph_, initialize=True, clone_key=clone_key)
-        self.threshold = threshold_
+            self.data = dat
+            update_metadata(self, reinitialize=True, clone_key=clone_key)
     else:
         if ('clone_id' in dat.columns) and (clone_key is not None):
             out = Dandelion(data=dat, retrieve=clonekey, split=False)
@@ -5,26 +5,163 @@
 # @Last Modified time: 2021-03-30 15:30:49
 
 import os
-from collections import defaultdict
+import shutil
+from collections import defaultdict, deque
 import pandas as pd
 import numpy as np
 import re
 import copy
+import json
+import functools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from changeo.IO import readGermlines
 import warnings
 import h5py
+import scipy.sparse
 import networkx as nx
 import bz2
 import gzip
 from anndata import AnnData
 import _pickle as cPickle
+import pickle
 try:
     from scanpy import logging as logg
 except ImportError:
     pass
 from ..utilities._utilities import *
+from ..utilities._utilities import _plain_dtypes, _h5_dtypes
 from ..utilities._io import *
-from typing import Union, Sequence, Tuple, Dict
+from typing import Union, Sequence, Tuple, Dict, Callable
+
+
+class _ContigIndex:
+    """
+    Integer-coded index of the contigs of each cell.
+
+    Cells and loci are coded once in order of appearance and the rows of the AIRR table are sorted by cell, so the contigs of a cell are a single slice. Heavy/light chain positions are coded on first use for each locus mode.
+    """
+
+    def __init__(self, data: pd.DataFrame):
+        self.data = data
+        self.n_contigs = data.shape[0]
+        # the arrays are held so that a replaced column is always detected
+        self._columns = [data[c].values for c in [
+            'cell_id', 'sequence_id', 'locus']]
+        self.cell_codes, cells = pd.factorize(data['cell_id'].values)
+        # plain index also for categorical columns
+        self.cells = pd.Index(np.asarray(cells))
+        self.order = np.argsort(self.cell_codes, kind='stable')
+        self.indptr = np.searchsorted(
+            self.cell_codes[self.order], np.arange(len(self.cells) + 1))
+        self.locus_codes, loci = pd.factorize(data['locus'].values)
+        self.loci = pd.Index(np.asarray(loci))
+        self._chains = {}
+
+    def is_valid(self, data: pd.DataFrame) -> bool:
+        """
+        Whether the index still describes `data`.
+        """
+        if data is not self.data or data.shape[0] != self.n_contigs:
+            return(False)
+        for c, v in zip(['cell_id', 'sequence_id', 'locus'], self._columns):
+            if c not in data:
+                return(False)
+            w = data[c].values
+            if isinstance(v, np.ndarray) and isinstance(w, np.ndarray):
+                if w.__array_interface__['data'] != v.__array_interface__['data']:
+                    return(False)
+            elif w is not v:
+                return(False)
+        return(True)
+
+    def rebind(self, data: pd.DataFrame) -> '_ContigIndex':
+        """
+        Index for a copy of the table it describes, sharing the codes.
+        """
+        index = copy.copy(self)
+        index.data = data
+        index._columns = [data[c].values for c in [
+            'cell_id', 'sequence_id', 'locus']]
+        index._chains = dict(self._chains)
+        return(index)
+
+    def rows(self, cell: str, loci: Union[None, Sequence] = None) -> np.ndarray:
+        """
+        Row numbers of the contigs of a cell, optionally only of the given loci.
+        """
+        if cell != cell:
+            rows = np.flatnonzero(self.cell_codes == -1)
+        else:
+            i = self.cells.get_loc(cell)
+            rows = self.order[self.indptr[i]:self.indptr[i + 1]]
+        if loci is not None:
+            codes = self.loci.get_indexer(list(loci))
+            rows = rows[np.isin(self.locus_codes[rows], codes[codes >= 0])]
+        return(rows)
+
+    def chains(self, locus: Literal['ig'] = 'ig', split_locus: bool = False) -> Tuple[Dict, pd.Index]:
+        """
+        Contigs of each chain coded against the cells with a heavy chain contig. See `_locus_contigs`.
+        """
+        if (locus, split_locus) not in self._chains:
+            self._chains[(locus, split_locus)] = _locus_contigs(
+                self.data, locus, split_locus)
+        return(self._chains[(locus, split_locus)])
+
+
+class _Shared:
+    """
+    Slot value held by several `Dandelion` copies. Each copy takes a private copy on first access to the slot, except the last one which takes the value itself.
+    """
+
+    def __init__(self, value):
+        self.value = value
+        self.refs = 1
+
+
+class _LazySlot:
+    """
+    Slot value read on first access, e.g. from a `.h5` file, with its number of rows if it is known without reading it.
+    """
+
+    def __init__(self, load, nrows: Union[None, int] = None):
+        self.load = load
+        self.nrows = nrows
+
+
+def _copy_slot(value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return(value.copy(deep=True))
+    if isinstance(value, dict) and not any(isinstance(v, (dict, list, tuple)) for v in value.values()):
+        # e.g. the germline dictionary of sequences or the dictionary of sparse distance matrices
+        return({k: v.copy() if hasattr(v, 'copy') else v for k, v in value.items()})
+    return(copy.deepcopy(value))
+
+
+def _slot(name: str, doc: str) -> property:
+    key = '_' + name
+
+    def fget(self):
+        return(self._own(key))
+
+    def fset(self, value):
+        self._release(key)
+        self.__dict__[key] = value
+        self._touch(key)
+
+    return(property(fget, fset, doc=doc))
+
+
+def _fingerprint(value) -> Union[None, Tuple]:
+    # content hash of a table, None if it cannot be hashed
+    if not isinstance(value, pd.DataFrame):
+        return(None)
+    try:
+        hashed = pd.util.hash_pandas_object(value, index=True).values
+    except TypeError:
+        return(None)
+    return((tuple(value.columns), tuple(str(t) for t in value.dtypes), int(hashed.sum()), len(hashed)))
 
 
 class Dandelion:
@@ -36,6 +173,15 @@ class Dandelion:
     """
 
     def __init__(self, data=None, metadata=None, germline=None, distance=None, edges=None, layout=None, graph=None, initialize=True, **kwargs):
+        self._contig_index = None
+        self._metadata_init = None
+        self._metadata_stale = False
+        self._metadata_snapshot = None
+        self._versions = {}
+        self._handed = set()
+        self._h5_saved = None
+        self._metadata_fallback = False
+        self._metadata_derived = None
         self.data = data
         self.metadata = metadata
         self.distance = distance
@@ -49,64 +195,320 @@ class Dandelion:
             self.germline.update(germline)
 
         if os.path.isfile(str(self.data)):
+            # `_io` imports this module, so `load_data` is not available at import time
+            from ..utilities._io import load_data
             self.data = load_data(self.data)
 
         if self.data is not None:
-            self.n_contigs = self.data.shape[0]
             if metadata is None:
                 if initialize is True:
-                    update_metadata(self, **kwargs)
-                try:
-                    self.n_obs = self.metadata.shape[0]
-                except:
-                    self.n_obs = 0
+                    # the metadata is computed on first access
+                    _initialize_cols(self, kwargs.get('clone_key'))
+                    self._metadata_init = kwargs
             else:
                 self.metadata = metadata
-                self.n_obs = self.metadata.shape[0]
+        # nothing has been handed out to a caller yet, so the slots can be shared by `copy`
+        self._handed = set()
+
+    distance = _slot('distance', """
+        Pairwise distance matrices of each sequence type used to generate the network.
+        """)
+    edges = _slot('edges', """
+        Edge list of the network.
+        """)
+    layout = _slot('layout', """
+        Layouts of the network and of the network without singletons.
+        """)
+    graph = _slot('graph', """
+        `networkx` graphs of the network and of the network without singletons.
+        """)
+    germline = _slot('germline', """
+        Germline reference dictionary.
+        """)
+
+    @property
+    def data(self) -> pd.DataFrame:
+        """
+        AIRR table of the contigs.
+        """
+        return(self._own('_data'))
+
+    @data.setter
+    def data(self, value: pd.DataFrame):
+        self._release('_data')
+        self._data = value
+        self._touch('_data')
+        self._contig_index = None
+        if self._metadata_init is not None:
+            self._metadata_stale = True
+
+    @property
+    def metadata(self) -> pd.DataFrame:
+        """
+        Cell-level metadata. Unless provided, it is computed from `.data` on first access and updated for the changed cells after `.data` is replaced.
+        """
+        self._refresh_metadata()
+        return(self._own('_metadata'))
+
+    @metadata.setter
+    def metadata(self, value: pd.DataFrame):
+        self._release('_metadata')
+        self._metadata = value
+        self._touch('_metadata')
+        self._metadata_init = None
+        self._metadata_stale = False
+        self._metadata_snapshot = None
+        self._metadata_derived = None
+
+    @property
+    def n_obs(self) -> int:
+        """
+        Number of cells in `.metadata`.
+        """
+        self._refresh_metadata()
+        metadata = self._peek('_metadata')
+        if metadata is None:
+            return(0)
+        return(metadata.shape[0])
+
+    @property
+    def n_contigs(self) -> int:
+        """
+        Number of contigs in `.data`.
+        """
+        data = self._peek('_data')
+        if not isinstance(data, pd.DataFrame):
+            return(0)
+        return(data.shape[0])
+
+    @property
+    def contig_index(self) -> _ContigIndex:
+        """
+        Integer-coded index of the contigs of each cell in `.data`, built on first use and rebuilt after `.data` changes.
+        """
+        data = self._peek('_data')
+        if data is None:
+            return(None)
+        if self._contig_index is None or not self._contig_index.is_valid(data):
+            self._contig_index = _ContigIndex(data)
+        return(self._contig_index)
+
+    def _refresh_metadata(self):
+        if (self._metadata is None or self._metadata_stale) and self._metadata_init is not None and self._data is not None:
+            kwargs, self._metadata_init = self._metadata_init, None
+            fallback, self._metadata_fallback = self._metadata_fallback, False
+            previous, derived = self._peek('_metadata'), self._metadata_derived
+            # the metadata is built from the contigs without copying them away from other copies or marking them as handed out
+            shared, handed = self.__dict__.get('_data'), set(self._handed)
+            if isinstance(shared, _Shared):
+                self.__dict__['_data'] = shared.value
+            try:
+                update_metadata(self, **dict(kwargs, reinitialize=True))
+            except:
+                if fallback:
+                    # as if the object had been created with `initialize=False`
+                    self._metadata_stale = False
+                    return
+                self._metadata_init = kwargs
+                raise
+            finally:
+                if isinstance(shared, _Shared) and self.__dict__.get('_data') is shared.value:
+                    self.__dict__['_data'] = shared
+                self._handed = handed
+            # columns added to the metadata by the user are kept for the cells that are still there
+            metadata = self._peek('_metadata')
+            if previous is not None and metadata is not None and derived is not None:
+                for col in previous.columns:
+                    if col not in derived and col not in metadata.columns:
+                        metadata[col] = previous[col].reindex(metadata.index)
+
+    def _peek(self, key: str):
+        # slot value without taking ownership, for read-only use
+        value = self.__dict__.get(key)
+        if isinstance(value, _LazySlot):
+            value = self._load(key)
+        if isinstance(value, _Shared):
+            return(value.value)
+        return(value)
+
+    def _load(self, key: str):
+        value = self.__dict__[key].load()
+        self.__dict__[key] = value
+        if self._h5_saved is not None and key in ['_data', '_metadata']:
+            self._h5_saved['fingerprints'][key] = _fingerprint(value)
+        return(value)
+
+    def _touch(self, key: str):
+        # slots can be modified in place, so every access through the attribute counts as a change
+        self._versions[key] = self._versions.get(key, 0) + 1
+
+    def _changed(self, key: str) -> bool:
+        # whether a slot changed since it was read from or written to `self._h5_saved['filename']`
+        if key == '_metadata' and (self._metadata_stale or (self._metadata_init is not None and self._changed('_data'))):
+            # the metadata is computed from `.data`, so it changes with it
+            return(True)
+        if self._versions.get(key, 0) == self._h5_saved['versions'].get(key, 0):
+            return(False)
+        fingerprint = self._h5_saved['fingerprints'].get(key)
+        return(fingerprint is None or fingerprint != _fingerprint(self._peek(key)))
+
+    def _h5_record(self, filename: str):
+        fingerprints = {}
+        for key in ['_data', '_metadata']:
+            if not isinstance(self.__dict__.get(key), _LazySlot):
+                fingerprints[key] = _fingerprint(self._peek(key))
+        self._h5_saved = {'filename': os.path.abspath(filename), 'versions': dict(
+            self._versions), 'fingerprints': fingerprints}
+
+    def _release(self, key: str):
+        # the slot is replaced, so a value shared with other copies is left to them
+        value = self.__dict__.get(key)
+        if isinstance(value, _Shared):
+            value.refs -= 1
+        self._handed.discard(key)
+
+    def _own(self, key: str):
+        value = self.__dict__.get(key)
+        if isinstance(value, _LazySlot):
+            value = self._load(key)
+        self._touch(key)
+        # the caller may keep a reference to the value, so it can no longer be shared by `copy`
+        self._handed.add(key)
+        if not isinstance(value, _Shared):
+            return(value)
+        if value.refs > 1:
+            value.refs -= 1
+            owned = _copy_slot(value.value)
         else:
-            self.n_contigs = 0
-            self.n_obs = 0
+            owned = value.value
+        self.__dict__[key] = owned
+        if key == '_data' and owned is not value.value and self._contig_index is not None and self._contig_index.is_valid(value.value):
+            self._contig_index = self._contig_index.rebind(owned)
+        return(owned)
+
+    def __getstate__(self) -> Dict:
+        for k, v in list(self.__dict__.items()):
+            if isinstance(v, _LazySlot):
+                self._load(k)
+        state = self.__dict__.copy()
+        for k, v in state.items():
+            if isinstance(v, _Shared):
+                state[k] = v.value
+        state['_contig_index'] = None
+        state['_metadata_snapshot'] = None
+        state['_h5_saved'] = None
+        return(state)
+
+    def __setstate__(self, state: Dict):
+        # objects saved before `.data` and `.metadata` became properties
+        for k in ['data', 'metadata']:
+            if k in state:
+                state['_'+k] = state.pop(k)
+        state.pop('n_obs', None)
+        state.pop('n_contigs', None)
+        state.setdefault('_contig_index', None)
+        state.setdefault('_metadata_init', None)
+        state.setdefault('_metadata_stale', False)
+        state.setdefault('_metadata_snapshot', None)
+        state.setdefault('_versions', {})
+        state.setdefault('_h5_saved', None)
+        state.setdefault('_metadata_fallback', False)
+        state['_handed'] = set()
+        state.setdefault('_metadata_derived', None)
+        self.__dict__.update(state)
 
     def _gen_repr(self, n_obs, n_contigs) -> str:
         # inspire by AnnData's function
         descr = f"Dandelion class object with n_obs = {n_obs} and n_contigs = {n_contigs}"
+        # slots of a lazily read file are not read for the repr
+        lazy = [attr for attr in ["data", "metadata", "distance", "edges", "layout", "graph"]
+                if isinstance(self.__dict__.get('_'+attr), _LazySlot) or (attr == 'metadata' and self._metadata_unread())]
         for attr in ["data", "metadata", "distance", "edges"]:
+            if attr in lazy:
+                descr += f"\n    {attr}: not loaded"
+                continue
             try:
-                keys = getattr(self, attr).keys()
+                keys = self._peek('_'+attr).keys()
             except:
                 keys = []
             if len(keys) > 0:
                 descr += f"\n    {attr}: {str(list(keys))[1:-1]}"
             else:
                 descr += f"\n    {attr}: {str(None)}"
-        if self.layout is not None:
-            descr += f"\n    layout: {', '.join(['layout for '+ str(len(x)) + ' vertices' for x in (self.layout[0], self.layout[1])])}"
+        if 'layout' in lazy:
+            descr += f"\n    layout: not loaded"
+        elif self._peek('_layout') is not None:
+            layout = self._peek('_layout')
+            descr += f"\n    layout: {', '.join(['layout for '+ str(len(x)) + ' vertices' for x in (layout[0], layout[1])])}"
         else:
             descr += f"\n    layout: {str(None)}"
-        if self.graph is not None:
-            descr += f"\n    graph: {', '.join(['networkx graph of '+ str(len(x)) + ' vertices' for x in (self.graph[0], self.graph[1])])} "
+        if 'graph' in lazy:
+            descr += f"\n    graph: not loaded"
+        elif self._peek('_graph') is not None:
+            graph = self._peek('_graph')
+            descr += f"\n    graph: {', '.join(['networkx graph of '+ str(len(x)) + ' vertices' for x in (graph[0], graph[1])])} "
         else:
             descr += f"\n    graph: {str(None)}"
         return descr
 
     def __repr__(self) -> str:
         # inspire by AnnData's function
-        return self._gen_repr(self.n_obs, self.n_contigs)
-
-    def copy(self):
+        return self._gen_repr(self._repr_rows('_metadata', lambda: self.n_obs), self._repr_rows('_data', lambda: self.n_contigs))
+
+    def _metadata_unread(self) -> bool:
+        # whether the metadata still has to be built from contigs that are not read yet
+        return((self.__dict__.get('_metadata') is None or self._metadata_stale) and self._metadata_init is not None and isinstance(self.__dict__.get('_data'), _LazySlot))
+
+    def _repr_rows(self, key: str, count):
+        # number of rows for the repr, without reading slots or building the metadata from contigs that are not read yet
+        value = self.__dict__.get(key)
+        if isinstance(value, _LazySlot):
+            return('not loaded' if value.nrows is None else value.nrows)
+        if key == '_metadata' and self._metadata_unread():
+            return('not loaded')
+        return(count())
+
+    def copy(self, deep: bool = False):
         """
-        Performs a deep copy of all slots in `Dandelion` class.
+        Copies the `Dandelion` class.
+
+        The slots are shared copy-on-write: the copy and the original hold the same tables, matrices and graphs until either of them accesses a slot, at which point that slot is copied for it, unless it is the last one holding it. Slots whose value was returned to a caller before the copy are copied immediately, as references to them may be held outside the object.
 
         Parameters
         ----------
         self : Dandelion
             `Dandelion` object.
+        deep : bool
+            whether to perform an immediate deep copy of all slots instead.
 
         Returns
         -------
-        a deep copy of `Dandelion` class.
+        a copy of `Dandelion` class.
         """
-        return copy.deepcopy(self)
+        if deep:
+            return copy.deepcopy(self)
+        new = self.__class__.__new__(self.__class__)
+        state = self.__dict__.copy()
+        for k in ['_data', '_metadata', '_distance', '_edges', '_layout', '_graph', '_germline']:
+            value = state.get(k)
+            if value is None or isinstance(value, _LazySlot):
+                # both read a lazy slot on their own
+                continue
+            if k in self._handed and not isinstance(value, _Shared):
+                state[k] = _copy_slot(value)
+                continue
+            if not isinstance(value, _Shared):
+                value = _Shared(value)
+                self.__dict__[k] = value
+            value.refs += 1
+            state[k] = value
+        state['_versions'] = dict(self._versions)
+        state['_handed'] = set()
+        if self._h5_saved is not None:
+            state['_h5_saved'] = dict(
+                self._h5_saved, fingerprints=dict(self._h5_saved['fingerprints']))
+        new.__dict__.update(state)
+        return new
 
     def update_germline(self, corrected: Union[None, Dict, str] = None, germline: Union[None, str] = None, org: Literal['human', 'mouse'] = 'human'):
         """
@@ -182,37 +584,36 @@ class Dandelion:
                   deep=('Updated Dandelion object: \n'
                         '   \'germline\', updated germline reference\n'))
 
-    def write_pkl(self, filename: str = 'dandelion_data.pkl.pbz2', **kwargs):
+    def write_pkl(self, filename: str = 'dandelion_data.pkl.pbz2', compression_level: Union[None, int] = None, ncpu: Union[None, int] = None, **kwargs):
         """
         Writes a `Dandelion` class to .pkl format.
 
         Parameters
         ----------
         filename
-            path to `.pkl` file.
+            path to `.pkl` file. Files ending with `.pbz2` or `.gz` are compressed with bz2 or gzip, in independent blocks so that several threads can compress and decompress them. They are therefore not single bz2 or gzip streams and are read back with `read_pkl` rather than `bz2.open` or `gzip.open`.
+        compression_level : {1-9}, optional
+            compression level. Defaults to 9.
+        ncpu : int, optional
+            number of threads to compress with. Defaults to the number of cpus minus one.
         **kwargs
             passed to `_pickle`.
         """
-        if isBZIP(filename):
-            try:
-                with bz2.BZ2File(filename, 'wb') as f:
-                    cPickle.dump(self, f, **kwargs)
-            except:
-                with bz2.BZ2File(filename, 'wb') as f:
-                    cPickle.dump(self, f, protocol=4, **kwargs)
-        elif isGZIP(filename):
-            try:
-                with gzip.open(filename, 'wb') as f:
-                    cPickle.dump(self, f, **kwargs)
-            except:
-                with gzip.open(filename, 'wb') as f:
-                    cPickle.dump(self, f, protocol=4, **kwargs)
-        else:
+        codec = _pkl_codec(filename)
+        if codec is None:
             f = open(filename, 'wb')
             cPickle.dump(self, f, **kwargs)
             f.close()
+            return
+        if compression_level is None:
+            compression_level = 9
+        # from protocol 5 (python 3.8), large arrays are kept out of the pickle stream and compressed without being copied into it
+        kwargs.setdefault('protocol', min(5, pickle.HIGHEST_PROTOCOL))
+        with open(filename, 'wb') as f:
+            _write_pkl_blocks(f, self, codec, compression_level,
+                              _pkl_threads(ncpu), **kwargs)
 
-    def write_h5(self, filename: str = 'dandelion_data.h5', complib: Literal['zlib', 'lzo', 'bzip2', 'blosc', 'blosc:blosclz', 'blosc:lz4', 'blosc:lz4hc', 'blosc:snappy', 'blosc:zlib', 'blosc:zstd'] = None, compression: Literal['zlib', 'lzo', 'bzip2', 'blosc', 'blosc:blosclz', 'blosc:lz4', 'blosc:lz4hc', 'blosc:snappy', 'blosc:zlib', 'blosc:zstd'] = None, compression_level: Union[None, int] = None, **kwargs):
+    def write_h5(self, filename: str = 'dandelion_data.h5', complib: Literal['zlib', 'lzo', 'bzip2', 'blosc', 'blosc:blosclz', 'blosc:lz4', 'blosc:lz4hc', 'blosc:snappy', 'blosc:zlib', 'blosc:zstd'] = None, compression: Literal['zlib', 'lzo', 'bzip2', 'blosc', 'blosc:blosclz', 'blosc:lz4', 'blosc:lz4hc', 'blosc:snappy', 'blosc:zlib', 'blosc:zstd'] = None, compression_level: Union[None, int] = None, mode: Literal['w', 'update', 'append'] = 'w', indexed: bool = False, min_itemsize: Union[None, int, Dict] = None, **kwargs):
         """
         Writes a `Dandelion` class to .h5 format.
 
@@ -226,6 +627,12 @@ class Dandelion:
             same call as complib. Just a convenience option.
         compression_opts : {0-9}, optional
             Specifies a compression level for data. A value of 0 disables compression.
+        mode : str
+            'w' writes a new file. 'update' only rewrites the slots that changed since the object was read from or written to `filename`, and writes a new file otherwise. 'append' adds the contigs and metadata to the tables of an existing file written with `format='table'`, leaving its other slots as they are.
+        indexed : bool
+            whether to write the contigs and metadata as tables with indexed `sample_id`, `cell_id`, `clone_id` and `locus` columns, so that `read_h5(..., cells=..., samples=...)` and `query_h5` only read the matching rows.
+        min_itemsize : int, dict, optional
+            minimum width of the string columns of the tables written with `format='table'`, i.e. the metadata, and the contigs if `indexed=True`, as an int for all columns or a dictionary of column names to widths. The widths are fixed when a table is written, so strings to be appended later with `mode='append'` cannot be longer.
         **kwargs
             passed to `pd.DataFrame.to_hdf`.
         """
@@ -234,11 +641,6 @@ class Dandelion:
         else:
             compression_level = compression_level
 
-        # a little hack to overwrite the existing file?
-        with h5py.File(filename,  "w") as hf:
-            for datasetname in hf.keys():
-                del hf[datasetname]
-
         if complib is None and compression is None:
             comp = None
         elif complib is not None and compression is None:
@@ -249,68 +651,165 @@ class Dandelion:
             raise ValueError(
                 'Please specify only complib or compression. They do the same thing.')
 
-        # now to actually saving
-        for col in self.data.columns:
-            weird = (self.data[[col]].applymap(type) !=
-                     self.data[[col]].iloc[0].apply(type)).any(axis=1)
-            if len(self.data[weird]) > 0:
-                self.data[col] = self.data[col].where(
-                    pd.notnull(self.data[col]), '')
-        self.data.to_hdf(filename, "data", complib=comp,
-                         complevel=compression_level, **kwargs)
+        if mode == 'append':
+            _append_h5(self, filename, comp, compression_level, **kwargs)
+            return
+        elif mode not in ['w', 'update']:
+            raise ValueError(
+                "mode must be one of 'w', 'update' or 'append'.")
+
+        if mode == 'update' and self._h5_saved is not None and self._h5_saved['filename'] == os.path.abspath(filename) and os.path.isfile(filename):
+            slots = [slot for slot in H5_SLOTS if self._changed('_'+slot)]
+            # rewritten tables keep the layout of the file
+            with pd.HDFStore(filename, mode='r') as store:
+                if 'data' in store and store.get_storer('data').is_table and len(store.get_storer('data').data_columns) > 0:
+                    indexed = True
+            with h5py.File(filename,  "a") as hf:
+                for slot in slots + ['threshold']:
+                    if slot in hf:
+                        del hf[slot]
+        else:
+            slots = H5_SLOTS
+            # a little hack to overwrite the existing file?
+            with h5py.File(filename,  "w") as hf:
+                for datasetname in hf.keys():
+                    del hf[datasetname]
+
+        for slot in slots:
+            _write_h5_slot(self, filename, slot, comp,
+                           compression_level, indexed, min_itemsize, **kwargs)
+        if self.threshold is not None:
+            with h5py.File(filename,  "a") as hf:
+                tr = self.threshold
+                hf.create_dataset('threshold', data=tr)
+        self._h5_record(filename)
 
-        if self.metadata is not None:
-            for col in self.metadata.columns:
-                weird = (self.metadata[[col]].applymap(
-                    type) != self.metadata[[col]].iloc[0].apply(type)).any(axis=1)
-                if len(self.metadata[weird]) > 0:
-                    self.metadata[col] = self.metadata[col].where(
-                        pd.notnull(self.metadata[col]), '')
-            self.metadata.to_hdf(filename, "metadata", complib=comp,
-                                 complevel=compression_level, format='table', nan_rep=np.nan, **kwargs)
-        # except:
-        #     warnings.warn("`metadata` slot not saved. Please check if there is incompatible dtypes in the metadata table.")
-        #     pass
-        try:
-            if 'index' in self.edges.columns:
-                self.edges.drop('index', axis=1, inplace=True)
-            self.edges.to_hdf(filename, "edges", complib=comp,
-                              complevel=compression_level, **kwargs)
-        except:
-            pass
+    def write_store(self, dirname: str = 'dandelion_data.ddl'):
+        """
+        Writes a `Dandelion` class to a columnar store directory.
 
-        graph_counter = 0
-        try:
-            for g in self.graph:
-                G = nx.to_pandas_adjacency(g, nonedge=np.nan)
-                G.to_hdf(filename, "graph/graph_"+str(graph_counter),
-                         complib=comp, complevel=compression_level, **kwargs)
-                graph_counter += 1
-        except:
-            pass
+        Each column, distance matrix, graph and layout is written to its own binary array file, described by a `manifest.json`. `read_store` memory-maps these files, so that opening a store is fast, columns are only paged in when used and several processes can share the pages.
 
+        Parameters
+        ----------
+        dirname
+            path to the store directory. An existing store at this path is overwritten.
+        """
+        if os.path.exists(dirname):
+            if os.path.isfile(os.path.join(dirname, 'manifest.json')):
+                shutil.rmtree(dirname)
+            elif not os.path.isdir(dirname) or len(os.listdir(dirname)) > 0:
+                raise ValueError(
+                    '{} exists and is not a dandelion store.'.format(dirname))
+        os.makedirs(dirname, exist_ok=True)
+        manifest = {'format': 'dandelion-store', 'version': STORE_VERSION,
+                    'threshold': None if self.threshold is None else float(self.threshold), 'slots': {}}
+        for slot in H5_SLOTS:
+            entry = _write_store_slot(self, dirname, slot)
+            if entry is not None:
+                manifest['slots'][slot] = entry
+        # the manifest is written last, so an interrupted write is not read as a store
+        with open(os.path.join(dirname, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+
+
+# slots written by `Dandelion.write_h5`
+H5_SLOTS = ['data', 'metadata', 'distance',
+            'edges', 'layout', 'graph', 'germline']
+
+# columns written as indexed data columns by `Dandelion.write_h5(..., indexed=True)`
+H5_INDEXED = ['sample_id', 'cell_id', 'clone_id', 'locus']
+
+
+def _h5_compression(compression_level: int) -> Dict:
+    # distances and graphs are written with h5py, which only has gzip built in. Like the tables written by pandas, they are compressed unless the level is 0
+    if compression_level == 0:
+        return({})
+    return({'compression': 'gzip', 'compression_opts': compression_level})
+
+
+def _write_h5_slot(self: Dandelion, filename: str, slot: str, comp: Union[None, str] = None, compression_level: int = 9, indexed: bool = False, min_itemsize: Union[None, int, Dict] = None, **kwargs):
+    # writes a single slot to a `.h5` file, in the layout read by `read_h5`
+    h5_comp = _h5_compression(compression_level)
+    # the slots are only read, so they are neither handed out nor counted as changed
+    if slot == 'metadata':
+        self._refresh_metadata()
+    value = self._peek('_'+slot)
+    if slot in ['data', 'metadata']:
+        table = value
+        if table is None:
+            return
+        # categorical and nullable boolean columns are written as plain columns and restored by `read_h5`
+        table, dtypes = _plain_dtypes(table)
+        if slot == 'data':
+            table = _h5_dtypes(table)
+            options = kwargs
+        else:
+            # the metadata columns are derived, so their types are inferred
+            table = _h5_dtypes(table, schema={})
+            options = dict(kwargs, format='table', nan_rep=np.nan)
+        if min_itemsize is not None and (indexed or options.get('format') in ['table', 't']):
+            options = dict(options, min_itemsize=min_itemsize)
+        if indexed:
+            columns = [c for c in H5_INDEXED if c in table]
+            with pd.HDFStore(filename, mode='a', complib=comp, complevel=compression_level) as store:
+                # chunks are sized for the expected number of rows
+                store.append(slot, table, **dict(options, format='table', data_columns=columns,
+                                                 index=False, expectedrows=max(table.shape[0], 1)))
+                store.create_table_index(
+                    slot, columns=['index'] + columns, optlevel=9, kind='full')
+        else:
+            table.to_hdf(filename, slot, complib=comp,
+                         complevel=compression_level, **options)
+        if len(dtypes) > 0:
+            with h5py.File(filename,  "a") as hf:
+                hf[slot].attrs['compact_dtypes'] = json.dumps(dtypes)
+
+    elif slot == 'edges':
         try:
-            for d in self.distance:
-                # how to make this faster?
-                dat = pd.DataFrame(self.distance[d].toarray())
-                dat.to_hdf(filename, "distance/"+d, complib=comp,
-                           complevel=compression_level, **kwargs)
+            # the column is only dropped from what is written
+            edges = value.drop('index', axis=1) if 'index' in value.columns else value
+            edges.to_hdf(filename, "edges", complib=comp,
+                         complevel=compression_level, **kwargs)
         except:
             pass
 
+    elif slot == 'distance':
+        if value is not None:
+            with h5py.File(filename,  "a") as hf:
+                for d in value:
+                    dist = scipy.sparse.csr_matrix(value[d])
+                    group = hf.create_group('distance/'+str(d))
+                    for k in ['data', 'indices', 'indptr']:
+                        _write_array(group, k, getattr(dist, k), **h5_comp)
+                    group.attrs['shape'] = dist.shape
+
+    elif slot == 'graph':
+        if value is not None:
+            with h5py.File(filename,  "a") as hf:
+                for graph_counter, g in enumerate(value):
+                    nodes = list(g.nodes())
+                    codes = {n: i for i, n in enumerate(nodes)}
+                    edges = list(g.edges(data='weight'))
+                    group = hf.create_group('graph/graph_'+str(graph_counter))
+                    group.attrs.update(_graph_attrs(g))
+                    # fixed width strings, as variable length strings are not compressed
+                    names = [str(n).encode('utf-8') for n in nodes]
+                    _write_array(group, 'nodes', np.array(names, dtype=h5py.string_dtype(
+                        'utf-8', max([len(n) for n in names] + [1]))), **h5_comp)
+                    _write_array(group, 'source', np.array(
+                        [codes[u] for u, v, w in edges], dtype=np.int64), **h5_comp)
+                    _write_array(group, 'target', np.array(
+                        [codes[v] for u, v, w in edges], dtype=np.int64), **h5_comp)
+                    # edges without a weight are stored as nan
+                    _write_array(group, 'weight', np.array(
+                        [np.nan if w is None else w for u, v, w in edges], dtype=np.float64), **h5_comp)
+
+    elif slot == 'layout':
         with h5py.File(filename,  "a") as hf:
-            # try:
-            #     for d in self.distance:
-            #         hf.create_dataset('distance/'+d+'/data', data=self.distance[d].data, compression = compression, compression_opts = compression_level)
-            #         hf.create_dataset('distance/'+d+'/indptr', data=self.distance[d].indptr, compression = compression, compression_opts = compression_level)
-            #         hf.create_dataset('distance/'+d+'/indices', data=self.distance[d].indices, compression = compression, compression_opts = compression_level)
-            #         hf['distance/'+d].attrs['shape'] = self.distance[d].shape
-            # except:
-            #     pass
-
             try:
                 layout_counter = 0
-                for l in self.layout:
+                for l in value:
                     try:
                         hf.create_group('layout/layout_'+str(layout_counter))
                     except:
@@ -322,22 +821,365 @@ class Dandelion:
             except:
                 pass
 
-            if len(self.germline) > 0:
+    elif slot == 'germline':
+        if value is not None and len(value) > 0:
+            with h5py.File(filename,  "a") as hf:
                 try:
                     hf.create_group('germline')
                 except:
                     pass
-                for k in self.germline.keys():
-                    hf['germline'].attrs[k] = self.germline[k]
-            if self.threshold is not None:
-                tr = self.threshold
-                hf.create_dataset('threshold', data=tr)
+                for k in value.keys():
+                    hf['germline'].attrs[k] = value[k]
+
+
+def _append_h5(self: Dandelion, filename: str, comp: Union[None, str] = None, compression_level: int = 9, **kwargs):
+    # appends the contigs and metadata to the tables of an existing `.h5` file
+    with pd.HDFStore(filename, mode='r') as store:
+        if 'data' not in store or not store.get_storer('data').is_table:
+            raise ValueError(
+                "Cannot append to {}: its contigs were not written with format='table'.".format(filename))
+        stored = store.select_column('data', 'index')
+        has_metadata = 'metadata' in store
+        if has_metadata:
+            stored_cells = store.select_column('metadata', 'index')
+        data_columns = {k: store.get_storer(k).data_columns for k in [
+            'data', 'metadata'] if k in store}
+    if stored.isin(self.data.index).any():
+        raise ValueError(
+            'Cannot append to {}: some sequence_ids are already stored.'.format(filename))
+    if has_metadata and self.metadata is not None and stored_cells.isin(self.metadata.index).any():
+        raise ValueError(
+            'Cannot append to {}: some cells are already stored.'.format(filename))
+
+    tables = [('data', self.data, None)]
+    if has_metadata and self.metadata is not None:
+        tables.append(('metadata', self.metadata, {}))
+    prepared = []
+    for key, table, schema in tables:
+        table, dtypes = _plain_dtypes(table)
+        prepared.append((key, _h5_dtypes(table, schema), dtypes))
+    # the columns are fixed by the first write, so they are checked before anything is appended
+    with pd.HDFStore(filename, mode='r') as store:
+        for i, (key, table, dtypes) in enumerate(prepared):
+            table, too_long, mismatched = _h5_match(
+                store.get_storer(key), table)
+            if len(too_long) > 0:
+                raise ValueError("Cannot append to {}: strings in {} of `{}` are longer than the stored columns allow. Please write the file with `write_h5(..., min_itemsize=...)` wide enough for the strings to be appended.".format(
+                    filename, ', '.join(too_long), key))
+            if len(mismatched) > 0:
+                raise ValueError("Cannot append to {}: {} of `{}` cannot be stored as the types of the stored columns.".format(
+                    filename, ', '.join(mismatched), key))
+            prepared[i] = (key, table, dtypes)
+    for key, table, dtypes in prepared:
+        options = dict(kwargs, format='table', append=True,
+                       data_columns=data_columns[key])
+        if key == 'metadata':
+            options['nan_rep'] = np.nan
+        table.to_hdf(filename, key, complib=comp,
+                     complevel=compression_level, **options)
+        with h5py.File(filename,  "a") as hf:
+            if 'compact_dtypes' in hf[key].attrs:
+                dtypes = dict(json.loads(
+                    hf[key].attrs['compact_dtypes']), **dtypes)
+            if len(dtypes) > 0:
+                hf[key].attrs['compact_dtypes'] = json.dumps(dtypes)
+
+
+def _h5_match(storer, table: pd.DataFrame) -> Tuple[pd.DataFrame, Sequence, Sequence]:
+    # casts the numeric columns of `table` to the columns of a stored table, returning the columns with strings that are too long and with values of another kind
+    widths, kinds = {}, {}
+    for axis in storer.index_axes:
+        if axis.kind == 'string':
+            widths['index'] = axis.itemsize
+    for axis in storer.values_axes:
+        for col in axis.values:
+            if axis.kind == 'string':
+                widths[col] = axis.itemsize
+            else:
+                kinds[col] = axis.dtype
+    too_long, mismatched = [], []
+    for col, width in widths.items():
+        values = pd.Series(table.index) if col == 'index' else table.get(col)
+        if values is None or values.dtype != object:
+            continue
+        lengths = values.dropna().map(lambda x: len(str(x).encode('utf-8')))
+        if len(lengths) > 0 and lengths.max() > width:
+            too_long.append(col)
+    table = table.copy()
+    for col, dtype in kinds.items():
+        if col not in table or table[col].dtype == dtype:
+            continue
+        try:
+            values = table[col].astype(dtype)
+        except (TypeError, ValueError):
+            values = None
+        if values is None or not (values == table[col]).all():
+            mismatched.append(col)
+        else:
+            table[col] = values
+    # copying consolidates the cast columns into the blocks that pandas matches against the stored table
+    return(table.copy(), too_long, mismatched)
+
+
+def _graph_attrs(G: nx.Graph) -> Dict:
+    # graph attributes that can be stored in `.h5` attributes and the store manifest, e.g. those recorded by `generate_network`
+    return({k: v.item() if isinstance(v, np.generic) else v for k, v in G.graph.items() if isinstance(v, (str, int, float, bool, np.generic))})
+
+
+def _write_array(group: h5py.Group, key: str, values: np.ndarray, **kwargs):
+    # empty datasets cannot be chunked for compression
+    if len(values) == 0:
+        kwargs = {}
+    group.create_dataset(key, data=values, **kwargs)
+
+
+# compressed `.pkl` files written by `Dandelion.write_pkl` are a sequence of independently compressed blocks, followed by an index of the blocks, its length and `PKL_MAGIC` again
+PKL_MAGIC = b'DDLPKL\x00\x01'
+PKL_BLOCK_SIZE = 1 << 24
+
+
+def _pkl_codec(filename: str) -> Union[None, str]:
+    if isBZIP(filename):
+        return('bz2')
+    if isGZIP(filename):
+        return('gzip')
+    return(None)
+
+
+def _pkl_threads(ncpu: Union[None, int] = None) -> int:
+    # bz2 and zlib release the GIL, so blocks are compressed in threads
+    if ncpu is None:
+        return(max(multiprocessing.cpu_count() - 1, 1))
+    return(max(int(ncpu), 1))
+
+
+class _PklBlockSink:
+    """
+    File-like object that a pickle is dumped into, which cuts what is written to it into blocks of `PKL_BLOCK_SIZE`, compresses them in a thread pool and writes them to `f` in order.
+
+    Only a few blocks per thread are held in memory at a time. Out-of-band buffers are added with `write_segment` after the pickle stream.
+    """
+
+    def __init__(self, f, pool: ThreadPoolExecutor, compress: Callable, ncpu: int):
+        self.f = f
+        self.pool = pool
+        self.compress = compress
+        self.ncpu = ncpu
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.segments = [0]
+        self.blocks = []
+
+    def write(self, data) -> int:
+        self.buffer += data
+        while len(self.buffer) >= PKL_BLOCK_SIZE:
+            self._submit(bytes(self.buffer[:PKL_BLOCK_SIZE]))
+            del self.buffer[:PKL_BLOCK_SIZE]
+        return(memoryview(data).nbytes)
+
+    def write_segment(self, data: memoryview):
+        # buffers are compressed in place, without being copied into blocks first
+        self._cut()
+        self.segments.append(0)
+        for start in range(0, len(data), PKL_BLOCK_SIZE):
+            self._submit(data[start:start + PKL_BLOCK_SIZE])
+
+    def close(self):
+        self._cut()
+        while len(self.pending) > 0:
+            self._flush()
+
+    def _cut(self):
+        if len(self.buffer) > 0:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def _submit(self, block):
+        self.pending.append(([len(self.segments) - 1, self.segments[-1], len(block)],
+                             self.pool.submit(self.compress, block)))
+        self.segments[-1] += len(block)
+        # at most a couple of compressed blocks per thread are held in memory
+        while len(self.pending) > 2 * self.ncpu:
+            self._flush()
+
+    def _flush(self):
+        block, result = self.pending.popleft()
+        self.blocks.append(block + [self.f.write(result.result())])
+
+
+def _write_pkl_blocks(f, obj, codec: str, compression_level: int, ncpu: int, **kwargs):
+    # pickles obj straight into compressed blocks, followed by its out-of-band buffers if the protocol is at least 5
+    if codec == 'bz2':
+        compress = functools.partial(
+            bz2.compress, compresslevel=compression_level)
+    else:
+        compress = functools.partial(
+            gzip.compress, compresslevel=compression_level, mtime=0)
+    buffers = []
+    if kwargs.get('protocol', pickle.DEFAULT_PROTOCOL) >= 5:
+        kwargs['buffer_callback'] = buffers.append
+    f.write(PKL_MAGIC)
+    with ThreadPoolExecutor(ncpu) as pool:
+        sink = _PklBlockSink(f, pool, compress, ncpu)
+        cPickle.dump(obj, sink, **kwargs)
+        for b in buffers:
+            sink.write_segment(b.raw())
+        sink.close()
+    footer = json.dumps({'codec': codec, 'segments': sink.segments,
+                        'blocks': sink.blocks}).encode()
+    f.write(footer)
+    f.write(len(footer).to_bytes(8, 'little'))
+    f.write(PKL_MAGIC)
+
+
+# version of the layout written by `Dandelion.write_store`
+STORE_VERSION = 1
+
+
+def _write_store_slot(self: Dandelion, dirname: str, slot: str) -> Union[None, Dict]:
+    # writes a single slot to a store directory and returns its manifest entry, None if there is nothing to write
+    if slot in ['data', 'metadata', 'edges']:
+        table = getattr(self, slot)
+        if not isinstance(table, pd.DataFrame):
+            return(None)
+        if slot == 'edges' and 'index' in table.columns:
+            table = table.drop('index', axis=1)
+        return(_write_store_table(dirname, slot, table))
+
+    if slot == 'distance':
+        if self.distance is None or len(self.distance) == 0:
+            return(None)
+        matrices = []
+        for i, d in enumerate(self.distance):
+            dist = scipy.sparse.csr_matrix(self.distance[d])
+            entry = {'name': d, 'shape': list(dist.shape)}
+            for k in ['data', 'indices', 'indptr']:
+                entry[k] = _write_store_array(
+                    dirname, slot+'/'+str(i)+'.'+k, getattr(dist, k))
+            matrices.append(entry)
+        return({'matrices': matrices})
+
+    if slot == 'graph':
+        if self.graph is None:
+            return(None)
+        graphs = []
+        for i, g in enumerate(self.graph):
+            nodes = list(g.nodes())
+            codes = {n: j for j, n in enumerate(nodes)}
+            edges = list(g.edges(data='weight'))
+            path = slot+'/'+str(i)
+            graphs.append({
+                'nodes': _write_store_column(dirname, path+'.nodes', pd.Series([str(n) for n in nodes], dtype=object)),
+                'source': _write_store_array(dirname, path+'.source', np.array([codes[u] for u, v, w in edges], dtype=np.int64)),
+                'target': _write_store_array(dirname, path+'.target', np.array([codes[v] for u, v, w in edges], dtype=np.int64)),
+                # edges without a weight are stored as nan
+                'weight': _write_store_array(dirname, path+'.weight', np.array([np.nan if w is None else w for u, v, w in edges], dtype=np.float64)),
+                'attrs': _graph_attrs(g)})
+        return({'graphs': graphs})
+
+    if slot == 'layout':
+        if self.layout is None:
+            return(None)
+        layouts = []
+        for i, l in enumerate(self.layout):
+            nodes = list(l.keys())
+            path = slot+'/'+str(i)
+            coords = np.array([l[n] for n in nodes], dtype=np.float64)
+            if len(nodes) == 0:
+                coords = np.zeros((0, 2))
+            layouts.append({
+                'nodes': _write_store_column(dirname, path+'.nodes', pd.Series([str(n) for n in nodes], dtype=object)),
+                'coords': _write_store_array(dirname, path+'.coords', coords)})
+        return({'layouts': layouts})
+
+    if slot == 'germline':
+        if self.germline is None or len(self.germline) == 0:
+            return(None)
+        return({'names': _write_store_column(dirname, slot+'/names', pd.Series(list(self.germline.keys()), dtype=object)),
+                'sequences': _write_store_column(dirname, slot+'/sequences', pd.Series(list(self.germline.values()), dtype=object))})
+
+
+def _write_store_table(dirname: str, slot: str, table: pd.DataFrame) -> Dict:
+    # one set of files per column, named by position so that any column name can be stored
+    return({'nrows': table.shape[0],
+            'index': _write_store_column(dirname, slot+'/index', table.index.to_series()),
+            'columns': [_write_store_column(dirname, slot+'/'+str(i), table.iloc[:, i]) for i in range(table.shape[1])]})
+
+
+def _write_store_column(dirname: str, path: str, values: pd.Series) -> Dict:
+    # writes a column in the encoding read by `_read_store_column` and returns its manifest entry
+    name = values.name
+    entry = {'name': name.item() if isinstance(name, np.generic) else name}
+    dtype = values.dtype
+    if is_categorical(values):
+        entry.update({'encoding': 'category', 'ordered': bool(dtype.ordered),
+                      'codes': _write_store_array(dirname, path+'.codes', values.cat.codes.values),
+                      'categories': _write_store_column(dirname, path+'.categories', dtype.categories.to_series())})
+    elif isinstance(values.array, pd.core.arrays.masked.BaseMaskedArray):
+        # nullable integer, float and boolean columns
+        entry.update({'encoding': 'masked', 'dtype': dtype.name,
+                      'values': _write_store_array(dirname, path+'.values', values.array._data),
+                      'mask': _write_store_array(dirname, path+'.mask', values.array._mask)})
+    elif isinstance(dtype, np.dtype) and dtype.kind in 'biufcmM':
+        entry.update({'encoding': 'array', 'values': _write_store_array(
+            dirname, path+'.values', values.values)})
+    elif pd.api.types.infer_dtype(values, skipna=True) in ['string', 'empty']:
+        # utf-8 bytes of all strings and the offset of each string, with missing values as empty strings
+        missing = values.isna().values
+        encoded = [b'' if m else v.encode('utf-8')
+                   for v, m in zip(values.values, missing)]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(v) for v in encoded])
+        blob = b''.join(encoded)
+        os.makedirs(os.path.dirname(os.path.join(dirname, path)), exist_ok=True)
+        with open(os.path.join(dirname, path+'.bytes'), 'wb') as f:
+            f.write(blob)
+        entry.update({'encoding': 'string', 'bytes': path+'.bytes', 'ascii': blob.isascii(),
+                      'offsets': _write_store_array(dirname, path+'.offsets', offsets),
+                      'mask': _write_store_array(dirname, path+'.mask', missing)})
+    else:
+        kinds = [_store_kind(v) for v in values.values]
+        if all(k is not None for k in kinds):
+            # numbers, booleans and strings mixed in one column, as strings and the type of each value
+            text = pd.Series([np.nan if k == 0 else str(v) for v, k in zip(
+                values.values, kinds)], dtype=object)
+            entry.update({'encoding': 'mixed', 'text': _write_store_column(dirname, path+'.text', text),
+                          'kinds': _write_store_array(dirname, path+'.kinds', np.array(kinds, dtype=np.int8))})
+        else:
+            # other python objects can only be pickled, and are only read by `read_store(..., allow_pickle=True)`
+            entry.update({'encoding': 'object', 'values': _write_store_array(
+                dirname, path+'.values', values.values.astype(object))})
+    return(entry)
+
+
+def _store_kind(value) -> Union[None, int]:
+    # type of a value in a column of mixed types: 0 missing, 1 string, 2 integer, 3 float, 4 boolean, None for other objects
+    if isinstance(value, (bool, np.bool_)):
+        return(4)
+    if isinstance(value, (int, np.integer)):
+        return(2)
+    if isinstance(value, (float, np.floating)):
+        return(0 if np.isnan(value) else 3)
+    if isinstance(value, str):
+        return(1)
+    if value is None or value is pd.NA:
+        return(0)
+    return(None)
+
+
+def _write_store_array(dirname: str, path: str, values: np.ndarray) -> str:
+    os.makedirs(os.path.dirname(os.path.join(dirname, path)), exist_ok=True)
+    np.save(os.path.join(dirname, path+'.npy'),
+            np.ascontiguousarray(values), allow_pickle=values.dtype == object)
+    return(path+'.npy')
 
 
 def concat(arrays: Sequence[Union[pd.DataFrame, Dandelion]], check_unique: bool = True) -> Dandelion:
     """
     Concatenate dataframe and return as `Dandelion` object.
 
+    If all arrays are `Dandelion` objects with metadata of the same columns and no cell is in more than one of them, their metadata are concatenated rather than computed again, and only the clone size ranks (`clone_id_by_size`), which depend on all cells, are recomputed.
+
     Parameters
     ----------
     arrays : Sequence
@@ -356,6 +1198,8 @@ def concat(arrays: Sequence[Union[pd.DataFrame, Dandelion]], check_unique: bool
     except:
         arrays_ = [x.copy() for x in arrays]
 
+    _union_categories(arrays_)
+
     if check_unique:
         try:
             df = pd.concat(arrays_, verify_integrity=True)
@@ -363,466 +1207,437 @@ def concat(arrays: Sequence[Union[pd.DataFrame, Dandelion]], check_unique: bool
             for i in range(0, len(arrays)):
                 arrays_[i]['sequence_id'] = [x + '__' +
                                              str(i) for x in arrays_[i]['sequence_id']]
+            from ..utilities._io import load_data
             arrays_ = [load_data(x) for x in arrays_]
             df = pd.concat(arrays_, verify_integrity=True)
     else:
         df = pd.concat(arrays_)
+    out = _try_initialize(data=df)
+
+    if out._metadata_init is not None and all(isinstance(x, Dandelion) for x in arrays):
+        metadata = _merge_metadata([x.metadata for x in arrays])
+        if metadata is not None:
+            # set directly, so that the metadata is still updated when `.data` changes
+            out._metadata = metadata
+            out._touch('_metadata')
+            derived = [x._metadata_derived for x in arrays]
+            if all(d == derived[0] for d in derived):
+                out._metadata_derived = derived[0]
+    return(out)
+
+
+def _try_initialize(**kwargs) -> Dandelion:
+    """
+    `Dandelion(**kwargs)`, or `Dandelion(**kwargs, initialize=False)` if the metadata cannot be computed.
+
+    The metadata is computed on first access, so errors computing it are caught there, leaving the metadata empty.
+    """
     try:
-        out = Dandelion(df)
+        out = Dandelion(**kwargs)
     except:
-        out = Dandelion(df, initialize=False)
+        return(Dandelion(**kwargs, initialize=False))
+    out._metadata_fallback = True
     return(out)
 
 
-def retrieve_metadata(data: pd.DataFrame, query: str, split: bool = True, collapse: bool = True, combine: bool = False, locus: Literal['ig'] = 'ig', split_locus: bool = False, verbose: bool = False) -> pd.DataFrame:
-    data_tmp = data.copy()
-    dat_dict = defaultdict(dict)
-    dict_ = defaultdict(dict)
-    metadata_ = defaultdict(dict)
-
-    locus_dict1 = {'ig': 'IGH'}
-    locus_dict2 = {'ig': ['IGK', 'IGL']}
-    locus_dict3 = {'ig': 'H'}
-    locus_dict4 = {'ig': 'L'}
-    query_dict = dict(zip(data_tmp['sequence_id'], data_tmp[query]))
+def _union_categories(frames: Sequence[pd.DataFrame]):
+    # categorical columns stay categorical only if they share their categories
+    for col in frames[0].columns:
+        if all((col in x) and is_categorical(x[col]) for x in frames):
+            categories = pd.api.types.union_categoricals(
+                [x[col].values for x in frames]).categories
+            for x in frames:
+                x[col] = x[col].cat.set_categories(categories)
+
+
+def _merge_metadata(metas: Sequence[pd.DataFrame]) -> Union[None, pd.DataFrame]:
+    # metadata of disjoint sets of cells in a single concatenation, None if they cannot be merged
+    if any(m is None for m in metas):
+        return(None)
+    columns = list(metas[0].columns)
+    if any(set(m.columns) != set(columns) or m.columns.duplicated().any() for m in metas):
+        return(None)
+    metas = [m[columns].copy() for m in metas]
+    _union_categories(metas)
+    metadata = pd.concat(metas)
+    if not metadata.index.is_unique:
+        return(None)
+    # clone sizes are counted over all cells
+    for col in columns:
+        if isinstance(col, str) and col.endswith('_by_size') and col[:-len('_by_size')] in metadata:
+            metadata[col] = _clone_size_rank(metadata[col[:-len('_by_size')]])
+    return(metadata)
+
+
+def retrieve_metadata(data: Union[pd.DataFrame, Dandelion], query: Union[str, Sequence], split: bool = True, collapse: bool = True, combine: bool = False, locus: Literal['ig'] = 'ig', split_locus: bool = False, verbose: bool = False) -> pd.DataFrame:
+    """
+    Retrieves columns of the AIRR table for each cell with a heavy chain contig.
 
-    if type_check(data, query):
-        data_tmp[query].fillna('unassigned', inplace=True)
+    Contigs are grouped by cell and locus once and all columns in `query` are retrieved in the same pass.
 
-    typesoflocus = len(list(set(data_tmp['locus'])))
+    Parameters
+    ----------
+    data : DataFrame, Dandelion
+        AIRR table or `Dandelion` object. The contig index of a `Dandelion` object is reused.
+    query : str, sequence
+        column name(s) in `data` to retrieve.
+    split : bool
+        returns the retrieval splitted into one column for heavy and one for light chains if True.
+    collapse : bool
+        returns the retrieval as a collapsed entry where each entry is separated by a '|' if True.
+    combine : bool
+        returns the collapsed entry with only unique entries if True.
+    locus : str
+        mode for retrieval. Currently only accepts 'ig'.
+    split_locus : bool
+        returns the retrieval splitted into one column for each locus (e.g. IGH, IGK, IGL) if True.
+    verbose : bool
+        whether or not to print warning messages.
 
-    if typesoflocus > 1:
-        if split_locus:
-            for loci in flatten([locus_dict1[locus]] + locus_dict2[locus]):
-                tmp = data_tmp[data_tmp['locus'].isin([loci])].copy()
-                if tmp.shape[0] > 0:
-                    dat_dict[loci] = tmp.copy()
-        else:
-            tmp3 = data_tmp[data_tmp['locus'].isin(
-                [locus_dict1[locus]])].copy()
-            tmp4 = data_tmp[data_tmp['locus'].isin(locus_dict2[locus])].copy()
-            if tmp3.shape[0] > 0:
-                dat_dict[locus_dict3[locus]] = tmp3.copy()
-            if tmp4.shape[0] > 0:
-                dat_dict[locus_dict4[locus]] = tmp4.copy()
-    else:
-        if verbose:
-            warnings.warn(UserWarning(
-                'Single locus type detected. Ignoring split = True and split_locus = True.'))
-        dat_dict[locus_dict3[locus]] = data_tmp[data_tmp['locus'].isin(
-            [locus_dict1[locus]])].copy()
-
-    for d in dat_dict:
-        tmp = Tree()
-        for cell, seq in zip(dat_dict[d]['cell_id'], dat_dict[d]['sequence_id']):
-            tmp[cell][seq].value = 1
-        cells = []
-        seqs = []
-        for t in tmp:
-            cells.append(t)
-            seqs.append([s for s in tmp[t]])
-        metadata_[d] = pd.DataFrame(seqs, index=cells)
-        metadata_[d][pd.isnull(metadata_[d])] = np.nan
-
-    if split_locus:
-        H = locus_dict1[locus]
+    Returns
+    -------
+    `pandas` dataframe with the retrieved columns, indexed by cell_id.
+    """
+    if type(query) is str:
+        query = [query]
+    if data.__class__ == Dandelion:
+        contigs, cells = data.contig_index.chains(locus, split_locus)
+        data = data.data
     else:
-        H = locus_dict3[locus]
+        contigs, cells = _locus_contigs(data, locus, split_locus)
+    if verbose and len(contigs) == 1:
+        warnings.warn(UserWarning(
+            'Single locus type detected. Ignoring split = True and split_locus = True.'))
+    values = _query_values(data, query)
+    results = [_retrieve_query(values[q], q, contigs, cells, split,
+                               collapse, combine, split_locus, verbose) for q in query]
+    return(pd.concat(results, axis=1))
 
-    if len(metadata_[H].columns) > 1:
-        metadata_[H].columns = ['sequence_id_'+H+'_' +
-                                str(x) for x in range(0, len(metadata_[H].columns))]
-    else:
-        metadata_[H].columns = ['sequence_id_'+H+'_0']
-
-    if typesoflocus > 1:
-        if split_locus:
-            for L in locus_dict2[locus]:
-                if len(metadata_[L].columns) > 1:
-                    metadata_[L].columns = ['sequence_id_'+L+'_' +
-                                            str(x) for x in range(0, len(metadata_[L].columns))]
-                else:
-                    metadata_[L].columns = ['sequence_id_'+L+'_0']
-        else:
-            L = locus_dict4[locus]
-            if len(metadata_[L].columns) > 1:
-                metadata_[L].columns = ['sequence_id_'+L+'_' +
-                                        str(x) for x in range(0, len(metadata_[L].columns))]
-            else:
-                metadata_[L].columns = ['sequence_id_'+L+'_0']
-
-    metadata_result = metadata_.copy()
-    for l in metadata_:
-        for x in metadata_[l]:
-            metadata_result[l][x] = [query_dict[i] if i ==
-                                     i else np.nan for i in metadata_[l][x]]
-
-    if typesoflocus > 1:
-        if not split_locus:
-            results = retrieve_result_dict(
-                query, data_tmp, metadata_result[locus_dict3[locus]], metadata_result[locus_dict4[locus]], locus, split, collapse, combine)
-        else:
-            results = retrieve_result_dict(query, data_tmp, metadata_result[locus_dict1[locus]], [
-                                           metadata_result[L] for L in locus_dict2[locus]], locus, split, collapse, combine)
+
+def _contig_codes(data: pd.DataFrame, mask: np.ndarray, cells: Union[None, pd.Index] = None) -> Tuple[np.ndarray, np.ndarray, pd.Index]:
+    """
+    Integer codes for the cells of the selected contigs and the position of each contig within its cell, both in order of appearance.
+
+    Parameters
+    ----------
+    data : DataFrame
+        AIRR table.
+    mask : np.ndarray
+        selected contigs.
+    cells : pd.Index, optional
+        cells to code the contigs against. Contigs of other cells get a code of -1. If None, the cells of the selected contigs are used.
+
+    Returns
+    -------
+    row numbers, cell codes and positions of the selected contigs, and the cells.
+    """
+    rows = np.flatnonzero(mask)
+    # the first contig of a sequence_id decides its position, as in a dictionary keyed by cell and sequence_id
+    first = ~pd.DataFrame({'cell_id': data['cell_id'].values[rows],
+                           'sequence_id': data['sequence_id'].values[rows]}).duplicated().values
+    rows = rows[first]
+    if cells is None:
+        codes, cells = pd.factorize(data['cell_id'].values[rows])
+        cells = pd.Index(np.asarray(cells))
     else:
-        results = retrieve_result_dict_singular(
-            query, data_tmp, metadata_result[locus_dict3[locus]], locus, collapse, combine)
-    return(results)
+        codes = cells.get_indexer(data['cell_id'].values[rows])
+    positions = pd.Series(codes).groupby(codes).cumcount().values
+    return(rows, codes, positions, cells)
 
 
-def retrieve_result_dict(query: str, data: pd.DataFrame, meta_h: pd.DataFrame, meta_l: pd.DataFrame, locus: Literal['ig'] = 'ig', split: bool = True, collapse: bool = True, combine: bool = False, verbose: bool = False) -> Dict:
-    df_hl = defaultdict(dict)
+def _join_tokens(codes: np.ndarray, tokens: np.ndarray, n: int) -> np.ndarray:
+    """
+    Joins the tokens of each code with '|'. Codes must be grouped together and codes without tokens get ''.
+    """
+    out = np.full(n, '', dtype=object)
+    if len(codes) > 0:
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        joined = np.add.reduceat(np.array(['|'], dtype=object) + tokens, starts)
+        out[codes[starts]] = [j[1:] for j in joined]
+    return(out)
+
+
+def _map_unique(values: pd.Series, func) -> pd.Series:
+    """
+    Applies a function once per unique value.
+    """
+    uniq = pd.unique(values)
+    return(values.map(dict(zip(uniq, [func(u) for u in uniq]))))
+
+
+
+def _locus_contigs(data: pd.DataFrame, locus: Literal['ig'] = 'ig', split_locus: bool = False) -> Tuple[Dict, pd.Index]:
+    """
+    Codes the contigs of each chain against the cells with a heavy chain contig.
+
+    Parameters
+    ----------
+    data : DataFrame
+        AIRR table.
+    locus : str
+        mode for retrieval. Currently only accepts 'ig'.
+    split_locus : bool
+        whether to keep each light chain locus separate.
+
+    Returns
+    -------
+    dictionary of row numbers, cell codes, positions and number of positions of the contigs of each chain, and the cells.
+    """
     locus_dict1 = {'ig': 'IGH'}
     locus_dict2 = {'ig': ['IGK', 'IGL']}
-    locus_dict3 = {'ig': 'H'}
-    locus_dict4 = {'ig': 'L'}
-    if len(meta_l) == 2 and type(meta_l) is list:
-        H = locus_dict1[locus]
-    else:
-        H = locus_dict3[locus]
-    if meta_h.shape[1] > 1:
-        if collapse:
-            newmeta_h = meta_h.copy()
-            if type_check(meta_h, 'sequence_id_'+H+'_0'):
-                newh = []
-                for i in meta_h.index:
-                    try:
-                        newh.append(
-                            '|'.join([h for h in list(dict.fromkeys(newmeta_h.loc[i])) if h == h]))
-                    except:
-                        newh.append('|'.join([str(h) for h in list(
-                            dict.fromkeys(newmeta_h.loc[i])) if h == h]))
-                newmeta_h['sequence_id_'+H+'_0'] = newh
-                meta_h = pd.DataFrame(newmeta_h['sequence_id_'+H+'_0'].copy())
-            else:
-                collapse = False
-                if verbose:
-                    warnings.warn(UserWarning(
-                        'Multiple heavy chain contigs mapping to the same cell barcode and/or query dtype is {}. Ignoring collapse = True.'.format(meta_h['sequence_id_'+H+'_0'].dtype.name)))
-    if len(meta_l) == 2 and type(meta_l) is list:
-        metadata_ = meta_h.join(meta_l[0]).join(meta_l[1])
+    typesoflocus = len(list(set(data['locus'])))
+    if typesoflocus == 1:
+        chains = {'heavy': [locus_dict1[locus]]}
+    elif split_locus:
+        chains = {L: [L] for L in [locus_dict1[locus]] + locus_dict2[locus]}
     else:
-        metadata_ = meta_h.join(meta_l)
-    df_ = metadata_.copy()
-    if type_check(meta_h, 'sequence_id_'+H+'_0'):
-        if split:
-            df_hl[H] = df_[list(meta_h.columns)].copy()
-            if len(meta_l) == 2 and type(meta_l) is list:
-                for x in range(0, len(locus_dict2[locus])):
-                    L = locus_dict2[locus][x]
-                    df_hl[L] = df_[list(meta_l[x].columns)].copy()
-            else:
-                L = locus_dict4[locus]
-                df_hl[L] = df_[list(meta_l.columns)].copy()
-            df_res_hl = df_hl.copy()
-            res_ = defaultdict(list)
-            result_dict_hl = defaultdict(dict)
-            if collapse:
-                for d in df_res_hl:
-                    for i in df_hl[d].index:
-                        if combine:
-                            try:
-                                res_[d].append(
-                                    '|'.join([l for l in list(dict.fromkeys(df_hl[d].loc[i])) if l == l]))
-                            except:
-                                res_[d].append('|'.join([str(l) for l in list(
-                                    dict.fromkeys(df_hl[d].loc[i])) if l == l]))
-                        else:
-                            try:
-                                res_[d].append(
-                                    '|'.join([l for l in list(df_hl[d].loc[i]) if l == l]))
-                            except:
-                                res_[d].append(
-                                    '|'.join([str(l) for l in list(df_hl[d].loc[i]) if l == l]))
-                    df_res_hl[d][query] = res_[d]
-                    result_dict_hl[d] = dict(df_res_hl[d][query])
-                    for k, v in result_dict_hl[d].items():
-                        if type(v) is not list:
-                            result_dict_hl[d][k] = [v]
-                if len(meta_l) == 2 and type(meta_l) is list and type(meta_l) is list:
-                    result_dict_ = {query+'_'+H: result_dict_hl[H]}
-                    for x in range(0, len(locus_dict2[locus])):
-                        L = locus_dict2[locus][x]
-                        result_dict_.update({query+'_'+L: result_dict_hl[L]})
-                else:
-                    result_dict_ = {
-                        query+'_heavy': result_dict_hl[H], query+'_light': result_dict_hl[L]}
-            else:
-                for d in df_res_hl:
-                    result_dict_hl[d] = df_res_hl[d]
+        chains = {'heavy': [locus_dict1[locus]], 'light': locus_dict2[locus]}
+    contigs = {}
+    cells = None
+    for chain, loci in chains.items():
+        rows, codes, positions, chain_cells = _contig_codes(
+            data, np.array(data['locus'].isin(loci)))
+        n_pos = positions.max() + 1 if len(positions) > 0 else 0
+        if cells is None:
+            cells = chain_cells
         else:
-            df_res = df_.copy()
-            q_res = []
-            if collapse:
-                for i in metadata_.index:
-                    if combine:
-                        q_res.append(
-                            '|'.join([qq for qq in list(dict.fromkeys(df_.loc[i])) if qq == qq]))
-                    else:
-                        q_res.append(
-                            '|'.join([qq for qq in list(df_.loc[i]) if qq == qq]))
+            # contigs of cells without a heavy chain contig still count towards the number of positions
+            codes = cells.get_indexer(data['cell_id'].values[rows])
+            keep = codes >= 0
+            rows, codes, positions = rows[keep], codes[keep], positions[keep]
+        contigs[chain] = (rows, codes, positions, n_pos)
+    return(contigs, cells)
+
+
+def _query_values(data: pd.DataFrame, query: Sequence) -> pd.DataFrame:
+    """
+    Values of the queried columns for each contig, where a sequence_id takes the values of its last contig.
+    """
+    values = data[list(query)]
+    if data['sequence_id'].duplicated().any():
+        last = data.drop_duplicates('sequence_id', keep='last')
+        values = last.set_index('sequence_id')[list(query)].reindex(
+            data['sequence_id'])
+    return(values)
+
+
+def _query_dtype(values: pd.Series, contigs: Dict) -> str:
+    """
+    Inferred dtype of a query, from the first heavy chain contig of each cell.
+    """
+    h_rows, h_codes, h_pos, h_max = contigs[list(contigs)[0]]
+    return(pd.api.types.infer_dtype(np.array(values, dtype=object)[h_rows][h_pos == 0], skipna=True))
+
+
+def _retrieve_query(values: pd.Series, query: str, contigs: Dict, cells: pd.Index, split: bool = True, collapse: bool = True, combine: bool = False, split_locus: bool = False, verbose: bool = False, dtype: Union[None, str] = None) -> pd.DataFrame:
+    """
+    Retrieves one column of the AIRR table for each cell, from the contigs coded by `_locus_contigs`. The dtype of the query is inferred with `_query_dtype` if not given.
+    """
+    if dtype is None:
+        dtype = _query_dtype(values, contigs)
+    values = np.array(values, dtype=object)
+    n = len(cells)
+    chains = list(contigs)
+    h_rows, h_codes, h_pos, h_max = contigs[chains[0]]
+    if len(chains) == 1:
+        split, split_locus = False, False
+
+    def _matrix(chain):
+        rows, codes, positions, n_pos = contigs[chain]
+        v = np.full((n, n_pos), np.nan, dtype=object)
+        v[codes, positions] = values[rows]
+        return(v)
+
+    # queries with numeric values are kept as one column per contig
+    if dtype in ['integer', 'floating', 'mixed-integer-float', 'empty', 'decimal']:
+        if verbose and collapse:
+            warnings.warn(UserWarning(
+                'Query dtype is {}. Ignoring collapse = True.'.format(dtype)))
+        blocks = []
+        for chain in chains:
+            if split_locus or split or (collapse and h_max == 1):
+                prefix = query+'_'+chain
             else:
-                for i in metadata_.index:
-                    q_res.append([qq for qq in list(df_.loc[i]) if qq == qq])
-            df_res[query] = q_res
-            result_dict_ = dict(df_res[query])
-    else:
-        result_dict_ = {x: dict(df_[x]) for x in df_}
-    rs_dict1 = {'ig': '[HL]'}
-    rs_dict2 = {'ig': 'IG[HKL]'}
-    if len(meta_l) == 2 and type(meta_l) is list:
-        rs = '_sequence_id_'+rs_dict2[locus]
-    else:
-        rs = '_sequence_id_'+rs_dict1[locus]
-    final_result_ = defaultdict(dict)
+                prefix = query
+            v = _matrix(chain)
+            blocks.append(pd.DataFrame(v, index=cells, columns=[
+                          prefix+'_'+str(p) for p in range(v.shape[1])]))
+        block = pd.concat(blocks, axis=1).apply(pd.to_numeric)
+        # the columns share one dtype
+        if any(block.dtypes.apply(lambda x: x.kind == 'f')):
+            block = block.astype(float)
+        return(block)
+
+    if split and not collapse:
+        blocks = []
+        for chain in chains:
+            v = _matrix(chain)
+            blocks.append(pd.DataFrame(v, index=cells, columns=[
+                          query+'_'+chain+'_'+str(p) for p in range(v.shape[1])]).infer_objects())
+        return(pd.concat(blocks, axis=1))
+
+    # contigs of all chains, ordered by cell, chain and position
+    codes, chain_of, ranks, v = [], [], [], []
+    for i, chain in enumerate(chains):
+        rows, c, positions, n_pos = contigs[chain]
+        vals = values[rows]
+        if i == 0 and collapse and h_max > 1:
+            # heavy chain contigs are collapsed into unique entries if any cell has more than one
+            vals = _join_tokens(*_tokens(c, vals, True), n)
+            c, positions = np.arange(n), np.zeros(n, dtype=int)
+        codes.append(c)
+        chain_of.append(np.full(len(c), i))
+        ranks.append(positions)
+        v.append(vals)
+    codes, chain_of, v = np.concatenate(codes), np.concatenate(
+        chain_of), np.concatenate(v)
+    order = np.lexsort((np.concatenate(ranks), chain_of, codes))
+    codes, chain_of, v = codes[order], chain_of[order], v[order]
+    notnull = ~pd.isnull(v)
+    codes, chain_of, v = codes[notnull], chain_of[notnull], v[notnull]
+
+    if not collapse:
+        # entries are listed in turn, one column each
+        positions = pd.Series(codes).groupby(codes).cumcount().values
+        n_pos = positions.max() + 1 if len(positions) > 0 else 0
+        out = np.full((n, n_pos), None, dtype=object)
+        out[codes, positions] = v
+        return(pd.DataFrame(out, index=cells, columns=[query+'_'+str(p) for p in range(n_pos)]).infer_objects())
     if split:
-        if not collapse:
-            if len(meta_l) == 2 and type(meta_l) is list:
-                names = [k for k in result_dict_hl.keys()]
-                final_result = result_dict_hl[names[0]].join(
-                    result_dict_hl[names[1]]).join(result_dict_hl[names[2]])
-                final_result.columns = [re.sub('_sequence_id', '', q) for q in [
-                    query+'_'+str(l) for l in final_result.columns]]
-            else:
-                try:
-                    if type_check(meta_h, 'sequence_id_'+H+'_0'):
-                        final_result_h = pd.DataFrame(result_dict_hl[H])
-                    else:
-                        final_result_h = pd.DataFrame(result_dict_[H])
-                except:
-                    if type_check(meta_h, 'sequence_id_'+H+'_0'):
-                        final_result_h = pd.DataFrame.from_dict(
-                            result_dict_hl, orient='index').T
-                        final_result_h = final_result_h[meta_h.columns].copy()
-                    else:
-                        final_result_h = pd.DataFrame.from_dict(
-                            result_dict_, orient='index').T
-                        final_result_h = final_result_h[meta_h.columns].copy()
-                final_result_h.columns = [re.sub(rs, '', q) for q in [
-                    query+'_heavy_'+str(l) for l in final_result_h.columns]]
-                try:
-                    if type_check(meta_h, 'sequence_id_'+H+'_0'):
-                        final_result_l = pd.DataFrame(
-                            result_dict_hl[locus_dict4[locus]])
-                    else:
-                        final_result_l = pd.DataFrame(
-                            result_dict_[locus_dict4[locus]])
-                except:
-                    if type_check(meta_h, 'sequence_id_'+H+'_0'):
-                        final_result_l = pd.DataFrame.from_dict(
-                            result_dict_hl, orient='index').T
-                        final_result_l = final_result_l[meta_l.columns].copy()
-                    else:
-                        final_result_l = pd.DataFrame.from_dict(
-                            result_dict_, orient='index').T
-                        final_result_l = final_result_l[meta_l.columns].copy()
-                final_result_l.columns = [re.sub(rs, '', q) for q in [
-                    query+'_light_'+str(l) for l in final_result_l.columns]]
-                final_result = final_result_h.join(final_result_l)
-        else:
-            if len(meta_l) == 2 and type(meta_l) is list:
-                if type_check(meta_h, 'sequence_id_'+H+'_0'):
-                    for d in result_dict_:
-                        final_result_[d] = pd.DataFrame.from_dict(
-                            result_dict_[d], orient='index')
-                        final_result_[d].columns = [re.sub(rs, '', q) for q in [
-                            d+'_'+str(l) for l in final_result_[d].columns]]
-                        final_result_[d].columns = [
-                            re.sub('_[0-9]', '', q) for q in final_result_[d].columns]
-                    names = [k for k in final_result_.keys()]
-                    final_result = final_result_[names[0]].join(
-                        final_result_[names[1]]).join(final_result_[names[2]])
-                else:
-                    if verbose:
-                        warnings.warn(UserWarning('Query dtype is {}. Ignoring collapse = True.'.format(
-                            meta_h['sequence_id_'+H+'_0'].dtype.name)))
-                    final_result = pd.DataFrame.from_dict(
-                        result_dict_, orient='index').T
-                    final_result.columns = [
-                        query+re.sub('sequence_id', '', q) for q in final_result.columns]
-            else:
-                if type_check(meta_h, 'sequence_id_'+H+'_0'):
-                    final_result_h = pd.DataFrame.from_dict(
-                        result_dict_[query+'_heavy'], orient='index')
-                    final_result_h.columns = [query+'_heavy']
-                    final_result_l = pd.DataFrame.from_dict(
-                        result_dict_[query+'_light'], orient='index')
-                    final_result_l.columns = [query+'_light']
-                    final_result = final_result_h.join(final_result_l)
-                else:
-                    if verbose:
-                        warnings.warn(UserWarning('Query dtype is {}. Ignoring collapse = True.'.format(
-                            meta_h['sequence_id_'+H+'_0'].dtype.name)))
-                    final_result_h = pd.DataFrame.from_dict(
-                        result_dict_, orient='index').T
-                    final_result_h = final_result_h[meta_h.columns].copy()
-                    final_result_h.columns = [re.sub(rs, '', q) for q in [
-                        query+'_heavy_'+str(l) for l in final_result_h.columns]]
-                    final_result_l = pd.DataFrame.from_dict(
-                        result_dict_, orient='index').T
-                    final_result_l = final_result_l[meta_l.columns].copy()
-                    final_result_l.columns = [re.sub(rs, '', q) for q in [
-                        query+'_light_'+str(l) for l in final_result_l.columns]]
-                    final_result = final_result_h.join(final_result_l)
-    else:
-        if type_check(meta_h, 'sequence_id_'+H+'_0'):
-            if not collapse:
-                if len(meta_l) == 2 and type(meta_l) is list:
-                    final_result = pd.DataFrame.from_dict(
-                        result_dict_, orient='index')
-                    final_result.columns = [re.sub(rs, '', q) for q in [
-                        query+'_'+str(l) for l in final_result.columns]]
-                else:
-                    final_result = pd.DataFrame.from_dict(
-                        result_dict_, orient='index')
-                    final_result.columns = [re.sub(rs, '', q) for q in [
-                        query+'_'+str(l) for l in final_result.columns]]
-            else:
-                if len(meta_l) == 2 and type(meta_l) is list:
-                    final_result = pd.DataFrame.from_dict(
-                        result_dict_, orient='index')
-                    final_result.columns = [query]
-                else:
-                    final_result = pd.DataFrame.from_dict(
-                        result_dict_, orient='index')
-                    final_result.columns = [query]
-        else:
-            if not collapse:
-                if len(meta_l) == 2 and type(meta_l) is list:
-                    final_result = pd.DataFrame.from_dict(
-                        result_dict_, orient='index').T
-                    final_result.columns = [re.sub('_sequence_id', '', q) for q in [
-                        query+'_'+str(l) for l in final_result.columns]]
-                else:
-                    final_result = pd.DataFrame.from_dict(
-                        result_dict_, orient='index').T
-                    final_result.columns = [re.sub(rs, '', q) for q in [
-                        query+'_'+str(l) for l in final_result.columns]]
-            else:
-                if verbose:
-                    warnings.warn(UserWarning('Query dtype is {}. Ignoring collapse = True and split = False.'.format(
-                        meta_h['sequence_id_'+H+'_0'].dtype.name)))
-                if len(meta_l) == 2 and type(meta_l) is list:
-                    final_result = pd.DataFrame.from_dict(
-                        result_dict_, orient='index').T
-                    final_result.columns = [re.sub('_sequence_id', '', q) for q in [
-                        query+'_'+str(l) for l in final_result.columns]]
-                else:
-                    typedict = {locus_dict3[locus]: 'heavy',
-                                locus_dict4[locus]: 'light'}
-                    final_result = pd.DataFrame.from_dict(
-                        result_dict_, orient='index').T
-                    final_result.columns = [re.sub(rs, '', q) for q in [
-                        query+'_'+typedict[l.split('_')[2]]+'_'+l for l in final_result.columns]]
+        result = pd.DataFrame(index=cells)
+        for i, chain in enumerate(chains):
+            in_chain = chain_of == i
+            result[query+'_'+chain] = _join_tokens(
+                *_tokens(codes[in_chain], v[in_chain], combine), n)
+        return(result)
+    return(pd.DataFrame({query: _join_tokens(*_tokens(codes, v, combine), n)}, index=cells))
 
-    return(final_result)
 
+def _tokens(codes: np.ndarray, values: np.ndarray, dedup: bool) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Non-null values as strings, grouped by code in order of appearance and optionally without duplicates within a code.
+    """
+    notnull = ~pd.isnull(values)
+    codes, values = codes[notnull], values[notnull]
+    if dedup:
+        first = ~pd.DataFrame({'c': codes, 'v': values}).duplicated().values
+        codes, values = codes[first], values[first]
+    order = np.argsort(codes, kind='stable')
+    return(codes[order], pd.Series(values[order], dtype=object).astype(str).values.astype(object))
 
-def retrieve_result_dict_singular(query: str, data: pd.DataFrame, meta_h: pd.DataFrame, locus: Literal['ig'] = 'ig', collapse: bool = True, combine: bool = False, verbose: bool = False) -> Dict:
 
-    df_hl = defaultdict(dict)
+def _subset_contigs(contigs: Dict, all_cells: pd.Index, cells: Sequence) -> Tuple[Dict, pd.Index]:
+    """
+    Restricts the contigs coded by `_locus_contigs` to some of the cells, keeping the number of positions of each chain.
+    """
+    target = all_cells.get_indexer(cells)
+    target = np.sort(target[target >= 0])
+    remap = np.full(len(all_cells), -1)
+    remap[target] = np.arange(len(target))
+    sub = {}
+    for chain, (rows, codes, positions, n_pos) in contigs.items():
+        keep = remap[codes] >= 0
+        sub[chain] = (rows[keep], remap[codes[keep]], positions[keep], n_pos)
+    return(sub, all_cells[target])
+
+
+def _contig_snapshot(data: pd.DataFrame, cols: Sequence) -> pd.DataFrame:
+    """
+    Hash of the columns the metadata is built from for each contig, with its cell and position within the cell.
+    """
+    codes = pd.factorize(data['cell_id'].values)[0]
+    hashes = pd.util.hash_pandas_object(
+        data[['cell_id', 'sequence_id'] + list(cols)], index=False).values
+    return(pd.DataFrame({'cell_id': data['cell_id'].values, 'position': pd.Series(codes).groupby(codes).cumcount().values, 'hash': hashes}))
 
-    locus_dict1 = {'ig': 'IGH'}
-    locus_dict3 = {'ig': 'H'}
-
-    H = locus_dict3[locus]
-    if meta_h.shape[1] > 1:
-        if collapse:
-            newmeta_h = meta_h.copy()
-            if type_check(meta_h, 'sequence_id_'+H+'_0'):
-                newh = []
-                for i in meta_h.index:
-                    try:
-                        newh.append(
-                            '|'.join([h for h in list(dict.fromkeys(newmeta_h.loc[i])) if h == h]))
-                    except:
-                        newh.append('|'.join([str(h) for h in list(
-                            dict.fromkeys(newmeta_h.loc[i])) if h == h]))
-                newmeta_h['sequence_id_'+H+'_0'] = newh
-                meta_h = pd.DataFrame(newmeta_h['sequence_id_'+H+'_0'].copy())
-            else:
-                collapse = False
-                if verbose:
-                    warnings.warn(UserWarning(
-                        'Multiple heavy chain contigs mapping to the same cell barcode and/or query dtype is {}. Ignoring collapse = True.'.format(meta_h['sequence_id_'+H+'_0'].dtype.name)))
-
-    metadata_ = meta_h.copy()
-
-    df_ = metadata_.copy()
-    if type_check(meta_h, 'sequence_id_'+H+'_0'):
-        df_res = df_.copy()
-        q_res = []
-        if collapse:
-            for i in metadata_.index:
-                if combine:
-                    try:
-                        q_res.append(
-                            '|'.join([qq for qq in list(dict.fromkeys(df_.loc[i])) if qq == qq]))
-                    except:
-                        q_res.append('|'.join([str(qq) for qq in list(
-                            dict.fromkeys(df_.loc[i])) if qq == qq]))
-                else:
-                    try:
-                        q_res.append(
-                            '|'.join([qq for qq in list(df_.loc[i]) if qq == qq]))
-                    except:
-                        q_res.append(
-                            '|'.join([str(qq) for qq in list(df_.loc[i]) if qq == qq]))
-        else:
-            for i in metadata_.index:
-                q_res.append([qq for qq in list(df_.loc[i]) if qq == qq])
-        df_res[query] = q_res
-        result_dict_ = dict(df_res[query])
-    else:
-        result_dict_ = {x: dict(df_[x]) for x in df_}
 
-    rs_dict1 = {'ig': '[H]'}
-    rs = '_sequence_id_'+rs_dict1[locus]
-    final_result_ = defaultdict(dict)
+def _dirty_cells(old: pd.DataFrame, new: pd.DataFrame) -> np.ndarray:
+    """
+    Cells with contigs that were added, removed, reordered or changed between two snapshots.
+    """
+    merged = old.merge(new, on=['cell_id', 'position'], how='outer')
+    changed = merged['hash_x'].isna() | merged['hash_y'].isna() | (
+        merged['hash_x'] != merged['hash_y'])
+    return(pd.unique(merged.loc[changed, 'cell_id'].values))
+
 
-    if type_check(meta_h, 'sequence_id_'+H+'_0'):
-        if not collapse:
-            final_result = pd.DataFrame.from_dict(result_dict_, orient='index')
-            final_result.columns = [re.sub(rs, '', q) for q in [
-                query+'_'+str(l) for l in final_result.columns]]
-        else:
-            final_result = pd.DataFrame.from_dict(result_dict_, orient='index')
-            final_result.columns = [query]
-    else:
-        if not collapse:
-            final_result = pd.DataFrame.from_dict(
-                result_dict_, orient='index').T
-            final_result.columns = [re.sub(rs, '', q) for q in [
-                query+'_'+str(l) for l in final_result.columns]]
-        else:
-            if verbose:
-                warnings.warn(UserWarning('Query dtype is {}. Ignoring collapse = True and split = False.'.format(
-                    meta_h['sequence_id_'+H+'_0'].dtype.name)))
-            typedict = {locus_dict3[locus]: 'heavy'}
-            final_result = pd.DataFrame.from_dict(
-                result_dict_, orient='index').T
-            final_result.columns = [re.sub(rs, '', q) for q in [
-                query+'_'+typedict[l.split('_')[2]]+'_'+l for l in final_result.columns]]
-    return(final_result)
-
-
-def initialize_metadata(self, cols: Sequence, locus_: str, clonekey: str, collapse_alleles: bool, verbose: bool) -> Dandelion:
+def _splice_metadata(old: pd.DataFrame, new: pd.DataFrame, cells: pd.Index, blocks: Sequence) -> Union[None, pd.DataFrame]:
+    """
+    Replaces the rows of the recomputed cells in the current metadata. Returns None if the two are not in the same layout.
+
+    Parameters
+    ----------
+    old : DataFrame
+        current metadata.
+    new : DataFrame
+        metadata of the recomputed cells.
+    cells : pd.Index
+        all cells, in order.
+    blocks : Sequence
+        column names of each numeric query, whose columns share one dtype.
+
+    Returns
+    -------
+    spliced metadata, or None.
+    """
+    if old is None or not all(c in old for c in new):
+        return(None)
+    old = old[list(new.columns)]
+    if not cells.isin(old.index.union(new.index)).all():
+        return(None)
+    if new.shape[0] > 0:
+        numeric = [c for b in blocks for c in b]
+        if any(new[c].dtype != old[c].dtype for c in new if c not in numeric):
+            return(None)
+        for b in blocks:
+            if len(b) == 0:
+                continue
+            old_float, new_float = old[b].dtypes.iloc[0].kind == 'f', new[b].dtypes.iloc[0].kind == 'f'
+            if new_float and not old_float:
+                old = old.astype({c: float for c in b})
+            elif old_float and not new_float:
+                new = new.astype({c: float for c in b})
+    spliced = pd.concat([old.drop(new.index, errors='ignore'), new]).reindex(cells)
+    for b in blocks:
+        # integer columns only stay float if there are missing values
+        block = spliced[b]
+        if len(b) > 0 and block.dtypes.iloc[0].kind == 'f' and not block.isna().any().any() and (block % 1 == 0).all().all():
+            return(None)
+    return(spliced)
+
+
+def initialize_metadata(self, cols: Sequence, locus_: str, clonekey: str, collapse_alleles: bool, verbose: bool, cells: Union[None, Sequence] = None) -> Dandelion:
     init_dict = {}
     for col in cols:
-        init_dict.update({col: {'split': True, 'collapse': True,
-                                'combine': False, 'locus': locus_, 'split_locus': False}})
+        init_dict.update({col: {'split': True, 'combine': False}})
     if clonekey in init_dict:
-        init_dict.update({clonekey: {'split': False, 'collapse': True,
-                                     'combine': True, 'locus': locus_, 'split_locus': False}})
+        init_dict.update({clonekey: {'split': False, 'combine': True}})
     if 'sample_id' in init_dict:
-        init_dict.update({'sample_id': {'split': False, 'collapse': True,
-                                        'combine': True, 'locus': locus_, 'split_locus': False}})
+        init_dict.update({'sample_id': {'split': False, 'combine': True}})
+
+    # contigs are coded against the cells once and shared by all columns
+    contigs, all_cells = self.contig_index.chains(locus_)
+    full_contigs = contigs
+    if cells is None:
+        cells = all_cells
+    else:
+        # only the given cells are recomputed, in the same layout; at least one is needed to check the layout
+        cells = all_cells[all_cells.isin(cells)]
+        if len(cells) == 0:
+            cells = all_cells[:1]
+        contigs, cells = _subset_contigs(contigs, all_cells, cells)
+    values = _query_values(self.data, list(init_dict))
+
     meta_ = defaultdict(dict)
     for k, v in init_dict.copy().items():
-        if (all(pd.isnull(self.data[k]))) or (all([i == '' for i in self.data[k]])):
+        if (all(pd.isnull(self.data[k]))) or ((self.data[k] == '').all()):
             init_dict.pop(k)
             continue
-        meta_[k] = retrieve_metadata(self.data, query=k, verbose=verbose, **v)
+        if verbose and len(contigs) == 1:
+            warnings.warn(UserWarning(
+                'Single locus type detected. Ignoring split = True and split_locus = True.'))
+        meta_[k] = _retrieve_query(
+            values[k], k, contigs, cells, dtype=_query_dtype(values[k], full_contigs), **v)
 
     tmp_metadata = pd.concat(meta_.values(), axis=1, join="inner")
 
@@ -836,97 +1651,53 @@ def initialize_metadata(self, cols: Sequence, locus_: str, clonekey: str, collap
     if clonekey in init_dict:
         tmp_metadata[str(clonekey)] = tmp_metadata[str(
             clonekey)].replace('', 'unassigned')
-        clones = tmp_metadata[str(clonekey)].str.split('|', expand=False)
-        tmpclones = []
-        for i in clones:
+
+        def _drop_unassigned(c):
+            i = c.split('|')
             while 'unassigned' in i:
                 i.remove('unassigned')
                 if len(i) == 1:
                     break
-            tmpclones.append(i)
-        tmpclones = ['|'.join(list(set(x))) for x in tmpclones]
-        tmpclonesdict = dict(zip(tmp_metadata.index, tmpclones))
-        tmp_metadata[str(clonekey)] = pd.Series(tmpclonesdict)
-        tmp = tmp_metadata[str(clonekey)].str.split('|', expand=True).stack()
-        tmp = tmp.reset_index(drop=False)
-        tmp.columns = ['cell_id', 'tmp', str(clonekey)]
-        clone_size = tmp[str(clonekey)].value_counts()
-        if "" in clone_size.index:
-            clone_size = clone_size.drop("", axis=0)
-        clonesize_dict = dict(clone_size)
-        size_of_clone = pd.DataFrame.from_dict(clonesize_dict, orient='index')
-        size_of_clone.reset_index(drop=False, inplace=True)
-        size_of_clone.columns = [str(clonekey), 'clone_size']
-        size_of_clone[str(clonekey)+'_by_size'] = size_of_clone.index+1
-        size_dict = dict(
-            zip(size_of_clone[clonekey], size_of_clone[str(clonekey)+'_by_size']))
-        size_dict.update({'': 'unassigned'})
-        tmp_metadata[str(clonekey)+'_by_size'] = ['|'.join(sorted(list(set([str(size_dict[c_]) for c_ in c.split('|')]))))
-                                                  if len(c.split('|')) > 1 else str(size_dict[c]) for c in tmp_metadata[str(clonekey)]]
-        tmp_metadata[str(
-            clonekey)+'_by_size'] = tmp_metadata[str(clonekey)+'_by_size'].astype('category')
-        tmp_metadata = tmp_metadata[[str(clonekey), str(clonekey)+'_by_size'] + [
-            cl for cl in tmp_metadata if cl not in [str(clonekey), str(clonekey)+'_by_size']]]
-
-    for i in tmp_metadata.index:
-        if pd.notnull(tmp_metadata.loc[i, 'locus'+suffix_h]):
-            if pd.notnull(tmp_metadata.loc[i, 'locus'+suffix_l]):
-                if (tmp_metadata.loc[i, 'locus'+suffix_l] != ''):
-                    tmp_metadata.at[i, 'status'] = tmp_metadata.loc[i,
-                                                                    'locus'+suffix_h]+' + ' + tmp_metadata.loc[i, 'locus'+suffix_l]
-                else:
-                    tmp_metadata.at[i, 'status'] = tmp_metadata.loc[i,
-                                                                    'locus'+suffix_h] + '_only'
-            elif tmp_metadata.loc[i, 'locus'+suffix_h] != '':
-                tmp_metadata.at[i, 'status'] = tmp_metadata.loc[i,
-                                                                'locus'+suffix_h] + '_only'
-            else:
-                tmp_metadata.at[i, 'status'] = 'unassigned'
-        else:
-            tmp_metadata.at[i, 'status'] = 'unassigned'
-    tmp_metadata['status_summary'] = [
-        'Multi' if '|' in i else i for i in tmp_metadata['status']]
-
-    for i in tmp_metadata.index:
-        if tmp_metadata.loc[i, 'productive'+suffix_h] == tmp_metadata.loc[i, 'productive'+suffix_h]:
-            if not pd.isnull(tmp_metadata.loc[i, 'productive'+suffix_l]):
-                if tmp_metadata.loc[i, 'productive'+suffix_l] != '':
-                    tmp_metadata.at[i, 'productive'] = tmp_metadata.loc[i,
-                                                                        'productive'+suffix_h]+' + ' + tmp_metadata.loc[i, 'productive'+suffix_l]
-                else:
-                    tmp_metadata.at[i, 'productive'] = tmp_metadata.loc[i,
-                                                                        'productive'+suffix_h]
-            elif tmp_metadata.loc[i, 'productive'+suffix_h] != '':
-                tmp_metadata.at[i, 'productive'] = tmp_metadata.loc[i,
-                                                                    'productive'+suffix_h]
-            else:
-                tmp_metadata.at[i, 'productive'] = 'unassigned'
-        else:
-            tmp_metadata.at[i, 'productive'] = 'unassigned'
-    tmp_metadata['productive_summary'] = [
-        'Multi' if '|' in i else i for i in tmp_metadata['productive']]
+            return('|'.join(list(set(i))))
+        tmp_metadata[str(clonekey)] = _map_unique(
+            tmp_metadata[str(clonekey)], _drop_unassigned)
+    def _pair(h, l, only, missing):
+        # h + l if there is a light chain entry, else the heavy chain entry (with a suffix)
+        h_notnull, l_notnull = pd.notnull(h), pd.notnull(l)
+        h_, l_ = h.astype(str), l.astype(str)
+        return(np.select([h_notnull & l_notnull & (l != ''), h_notnull & l_notnull, h_notnull & (h != '')],
+                         [h_ + ' + ' + l_, h_ + only, h_ + only], default=missing))
+
+    tmp_metadata['status'] = _pair(tmp_metadata['locus'+suffix_h],
+                                   tmp_metadata['locus'+suffix_l], '_only', 'unassigned')
+    tmp_metadata['status_summary'] = np.where(
+        tmp_metadata['status'].str.contains('|', regex=False), 'Multi', tmp_metadata['status'])
+
+    tmp_metadata['productive'] = _pair(tmp_metadata['productive'+suffix_h],
+                                       tmp_metadata['productive'+suffix_l], '', 'unassigned')
+    tmp_metadata['productive_summary'] = np.where(
+        tmp_metadata['productive'].str.contains('|', regex=False), 'Multi', tmp_metadata['productive'])
 
     # conversion_dict = {'igha1': 'IgA', 'igha2': 'IgA', 'ighm': 'IgM', 'ighd': 'IgD', 'ighe': 'IgE', 'ighg1': 'IgG', 'ighg2': 'IgG', 'ighg2a': 'IgG', 'ighg2b': 'IgG', 'ighg2c': 'IgG', 'ighg3': 'IgG', 'ighg4': 'IgG', 'igkc': 'IgK', 'iglc1': 'IgL', 'iglc2': 'IgL', 'iglc3': 'IgL', 'iglc4': 'IgL', 'iglc5': 'IgL', 'iglc6': 'IgL', 'iglc7': 'IgL',
     #                   'igha': 'IgA', 'ighg': 'IgG', 'iglc': 'IgL', 'nan': 'unassigned', 'na': 'unassigned', 'none': 'unassigned', '': 'unassigned', 'unassigned': 'unassigned', np.nan: 'unassigned', None: 'unassigned'}
     conversion_dict = {'ighgcmm': 'IgG', 'igkcmm': 'IgK', 'ighmmm': 'IgG', 'ighamm': 'IgA', 'ighgbmm': 'IgG', 'ighgmm': 'IgG', 'ighg2cmm': 'IgG', 'iglc3cf': 'IgL', 'ighg2bmm': 'IgG', 'iglc1cf': 'IgL', 'ighg1mm': 'IgG', 'iglc2mm': 'IgL', 'ighg3mm': 'IgG', 'iglc1mm': 'IgL', 'ighdmm': 'IgD', 'iglc7cf': 'IgL', 'ighmcf': 'IgM', 'ighacf': 'IgA', 'iglc3mm': 'IgL', 'iglc4cf': 'IgL', 'ighg1cf': 'IgG', 'iglc5cf': 'IgL', 'iglc9cf': 'IgL', 'igkccf': 'IgK', 'ighemm': 'IgE', 'iglc2cf': 'IgL', 'ighg2cf': 'IgG',
                        'nan': 'unassigned', 'na': 'unassigned', 'none': 'unassigned', '': 'unassigned', 'unassigned': 'unassigned', np.nan: 'unassigned', None: 'unassigned'}
 
-
-    isotype = []
-    for k in tmp_metadata['c_call'+suffix_h]:
+    def _isotype(k):
         if isinstance(k, str):
             if ',' in k:
                 k = '|'.join(k.split(','))
             if '|' in k:
-                isotype.append('|'.join([str(z) for z in [conversion_dict[y.lower()] for y in set(
+                return('|'.join([str(z) for z in [conversion_dict[y.lower()] for y in set(
                     [re.sub('[0-9]', '', x) for x in k.split('|')])]]))
             else:
-                isotype.append(conversion_dict[k.lower()])
+                return(conversion_dict[k.lower()])
         else:
-            isotype.append('unassigned')
-    tmp_metadata['isotype'] = isotype
-    tmp_metadata['isotype_summary'] = [i if i == 'IgM|IgD' or i == 'IgD|IgM' else
-                                       'Multi' if '|' in i else i for i in tmp_metadata['isotype']]
+            return('unassigned')
+    tmp_metadata['isotype'] = _map_unique(
+        tmp_metadata['c_call'+suffix_h], _isotype)
+    tmp_metadata['isotype_summary'] = _map_unique(tmp_metadata['isotype'], lambda i: i if i == 'IgM|IgD' or i == 'IgD|IgM' else
+                                                  'Multi' if '|' in i else i)
 
     vdj_gene_calls = ['v_call', 'd_call', 'j_call']
     if collapse_alleles:
@@ -934,105 +1705,183 @@ def initialize_metadata(self, cols: Sequence, locus_: str, clonekey: str, collap
             if x in self.data:
                 for c in tmp_metadata:
                     if x in c:
-                        tmp_metadata[c] = ['|'.join(['|'.join(list(set(yy.split(',')))) for yy in list(set(
-                            [re.sub('[*][0-9][0-9]', '', tx) for tx in t.split('|')]))]) for t in tmp_metadata[c]]
-    multi = {}
-    multic = {}
-    for i in tmp_metadata.index:
-        try:
-            if 'v_call_genotyped' in cols:
-                hv_ = tmp_metadata.at[i,
-                                      'v_call_genotyped'+suffix_h].split('|')
-            else:
-                hv_ = tmp_metadata.at[i, 'v_call'+suffix_h].split('|')
-        except:
-            if 'v_call_genotyped' in cols:
-                hv_ = tmp_metadata.at[i, 'v_call_genotyped'+suffix_h]
-            else:
-                hv_ = tmp_metadata.at[i, 'v_call'+suffix_h]
-        try:
-            hj_ = tmp_metadata.at[i, 'j_call'+suffix_h].split('|')
-        except:
-            hj_ = tmp_metadata.at[i, 'j_call'+suffix_h]
-        try:
-            if 'v_call_genotyped' in cols:
-                lv_ = tmp_metadata.at[i,
-                                      'v_call_genotyped'+suffix_l].split('|')
-            else:
-                lv_ = tmp_metadata.at[i, 'v_call'+suffix_l].split('|')
-        except:
-            if 'v_call_genotyped' in cols:
-                lv_ = tmp_metadata.at[i, 'v_call_genotyped'+suffix_l]
-            else:
-                lv_ = tmp_metadata.at[i, 'v_call'+suffix_l]
-        try:
-            lj_ = tmp_metadata.at[i, 'j_call'+suffix_l].split('|')
-        except:
-            lj_ = tmp_metadata.at[i, 'j_call'+suffix_l]
+                        tmp_metadata[c] = _map_unique(tmp_metadata[c], lambda t: '|'.join(['|'.join(list(set(yy.split(',')))) for yy in list(set(
+                            [re.sub('[*][0-9][0-9]', '', tx) for tx in t.split('|')]))]))
+
+    def _n_entries(c):
         try:
-            hc_ = tmp_metadata.at[i, 'c_call'+suffix_h].split('|')
+            return(len(c.split('|')))
         except:
-            hc_ = tmp_metadata.at[i, 'c_call'+suffix_h]
+            return(len(c))
+
+    def _single(c):
         try:
-            lc_ = tmp_metadata.at[i, 'c_call'+suffix_l].split('|')
+            return('' not in c.split('|'))
         except:
-            lc_ = tmp_metadata.at[i, 'c_call'+suffix_l]
+            return('' not in c)
+    if 'v_call_genotyped' in cols:
+        v_call = 'v_call_genotyped'
+    else:
+        v_call = 'v_call'
+    n_hv = _map_unique(tmp_metadata[v_call+suffix_h], _n_entries)
+    n_hj = _map_unique(tmp_metadata['j_call'+suffix_h], _n_entries)
+    n_lv = _map_unique(tmp_metadata[v_call+suffix_l], _n_entries)
+    n_lj = _map_unique(tmp_metadata['j_call'+suffix_l], _n_entries)
+    n_hc = _map_unique(tmp_metadata['c_call'+suffix_h], _n_entries)
+    n_lc = _map_unique(tmp_metadata['c_call'+suffix_l], _n_entries)
+    single_l = (n_lv == 1) & (n_lj == 1) & _map_unique(tmp_metadata[v_call+suffix_l], _single) & _map_unique(
+        tmp_metadata['j_call'+suffix_l], _single)
+    single_lc = (n_lc == 1) & _map_unique(
+        tmp_metadata['c_call'+suffix_l], _single)
+    ighm_ighd = tmp_metadata['isotype_summary'].isin(['IgM|IgD', 'IgD|IgM'])
+
+    # the statuses only depend on these flags, so each combination is worked out once
+    flags = pd.DataFrame({'hv': n_hv > 1, 'hj': n_hj > 1, 'lv': n_lv > 1, 'lj': n_lj > 1, 'hc': n_hc > 1, 'lc': n_lc > 1, 'single_l': single_l,
+                          'single_lc': single_lc, 'isotype': np.where(ighm_ighd, tmp_metadata['isotype_summary'], '')}, index=tmp_metadata.index)
+
+    def _status(f):
+        hv, hj, lv, lj, hc, lc, s_l, s_lc, iso = f
         multi_h = []
         multi_l = []
         multi_hc = []
         multi_lc = []
-        if len(hv_) > 1:
+        if hv:
             multi_h.append(['Multi'+suffix_h+'_v'])
-        if len(hj_) > 1:
+        if hj:
             multi_h.append(['Multi'+suffix_h+'_j'])
-        if len(lv_) > 1:
+        if lv:
             multi_l.append(['Multi'+suffix_l+'_v'])
-        if len(lj_) > 1:
+        if lj:
             multi_l.append(['Multi'+suffix_l+'_j'])
-        if len(hc_) > 1:
-            if (tmp_metadata.at[i, 'isotype_summary'] == 'IgM|IgD') or (tmp_metadata.at[i, 'isotype_summary'] == 'IgD|IgM'):
-                multi_hc.append([tmp_metadata.at[i, 'isotype_summary']])
+        if hc:
+            if iso != '':
+                multi_hc.append([iso])
             else:
                 multi_hc.append(['Multi'+suffix_h+'_c'])
-        if len(lc_) > 1:
+        if lc:
             multi_lc.append(['Multi'+suffix_l+'_c'])
         if len(multi_hc) < 1:
             multi_hc.append(['Single'])
         if len(multi_h) < 1:
             multi_h.append(['Single'])
-        if (len(lv_) == 1) & (len(lj_) == 1):
-            if ('' not in lv_) and ('' not in lj_):
-                if len(multi_l) < 1:
-                    multi_l.append(['Single'])
-        if len(lc_) == 1:
-            if ('' not in lc_):
-                if len(multi_lc) < 1:
-                    multi_lc.append(['Single'])
+        if s_l:
+            if len(multi_l) < 1:
+                multi_l.append(['Single'])
+        if s_lc:
+            if len(multi_lc) < 1:
+                multi_lc.append(['Single'])
         multih = '|'.join(list(set(flatten(multi_h))))
         multil = '|'.join(list(set(flatten(multi_l))))
         multihc = '|'.join(list(set(flatten(multi_hc))))
         multilc = '|'.join(list(set(flatten(multi_lc))))
         if len(multih) > 0:
             if len(multil) > 0:
-                multi[i] = multih + ' + ' + multil
+                multi = multih + ' + ' + multil
             else:
-                multi[i] = multih
+                multi = multih
         else:
-            multi[i] = 'unassigned'
+            multi = 'unassigned'
         if len(multihc) > 0:
             if len(multilc) > 0:
-                multic[i] = multihc + ' + ' + multilc
+                multic = multihc + ' + ' + multilc
             else:
-                multic[i] = multihc
+                multic = multihc
         else:
-            multic[i] = 'unassigned'
-    tmp_metadata['vdj_status'] = pd.Series(multi)
-    tmp_metadata['vdj_status_summary'] = [
-        'Multi' if 'Multi'+suffix_h in i else 'Single' for i in tmp_metadata['vdj_status']]
-    tmp_metadata['heavychain_status_summary'] = [
-        'Multi' if 'Multi'+suffix_h in i else 'Single' for i in pd.Series(multic)]
+            multic = 'unassigned'
+        return(multi, multic)
+    combos, uniq = pd.factorize(pd.MultiIndex.from_frame(flags))
+    status = np.array([_status(c) for c in uniq], dtype=object).reshape(-1, 2)
+    tmp_metadata['vdj_status'] = status[combos, 0]
+    tmp_metadata['vdj_status_summary'] = np.where(tmp_metadata['vdj_status'].str.contains(
+        'Multi'+suffix_h, regex=False), 'Multi', 'Single')
+    tmp_metadata['heavychain_status_summary'] = np.where(pd.Series(status[combos, 1]).str.contains(
+        'Multi'+suffix_h, regex=False), 'Multi', 'Single')
+
+    if cells is not all_cells:
+        tmp_metadata = _splice_metadata(self._peek('_metadata'), tmp_metadata, all_cells, [
+                                        list(m.columns) for m in meta_.values() if m.dtypes.apply(lambda x: x.kind in 'iuf').all()])
+        if tmp_metadata is None:
+            return(initialize_metadata(self, cols, locus_, clonekey, collapse_alleles, verbose))
+
+    # clone sizes are counted over all cells
+    if clonekey in init_dict:
+        tmp_metadata[str(clonekey)+'_by_size'] = _clone_size_rank(
+            tmp_metadata[str(clonekey)])
+        tmp_metadata = tmp_metadata[[str(clonekey), str(clonekey)+'_by_size'] + [
+            cl for cl in tmp_metadata if cl not in [str(clonekey), str(clonekey)+'_by_size']]]
+
+    self._metadata = tmp_metadata.copy()
+    self._metadata_stale = False
+    # columns computed from `.data`, as opposed to columns added by the user
+    self._metadata_derived = list(tmp_metadata.columns)
+
+
+def _clone_size_rank(clones: pd.Series) -> pd.Series:
+    # rank of each clone by its number of cells, with the ranks of all clones of cells in several clones
+    # each unique entry is split once; clones are kept in order of first appearance so that ties are ranked as before
+    entries = clones.value_counts(sort=False)
+    entries = entries.reindex(pd.unique(clones))
+    tmp = pd.DataFrame({'n': np.repeat(entries.values, [len(e.split('|')) for e in entries.index]), 'clone': [
+                       c for e in entries.index for c in e.split('|')]})
+    clone_size = tmp.groupby('clone', sort=False)[
+        'n'].sum().sort_values(ascending=False)
+    if "" in clone_size.index:
+        clone_size = clone_size.drop("", axis=0)
+    size_dict = dict(
+        zip(clone_size.index, [str(x) for x in range(1, len(clone_size)+1)]))
+    size_dict.update({'': 'unassigned'})
+    ranks = _map_unique(clones, lambda c: '|'.join(sorted(list(set([str(size_dict[c_]) for c_ in c.split('|')]))))
+                        if len(c.split('|')) > 1 else str(size_dict[c]))
+    return(ranks.astype('category'))
+
+
+def _initialize_cols(self: Dandelion, clonekey: Union[None, str] = None) -> Sequence:
+    """
+    Columns of `.data` that the metadata is initialized from.
+
+    Parameters
+    ----------
+    self : Dandelion
+        `Dandelion` object.
+    clonekey : str, optional
+        Column name of clone id. None defaults to 'clone_id'.
+
+    Returns
+    -------
+    list of column names. Raises a ValueError if required columns are missing.
+    """
+    if clonekey is None:
+        clonekey = 'clone_id'
+
+    cols = ['sequence_id', 'cell_id', 'locus', 'productive',
+            'v_call', 'j_call', 'c_call', 'umi_count', 'junction_aa']
+
+    if 'umi_count' not in self.data:
+        cols = list(map(lambda x: 'duplicate_count' if x ==
+                        'umi_count' else x, cols))
+        if 'duplicate_count' not in self.data:
+            raise ValueError(
+                "Unable to initialize metadata due to missing keys. Please ensure either 'umi_count' or 'duplicate_count' is in the input data.")
 
-    self.metadata = tmp_metadata.copy()
+    if not all([c in self.data for c in cols]):
+        raise ValueError(
+            'Unable to initialize metadata due to missing keys. Please ensure the input data contains all the following columns: {}'.format(cols))
+
+    if 'sample_id' in self.data:
+        cols = ['sample_id'] + cols
+
+    if 'v_call_genotyped' in self.data:
+        cols = list(
+            map(lambda x: 'v_call_genotyped' if x == 'v_call' else x, cols))
+
+    for c in ['sequence_id', 'cell_id']:
+        cols.remove(c)
+
+    if clonekey in self.data:
+        if not all(pd.isnull(self.data[clonekey])):
+            cols = [clonekey] + cols
+
+    return(cols)
 
 
 def update_metadata(self: Dandelion, retrieve: Union[None, Sequence, str] = None, locus: Union[None, Literal['ig']] = None, clone_key: Union[None, str] = None, split: bool = True, collapse: bool = True, combine: bool = True, split_locus: bool = False, collapse_alleles: bool = True, reinitialize: bool = False,  verbose: bool = False) -> Dandelion:
@@ -1078,69 +1927,64 @@ def update_metadata(self: Dandelion, retrieve: Union[None, Sequence, str] = None
     else:
         clonekey = clone_key
 
-    cols = ['sequence_id', 'cell_id', 'locus', 'productive',
-            'v_call', 'j_call', 'c_call', 'umi_count', 'junction_aa']
+    cols = _initialize_cols(self, clonekey)
 
-    if 'umi_count' not in self.data:
-        cols = list(map(lambda x: 'duplicate_count' if x ==
-                        'umi_count' else x, cols))
-        if 'duplicate_count' not in self.data:
-            raise ValueError(
-                "Unable to initialize metadata due to missing keys. Please ensure either 'umi_count' or 'duplicate_count' is in the input data.")
-
-    if not all([c in self.data for c in cols]):
-        raise ValueError(
-            'Unable to initialize metadata due to missing keys. Please ensure the input data contains all the following columns: {}'.format(cols))
-
-    if 'sample_id' in self.data:
-        cols = ['sample_id'] + cols
-
-    if 'v_call_genotyped' in self.data:
-        cols = list(
-            map(lambda x: 'v_call_genotyped' if x == 'v_call' else x, cols))
-
-    for c in ['sequence_id', 'cell_id']:
-        cols.remove(c)
-
-    if clonekey in self.data:
-        if not all(pd.isnull(self.data[clonekey])):
-            cols = [clonekey] + cols
-
-    metadata_status = self.metadata
-    if (metadata_status is None) or reinitialize:
+    # metadata waiting to be computed on first access is computed with the options it was registered with, unless reinitialized here
+    if reinitialize:
+        metadata_status = None
+    else:
+        metadata_status = self.metadata
+    if metadata_status is None:
+        # only cells whose contigs changed since the last build are recomputed
+        options = (tuple(cols), locus_, clonekey, collapse_alleles, tuple(
+            v[3] for v in self.contig_index.chains(locus_)[0].values()))
+        try:
+            snapshot = _contig_snapshot(self.data, cols)
+        except TypeError:
+            snapshot = None
+        dirty = None
+        previous = self._metadata_snapshot
+        if (self._metadata is not None) and (previous is not None) and (snapshot is not None) and (previous['options'] == options) and not self.data['sequence_id'].duplicated().any():
+            dirty = _dirty_cells(previous['contigs'], snapshot)
         initialize_metadata(self, cols, locus_, clonekey,
-                            collapse_alleles, verbose)
+                            collapse_alleles, verbose, cells=dirty)
+        if snapshot is not None:
+            self._metadata_snapshot = {
+                'options': options, 'contigs': snapshot}
+        else:
+            self._metadata_snapshot = None
+        self._metadata_init = {'retrieve': retrieve, 'locus': locus, 'clone_key': clone_key, 'split': split, 'collapse': collapse, 'combine': combine,
+                               'split_locus': split_locus, 'collapse_alleles': collapse_alleles, 'verbose': verbose}
 
     tmp_metadata = self.metadata.copy()
 
     if retrieve is not None:
-        ret_dict = {}
         if type(retrieve) is str:
             retrieve = [retrieve]
-        for ret in retrieve:
-            ret_dict.update({ret: {'split': split, 'collapse': collapse,
-                                   'combine': combine, 'locus': locus_, 'split_locus': split_locus}})
+        retrieve = list(dict.fromkeys(retrieve))
 
         vdj_gene_ret = ['v_call', 'd_call', 'j_call']
 
-        retrieve_ = defaultdict(dict)
-        for k, v in ret_dict.items():
-            if k in self.data.columns:
-                retrieve_[k] = retrieve_metadata(
-                    self.data, query=k, verbose=verbose, **v)
-            else:
+        for k in retrieve:
+            if k not in self.data.columns:
                 raise KeyError(
                     'Cannot retrieve \'%s\' : Unknown column name.' % k)
-        ret_metadata = pd.concat(retrieve_.values(), axis=1, join="inner")
+        ret_metadata = retrieve_metadata(self, query=retrieve, split=split, collapse=collapse, combine=combine, locus=locus_, split_locus=split_locus, verbose=verbose)
 
         if collapse_alleles:
-            for k in ret_dict.keys():
+            def _collapse_alleles(t):
+                return('|'.join(['|'.join(list(set(yy.split(',')))) for yy in list(set(
+                    [re.sub('[*][0-9][0-9]', '', tx) for tx in t.split('|')]))]))
+            for k in retrieve:
                 if k in vdj_gene_ret:
                     for c in ret_metadata:
                         if k in c:
-                            ret_metadata[c] = ['|'.join(['|'.join(list(set(yy.split(',')))) for yy in list(set(
-                                [re.sub('[*][0-9][0-9]', '', tx) for tx in t.split('|')]))]) for t in ret_metadata[c]]
+                            ret_metadata[c] = _map_unique(
+                                ret_metadata[c], _collapse_alleles)
 
         for r in ret_metadata:
             tmp_metadata[r] = pd.Series(ret_metadata[r])
-        self.metadata = tmp_metadata.copy()
+        self._metadata = tmp_metadata.copy()
+        if self._metadata_derived is not None:
+            self._metadata_derived = self._metadata_derived + \
+                [r for r in ret_metadata if r not in self._metadata_derived]
@@ -5,6 +5,11 @@
 # @Last Modified time: 2021-04-03 11:55:58
 
 import os
+import json
+import functools
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 import scipy.sparse
@@ -13,8 +18,10 @@ import bz2
 import gzip
 import _pickle as cPickle
 from ..utilities._utilities import *
+from ..utilities._utilities import _restore_dtypes
 from ..utilities._core import *
-from typing import Union, Sequence, Tuple
+from ..utilities._core import _LazySlot, _pkl_threads, _try_initialize
+from typing import Union, Sequence, Tuple, Dict, Iterator
 
 
 def fasta_iterator(fh: str):
@@ -50,51 +57,101 @@ def Write_output(out: str, file: str):
     return()
 
 
-def load_data(obj: Union[pd.DataFrame, str]) -> pd.DataFrame:
+def load_data(obj: Union[pd.DataFrame, str], compact: bool = False, usecols: Union[None, Sequence] = None, chunksize: Union[None, int] = None, schema: Union[None, Dict] = None, engine: Literal['c', 'python', 'pyarrow'] = 'c') -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
     """
     Reads in or copy dataframe object and set sequence_id as index without dropping.
 
     Parameters
     ----------
     obj : DataFrame, str
-        file path to .tsv file or pandas DataFrame object.
+        file path to .tsv file, which can be gzip (`.gz`) or bzip2 (`.pbz2`, `.bz2`) compressed, or pandas DataFrame object.
+    compact : bool
+        whether to store the AIRR columns in compact dtypes. See `compact_data`.
+    usecols : Sequence, optional
+        columns to read. `sequence_id` is always read and columns that are not in the input are ignored. Defaults to all columns.
+    chunksize : int, optional
+        if given, returns an iterator over tables of `chunksize` contigs rather than a single table, so that large files can be processed without reading them into memory at once.
+    schema : dict, optional
+        mapping of column names to AIRR types, 'string', 'boolean', 'integer' or 'number'. String columns are read as strings without type inference. Defaults to `AIRR_SCHEMA`.
+    engine : str
+        parser passed to `pd.read_csv`. 'pyarrow' is faster for large files if it is installed, but cannot read in chunks.
 
     Returns
     -------
-    pandas DataFrame object.
+    pandas DataFrame object, or an iterator of pandas DataFrame objects if `chunksize` is given.
     """
+    if usecols is not None:
+        usecols = ['sequence_id'] + [c for c in usecols if c != 'sequence_id']
+
     if os.path.isfile(str(obj)):
-        try:
-            obj_ = pd.read_csv(obj, sep='\t')
-        except FileNotFoundError as e:
-            print(e)
+        if schema is None:
+            schema = AIRR_SCHEMA
+        dtype = {k: str for k, kind in schema.items() if kind == 'string'}
+        if compact:
+            # categoricals are built while parsing rather than from object columns
+            dtype.update({k: 'category' for k, kind in COMPACT_SCHEMA.items()
+                          if kind == 'category' and schema.get(k, 'string') == 'string'})
+        if isBZIP(str(obj)) or str(obj).endswith('.bz2'):
+            compression = 'bz2'
+        elif isGZIP(str(obj)):
+            compression = 'gzip'
+        else:
+            compression = None
+        if usecols is not None:
+            header = pd.read_csv(obj, sep='\t', nrows=0,
+                                 compression=compression).columns
+            usecols = [c for c in header if c in usecols]
+            dtype = {k: v for k, v in dtype.items() if k in usecols}
+        obj_ = pd.read_csv(obj, sep='\t', dtype=dtype, compression=compression,
+                           engine=engine, chunksize=chunksize, usecols=usecols)
     elif isinstance(obj, pd.DataFrame):
-        obj_ = obj.copy()
+        if usecols is not None:
+            obj = obj[[c for c in usecols if c in obj]]
+        if chunksize is None:
+            obj_ = obj.copy()
+        else:
+            obj_ = (obj.iloc[i:i + chunksize].copy()
+                    for i in range(0, obj.shape[0], chunksize))
     else:
         raise TypeError(
             "Either input is not of <class 'pandas.core.frame.DataFrame'> or file does not exist.")
 
+    if chunksize is not None:
+        return(_format_data(chunk, compact) for chunk in obj_)
+    return(_format_data(obj_, compact))
+
+
+def _format_data(obj_: pd.DataFrame, compact: bool = False) -> pd.DataFrame:
     if 'sequence_id' in obj_.columns:
         obj_.set_index('sequence_id', drop=False, inplace=True)
     else:
         raise KeyError("'sequence_id' not found in columns of input")
 
+    if compact:
+        obj_ = compact_data(obj_)
+
     return(obj_)
 
 
-def read_pkl(filename: str = 'dandelion_data.pkl.pbz2') -> Dandelion:
+def read_pkl(filename: str = 'dandelion_data.pkl.pbz2', ncpu: Union[None, int] = None) -> Dandelion:
     """
     Reads in and returns a `Dandelion` class saved using pickle format.
 
     Parameters
     ----------
     filename : str
-        path to `.pkl` file. Depending on the extension, it will try to unzip accordingly.
+        path to `.pkl` file. Depending on the extension, it will try to unzip accordingly. Both the block compressed files written by `write_pkl` and single bz2 or gzip streams are read.
+    ncpu : int, optional
+        number of threads to decompress with. Defaults to the number of cpus minus one.
 
     Returns
     -------
     Dandelion object.
     """
+    with open(filename, 'rb') as f:
+        if f.read(len(PKL_MAGIC)) == PKL_MAGIC:
+            return(_read_pkl_blocks(f, _pkl_threads(ncpu)))
+    # files written as a single compressed stream
     if isBZIP(filename):
         data = bz2.BZ2File(filename, 'rb')
         data = cPickle.load(data)
@@ -107,7 +164,37 @@ def read_pkl(filename: str = 'dandelion_data.pkl.pbz2') -> Dandelion:
     return(data)
 
 
-def read_h5(filename: str = 'dandelion_data.h5') -> Dandelion:
+def _read_pkl_blocks(f, ncpu: int) -> Dandelion:
+    # reads a file written by `_write_pkl_blocks`, decompressing the blocks in threads straight into their segments
+    f.seek(-len(PKL_MAGIC) - 8, 2)
+    length = int.from_bytes(f.read(8), 'little')
+    f.seek(-len(PKL_MAGIC) - 8 - length, 2)
+    index = json.loads(f.read(length))
+    decompress = bz2.decompress if index['codec'] == 'bz2' else gzip.decompress
+    segments = [bytearray(size) for size in index['segments']]
+    views = [memoryview(segment) for segment in segments]
+
+    def _fill(block, i, start, size):
+        views[i][start:start + size] = decompress(block)
+
+    f.seek(len(PKL_MAGIC))
+    with ThreadPoolExecutor(ncpu) as pool:
+        pending = deque()
+        for i, start, size, length in index['blocks']:
+            pending.append(pool.submit(
+                _fill, f.read(length), i, start, size))
+            while len(pending) > 2 * ncpu:
+                pending.popleft().result()
+        for p in pending:
+            p.result()
+    for view in views:
+        view.release()
+    if len(segments) == 1:
+        return(cPickle.loads(segments[0]))
+    return(cPickle.loads(segments[0], buffers=segments[1:]))
+
+
+def read_h5(filename: str = 'dandelion_data.h5', slots: Union[None, str, Sequence] = None, lazy: bool = False, cells: Union[None, Sequence] = None, samples: Union[None, Sequence] = None) -> Dandelion:
     """
     Reads in and returns a `Dandelion` class from .h5 format.
 
@@ -115,99 +202,474 @@ def read_h5(filename: str = 'dandelion_data.h5') -> Dandelion:
     ----------
     filename : str
         path to `.h5` file
+    slots : str, Sequence, optional
+        slots to read, out of 'data', 'metadata', 'distance', 'edges', 'layout', 'graph' and 'germline'. Defaults to all of them.
+    lazy : bool
+        whether to read each slot on first access rather than immediately.
+    cells : Sequence, optional
+        only read the contigs, metadata and network of these cells. The distance matrices are not read for a subset of cells.
+    samples : Sequence, optional
+        only read the contigs, metadata and network of the cells of these `sample_id`s.
 
     Returns
     -------
     `Dandelion` object.
     """
-    try:
-        data = pd.read_hdf(filename, 'data')
-    except:
-        raise AttributeError(
-            '{} does not contain attribute `data`'.format(filename))
-    try:
-        metadata = pd.read_hdf(filename, 'metadata')
-    except:
-        pass
+    slots = _check_slots(slots)
+
+    with h5py.File(filename, 'r') as hf:
+        if 'data' not in hf:
+            raise AttributeError(
+                '{} does not contain attribute `data`'.format(filename))
+        stored = [slot for slot in slots if slot in hf or slot in [
+            'distance', 'germline']]
+        try:
+            threshold = float(np.array(hf['threshold']))
+        except:
+            threshold = None
+
+    if cells is not None or samples is not None:
+        rows = _H5Rows(filename, cells, samples)
+        # the distance matrices are positional
+        stored = [slot for slot in stored if slot != 'distance']
+    else:
+        rows = None
+
+    constructor = {}
+    for slot in stored:
+        if lazy:
+            constructor[slot] = _LazySlot(functools.partial(_read_h5_slot, filename, slot, rows),
+                                          _h5_nrows(filename, slot) if rows is None else None)
+        else:
+            value = _read_h5_slot(filename, slot, rows)
+            if value is not None:
+                constructor[slot] = value
+
+    res = _build_dandelion(constructor, lazy)
+    res.threshold = threshold
+    if rows is None:
+        # for `write_h5(..., mode='update')`
+        res._h5_record(filename)
+    return(res)
+
+
+def _check_slots(slots: Union[None, str, Sequence]) -> Sequence:
+    if slots is None:
+        slots = H5_SLOTS
+    elif type(slots) is str:
+        slots = [slots]
+    for slot in slots:
+        if slot not in H5_SLOTS:
+            raise ValueError(
+                "Unknown slot '{}'. Please choose from {}.".format(slot, ', '.join(H5_SLOTS)))
+    return(slots)
+
+
+def _build_dandelion(constructor: Dict, lazy: bool = False) -> Dandelion:
+    # `Dandelion` from the slots read from a file, which are `_LazySlot`s if lazy
+    if lazy:
+        res = Dandelion()
+        for slot, value in constructor.items():
+            setattr(res, '_'+slot, value)
+        if 'data' in constructor and 'metadata' not in constructor:
+            res._metadata_init = {}
+            res._metadata_fallback = True
+    else:
+        res = _try_initialize(**constructor)
+    return(res)
 
-    try:
-        edges = pd.read_hdf(filename, 'edges')
-    except:
-        pass
 
+class _H5Rows:
+    """
+    Cells and samples to read from a `.h5` file.
+
+    With tables written by `write_h5(..., indexed=True)`, only the filtered columns are read to find the rows, and then only those rows are read.
+    """
+
+    def __init__(self, filename: str, cells: Union[None, Sequence] = None, samples: Union[None, Sequence] = None):
+        self.filename = filename
+        self.cell_list = None if cells is None else pd.Index(cells)
+        self.samples = samples
+        self._cells = None
+
+    def cells(self) -> pd.Index:
+        """
+        Selected cells. Samples are looked up in the metadata, or in the contigs if there is no metadata.
+        """
+        if self._cells is None:
+            if self.samples is None:
+                self._cells = self.cell_list
+            else:
+                try:
+                    meta = self.select('metadata', [('sample_id', self.samples)])
+                    cells = meta.index
+                except:
+                    data = self.select('data', [('sample_id', self.samples)])
+                    cells = pd.Index(data['cell_id'].unique())
+                if self.cell_list is not None:
+                    cells = cells[cells.isin(self.cell_list)]
+                self._cells = cells
+        return(self._cells)
+
+    def select(self, key: str, filters: Union[None, Sequence] = None) -> pd.DataFrame:
+        """
+        Rows of a table matching all filters, given as (column, values) pairs. Defaults to the selected cells and samples.
+        """
+        if filters is None:
+            if key == 'data':
+                filters = [('cell_id', self.cell_list), ('sample_id', self.samples)]
+            else:
+                filters = [('index', self.cells())]
+        filters = [(c, v) for c, v in filters if v is not None]
+        with pd.HDFStore(self.filename, mode='r') as store:
+            storer = store.get_storer(key)
+            if storer.is_table and all(c == 'index' or c in storer.data_columns for c, v in filters):
+                keep = np.ones(storer.nrows, dtype=bool)
+                for c, v in filters:
+                    keep &= store.select_column(key, c).isin(v).values
+                return(store.select(key, where=np.flatnonzero(keep)))
+            table = store.select(key)
+        keep = np.ones(table.shape[0], dtype=bool)
+        for c, v in filters:
+            values = table.index if c == 'index' else table[c]
+            keep &= values.isin(v)
+        return(table[keep])
+
+
+def _h5_nrows(filename: str, slot: str) -> Union[None, int]:
+    # number of rows of a stored table, from its attributes rather than the table itself
+    if slot not in ['data', 'metadata']:
+        return(None)
     try:
-        g_0 = pd.read_hdf(filename, 'graph/graph_0')
-        g_1 = pd.read_hdf(filename, 'graph/graph_1')
-        g_0 = g_0 + 1
-        g_0 = g_0.fillna(0)
-        g_1 = g_1 + 1
-        g_1 = g_1.fillna(0)
-        graph0 = nx.from_pandas_adjacency(g_0)
-        graph1 = nx.from_pandas_adjacency(g_1)
-        for u, v, d in graph0.edges(data=True):
-            d['weight'] = d['weight']-1
-        for u, v, d in graph1.edges(data=True):
-            d['weight'] = d['weight']-1
-        graph = (graph0, graph1)
+        with pd.HDFStore(filename, mode='r') as store:
+            storer = store.get_storer(slot)
+            return(int(storer.nrows if storer.is_table else storer.shape[0]))
     except:
-        pass
+        return(None)
 
-    with h5py.File(filename, 'r') as hf:
-        try:
-            layout0 = {}
-            for k in hf['layout/layout_0'].attrs.keys():
-                layout0.update({k: np.array(hf['layout/layout_0'].attrs[k])})
-            layout1 = {}
-            for k in hf['layout/layout_1'].attrs.keys():
-                layout1.update({k: np.array(hf['layout/layout_1'].attrs[k])})
-            layout = (layout0, layout1)
-        except:
-            pass
 
-        germline = {}
+def _read_h5_slot(filename: str, slot: str, rows: Union[None, _H5Rows] = None):
+    # reads a single slot of a `.h5` file written by `Dandelion.write_h5`, None if it is not stored
+    if slot in ['data', 'metadata']:
         try:
-            for g in hf['germline'].attrs:
-                germline.update({g: hf['germline'].attrs[g]})
+            if rows is not None:
+                table = rows.select(slot)
+            else:
+                table = pd.read_hdf(filename, slot)
         except:
-            pass
+            return(None)
+        return(_restore_h5_dtypes(filename, slot, table))
 
-        distance = Tree()
+    if slot == 'edges':
         try:
-            for d in hf['distance'].keys():
-                d_ = pd.read_hdf(filename, 'distance/'+d)
-                distance[d] = scipy.sparse.csr_matrix(d_.values)
+            edges = pd.read_hdf(filename, 'edges')
         except:
-            pass
+            return(None)
+        if rows is not None:
+            cells = rows.cells()
+            edges = edges[edges['source'].isin(cells) & edges['target'].isin(cells)]
+        return(edges)
+
+    if slot == 'graph':
+        with h5py.File(filename, 'r') as hf:
+            if 'graph/graph_0/nodes' in hf:
+                graph = tuple(_read_graph(hf['graph/graph_'+str(i)])
+                              for i in range(2))
+        if 'graph' not in locals():
+            # files written with dense adjacency matrices
+            try:
+                g_0 = pd.read_hdf(filename, 'graph/graph_0')
+                g_1 = pd.read_hdf(filename, 'graph/graph_1')
+                g_0 = g_0 + 1
+                g_0 = g_0.fillna(0)
+                g_1 = g_1 + 1
+                g_1 = g_1.fillna(0)
+                graph0 = nx.from_pandas_adjacency(g_0)
+                graph1 = nx.from_pandas_adjacency(g_1)
+                for u, v, d in graph0.edges(data=True):
+                    d['weight'] = d['weight']-1
+                for u, v, d in graph1.edges(data=True):
+                    d['weight'] = d['weight']-1
+                graph = (graph0, graph1)
+            except:
+                return(None)
+        if rows is not None:
+            cells = rows.cells()
+            graph = tuple(g.subgraph([c for c in cells if c in g]).copy()
+                          for g in graph)
+        return(graph)
 
-        try:
-            threshold = np.float(np.array(hf['threshold']))
-        except:
-            threshold = None
+    with h5py.File(filename, 'r') as hf:
+        if slot == 'layout':
+            try:
+                layout0 = {}
+                for k in hf['layout/layout_0'].attrs.keys():
+                    layout0.update(
+                        {k: np.array(hf['layout/layout_0'].attrs[k])})
+                layout1 = {}
+                for k in hf['layout/layout_1'].attrs.keys():
+                    layout1.update(
+                        {k: np.array(hf['layout/layout_1'].attrs[k])})
+                layout = (layout0, layout1)
+            except:
+                return(None)
+            if rows is not None:
+                cells = rows.cells()
+                layout = tuple({k: l[k] for k in cells if k in l}
+                               for l in layout)
+            return(layout)
+
+        if slot == 'germline':
+            germline = {}
+            try:
+                for g in hf['germline'].attrs:
+                    germline.update({g: hf['germline'].attrs[g]})
+            except:
+                pass
+            return(germline)
+
+        if slot == 'distance':
+            distance = Tree()
+            try:
+                for d in hf['distance'].keys():
+                    if 'indptr' in hf['distance/'+d]:
+                        group = hf['distance/'+d]
+                        distance[d] = scipy.sparse.csr_matrix((group['data'][()], group['indices'][()], group['indptr'][()]), shape=tuple(
+                            group.attrs['shape']))
+                    else:
+                        d_ = pd.read_hdf(filename, 'distance/'+d)
+                        distance[d] = scipy.sparse.csr_matrix(d_.values)
+            except:
+                pass
+            return(distance)
+
+
+def query_h5(filename: str = 'dandelion_data.h5', where: Union[None, str, Sequence] = None, slot: Literal['data', 'metadata'] = 'data', columns: Union[None, Sequence] = None) -> pd.DataFrame:
+    """
+    Reads the rows of the contig or metadata table of a `.h5` file that match a query.
+
+    Queries can use the index and the columns written as data columns, i.e. `sample_id`, `cell_id`, `clone_id` and `locus` of files written with `write_h5(..., indexed=True)`. The indexes of these columns are used, so only the matching rows are read.
+
+    Parameters
+    ----------
+    filename : str
+        path to `.h5` file
+    where : str, Sequence, optional
+        query passed to `pd.HDFStore.select`, e.g. "sample_id == 'donor1' & locus == 'IGH'". Defaults to all rows.
+    slot : str
+        table to query, 'data' or 'metadata'.
+    columns : Sequence, optional
+        columns to return. Defaults to all columns.
+
+    Returns
+    -------
+    pandas DataFrame object.
+    """
+    with pd.HDFStore(filename, mode='r') as store:
+        if slot not in store:
+            raise AttributeError(
+                '{} does not contain attribute `{}`'.format(filename, slot))
+        if not store.get_storer(slot).is_table:
+            raise ValueError(
+                "`{}` of {} can only be queried if it was written with format='table'.".format(slot, filename))
+        table = store.select(slot, where=where, columns=columns)
+    return(_restore_h5_dtypes(filename, slot, table))
+
+
+def _restore_h5_dtypes(filename: str, slot: str, table: pd.DataFrame) -> pd.DataFrame:
+    with h5py.File(filename, 'r') as hf:
+        if 'compact_dtypes' in hf[slot].attrs:
+            table = _restore_dtypes(table, json.loads(
+                hf[slot].attrs['compact_dtypes']))
+    return(table)
+
+
+def _read_graph(group: h5py.Group) -> nx.Graph:
+    G = _graph_from_edges(group['nodes'].asstr()[()], group['source'][()], group['target'][()], group['weight'][()])
+    G.graph.update({k: v.item() if isinstance(v, np.generic) else v for k, v in group.attrs.items()})
+    return(G)
+
+
+def _graph_from_edges(nodes: np.ndarray, source: np.ndarray, target: np.ndarray, weight: np.ndarray) -> nx.Graph:
+    # edges are given as positions in `nodes`, with nan for edges without a weight
+    nodes = np.asarray(nodes)
+    G = nx.Graph()
+    G.add_nodes_from(nodes)
+    for u, v, w in zip(nodes[source], nodes[target], weight):
+        if w == w:
+            G.add_edge(u, v, weight=w)
+        else:
+            G.add_edge(u, v)
+    return(G)
+
+
+def read_store(dirname: str = 'dandelion_data.ddl', slots: Union[None, str, Sequence] = None, lazy: bool = True, columns: Union[None, Sequence] = None, mmap: bool = True, allow_pickle: bool = False) -> Dandelion:
+    """
+    Reads in and returns a `Dandelion` class from a store directory written by `write_store`.
+
+    Parameters
+    ----------
+    dirname : str
+        path to the store directory.
+    slots : str, Sequence, optional
+        slots to read, out of 'data', 'metadata', 'distance', 'edges', 'layout', 'graph' and 'germline'. Defaults to all of them.
+    lazy : bool
+        whether to read each slot on first access rather than immediately.
+    columns : Sequence, optional
+        columns of `.data` to read. `sequence_id` and `cell_id` are always read. Defaults to all columns.
+    mmap : bool
+        whether to memory-map the numeric columns, category codes, distance matrices and graph arrays rather than reading them into memory. The mapping is copy-on-write, so changes to the returned object are never written to the store. String columns are always decoded into memory.
+    allow_pickle : bool
+        whether to read columns of python objects other than strings, numbers and booleans, which `write_store` pickles. Loading a pickle can run arbitrary code, so only set this for stores from trusted sources.
+
+    Returns
+    -------
+    `Dandelion` object.
+    """
+    slots = _check_slots(slots)
+    manifest_file = os.path.join(dirname, 'manifest.json')
+    if not os.path.isfile(manifest_file):
+        raise FileNotFoundError(
+            '{} is not a dandelion store: manifest.json not found.'.format(dirname))
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    if manifest.get('version', 0) > STORE_VERSION:
+        raise ValueError(
+            '{} was written by a newer version of dandelion. Please update dandelion to read it.'.format(dirname))
+    if columns is not None:
+        columns = ['sequence_id', 'cell_id'] + \
+            [c for c in columns if c not in ['sequence_id', 'cell_id']]
 
     constructor = {}
-    constructor['data'] = data
-    if 'metadata' in locals():
-        constructor['metadata'] = metadata
-    if 'germline' in locals():
-        constructor['germline'] = germline
-    if 'edges' in locals():
-        constructor['edges'] = edges
-    if 'distance' in locals():
-        constructor['distance'] = distance
-    if 'layout' in locals():
-        constructor['layout'] = layout
-    if 'graph' in locals():
-        constructor['graph'] = graph
-    try:
-        res = Dandelion(**constructor)
-    except:
-        res = Dandelion(**constructor, initialize=False)
+    for slot in slots:
+        if slot in manifest['slots']:
+            load = functools.partial(_read_store_slot, dirname, slot, manifest['slots'][slot],
+                                     columns if slot == 'data' else None, mmap, allow_pickle)
+            constructor[slot] = _LazySlot(load, manifest['slots'][slot].get(
+                'nrows')) if lazy else load()
+
+    res = _build_dandelion(constructor, lazy)
+    res.threshold = manifest['threshold']
+    return(res)
+
+
+def _read_store_slot(dirname: str, slot: str, entry: Dict, columns: Union[None, Sequence] = None, mmap: bool = True, allow_pickle: bool = False):
+    # reads a single slot of a store directory written by `Dandelion.write_store`
+    def _array(path):
+        return(np.load(os.path.join(dirname, path), mmap_mode='c' if mmap else None))
 
-    if 'threshold' in locals():
-        res.threshold = threshold
+    if slot in ['data', 'metadata', 'edges']:
+        index = _read_store_column(
+            dirname, entry['index'], mmap, allow_pickle)
+        stored = entry['columns']
+        if columns is not None:
+            stored = [c for c in stored if c['name'] in columns]
+        table = pd.DataFrame({i: _read_store_column(dirname, c, mmap, allow_pickle) for i, c in enumerate(stored)},
+                             index=pd.Index(index, name=entry['index']['name']), copy=False)
+        table.columns = [c['name'] for c in stored]
+        return(table)
+
+    if slot == 'distance':
+        distance = Tree()
+        for m in entry['matrices']:
+            distance[m['name']] = scipy.sparse.csr_matrix(
+                (_array(m['data']), _array(m['indices']), _array(m['indptr'])), shape=tuple(m['shape']))
+        return(distance)
+
+    if slot == 'graph':
+        graph = tuple(_graph_from_edges(_read_store_column(dirname, g['nodes'], mmap), _array(g['source']), _array(g['target']), _array(g['weight'])) for g in entry['graphs'])
+        for G, g in zip(graph, entry['graphs']):
+            G.graph.update(g.get('attrs', {}))
+        return(graph)
+
+    if slot == 'layout':
+        layout = []
+        for l in entry['layouts']:
+            coords = _array(l['coords'])
+            layout.append({n: np.array(coords[i]) for i, n in enumerate(
+                _read_store_column(dirname, l['nodes'], mmap))})
+        return(tuple(layout))
+
+    if slot == 'germline':
+        return(dict(zip(_read_store_column(dirname, entry['names'], mmap), _read_store_column(dirname, entry['sequences'], mmap))))
+
+
+# `Categorical._from_backing_data` wraps the codes without copying them in these pandas versions, others build the column with `from_codes`, which copies the codes into memory
+_PANDAS_VERSION = tuple(int(x) for x in pd.__version__.split('.')[:2])
+_WRAP_CODES = (1, 4) <= _PANDAS_VERSION < (3, 0)
+
+
+def _read_store_column(dirname: str, entry: Dict, mmap: bool = True, allow_pickle: bool = False):
+    # values of a column written by `_write_store_column`
+    def _array(path):
+        return(np.load(os.path.join(dirname, path), mmap_mode='c' if mmap else None))
+
+    encoding = entry['encoding']
+    if encoding == 'array':
+        return(_array(entry['values']))
+    if encoding == 'category':
+        codes = _array(entry['codes'])
+        dtype = pd.CategoricalDtype(pd.Index(_read_store_column(
+            dirname, entry['categories'], mmap, allow_pickle)), ordered=entry['ordered'])
+        empty = pd.Categorical([], dtype=dtype)
+        if mmap and _WRAP_CODES and codes.dtype == empty.codes.dtype:
+            # keeps the codes memory-mapped, as a plain ndarray view so the column compares equal to one read into memory
+            return(empty._from_backing_data(codes.view(np.ndarray)))
+        return(pd.Categorical.from_codes(codes, dtype=dtype))
+    if encoding == 'masked':
+        return(pd.api.types.pandas_dtype(entry['dtype']).construct_array_type()(_array(entry['values']), _array(entry['mask'])))
+    if encoding == 'string':
+        with open(os.path.join(dirname, entry['bytes']), 'rb') as f:
+            raw = f.read()
+        offsets = np.load(os.path.join(dirname, entry['offsets'])).tolist()
+        if entry['ascii']:
+            # byte offsets are character offsets
+            raw = raw.decode('ascii')
+            values = [raw[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+        else:
+            values = [raw[a:b].decode('utf-8')
+                      for a, b in zip(offsets[:-1], offsets[1:])]
+        values = np.array(values, dtype=object)
+        values[np.load(os.path.join(dirname, entry['mask']))] = np.nan
+        return(values)
+    if encoding == 'mixed':
+        values = _read_store_column(dirname, entry['text'], mmap)
+        kinds = np.load(os.path.join(dirname, entry['kinds']))
+        for kind, cast in [(2, int), (3, float), (4, lambda x: x == 'True')]:
+            rows = np.flatnonzero(kinds == kind)
+            values[rows] = [cast(x) for x in values[rows]]
+        return(values)
+    if not allow_pickle:
+        raise ValueError("{} holds a column of python objects, which is pickled. Loading a pickle can run arbitrary code, so please only read stores from trusted sources with `read_store(..., allow_pickle=True)`.".format(dirname))
+    return(np.load(os.path.join(dirname, entry['values']), allow_pickle=True))
+
+
+def convert_to_store(filename: str, dirname: Union[None, str] = None) -> str:
+    """
+    Converts a `Dandelion` class saved with `write_h5` or `write_pkl` to a store directory read by `read_store`.
+
+    Parameters
+    ----------
+    filename : str
+        path to `.h5` or `.pkl` file.
+    dirname : str, optional
+        path to the store directory. Defaults to `filename` with its extensions replaced by `.ddl`.
+
+    Returns
+    -------
+    path to the store directory.
+    """
+    if dirname is None:
+        root, ext = os.path.splitext(filename)
+        while ext in ['.h5', '.hdf5', '.pkl', '.pbz2', '.gz']:
+            root, ext = os.path.splitext(root)
+        dirname = root + ext + '.ddl'
+    if h5py.is_hdf5(filename):
+        vdj = read_h5(filename)
     else:
-        pass
-    return(res)
+        vdj = read_pkl(filename)
+    vdj.write_store(dirname)
+    return(dirname)
 
 
 def read_10x_airr(file: str) -> Dandelion:
@@ -225,25 +687,102 @@ def read_10x_airr(file: str) -> Dandelion:
 
     """
     dat = load_data(file)
-    # get all the v,d,j,c calls
     if 'locus' not in dat:
-        tmp = [(v, d, j, c) for v, d, j, c in zip(
-            dat['v_call'], dat['d_call'], dat['j_call'], dat['c_call'])]
-        locus = []
-        for t in tmp:
-            if all('IGH' in x for x in t if x == x):
-                locus.append('IGH')
-            elif all('IGK' in x for x in t if x == x):
-                locus.append('IGK')
-            elif all('IGL' in x for x in t if x == x):
-                locus.append('IGL')
-            else:
-                locus.append(np.nan)
-        dat['locus'] = locus
+        dat['locus'] = _infer_locus(dat)
 
     return(Dandelion(dat))
 
 
+def _infer_locus(dat: pd.DataFrame) -> np.ndarray:
+    # the locus that all of the v, d, j and c calls of a contig belong to, nan if they disagree
+    calls = [dat[c] for c in ['v_call', 'd_call', 'j_call', 'c_call'] if c in dat]
+    loci = np.full(dat.shape[0], np.nan, dtype=object)
+    # in reverse, so that IGH takes precedence as contigs without any calls match all loci
+    for locus in ['IGL', 'IGK', 'IGH']:
+        mask = np.ones(dat.shape[0], dtype=bool)
+        for values in calls:
+            mask &= (values.isna() | values.astype(str).str.contains(
+                locus, regex=False)).values
+        loci[mask] = locus
+    return(loci)
+
+
+def read_samples(files: Union[Sequence, Dict], sample_ids: Union[None, Sequence] = None, prefix: bool = True, sep: str = '_', compact: bool = False, usecols: Union[None, Sequence] = None, ncpu: Union[None, int] = None) -> Dandelion:
+    """
+    Reads the AIRR .tsv files of several samples, e.g. 10x `airr_rearrangement.tsv` files, and returns a single `Dandelion` object.
+
+    The files are read in parallel. The `locus` of each contig is inferred from its gene calls for files without a `locus` column, as in `read_10x_airr`, and all samples are combined in a single concatenation.
+
+    Parameters
+    ----------
+    files : Sequence, dict
+        paths to the .tsv files, or a dictionary of sample ids to paths.
+    sample_ids : Sequence, optional
+        sample ids of the files. Defaults to the keys of `files` if it is a dictionary, or to the file names without extensions.
+    prefix : bool
+        whether to prefix the `cell_id` and `sequence_id` of each contig with its sample id, so that barcodes of different samples do not collide.
+    sep : str
+        separator between the sample id and the barcode.
+    compact : bool
+        whether to store the AIRR columns in compact dtypes. See `compact_data`.
+    usecols : Sequence, optional
+        columns to read, passed to `load_data` together with the columns used to infer `locus` and prefix barcodes. Defaults to all columns.
+    ncpu : int, optional
+        number of processes to read the files with. Defaults to the number of cpus minus one.
+
+    Returns
+    -------
+    `Dandelion` object, with the sample id of each contig in `sample_id`.
+    """
+    if isinstance(files, dict):
+        sample_ids, files = list(files.keys()), list(files.values())
+    files = [str(f) for f in files]
+    if sample_ids is None:
+        sample_ids = [os.path.basename(f).split('.')[0] for f in files]
+    sample_ids = [str(s) for s in sample_ids]
+    if len(sample_ids) != len(files):
+        raise ValueError('Please provide one sample id per file.')
+    if len(set(sample_ids)) < len(sample_ids):
+        raise ValueError(
+            'Sample ids are not unique. Please provide them with `sample_ids` or as a dictionary of files.')
+
+    if ncpu is None:
+        ncpu = max(multiprocessing.cpu_count() - 1, 1)
+    ncpu = min(int(ncpu), len(files))
+    args = [(f, s, prefix, sep, usecols) for f, s in zip(files, sample_ids)]
+    if ncpu > 1:
+        with multiprocessing.Pool(ncpu) as p:
+            tables = p.map(_read_sample, args)
+    else:
+        tables = [_read_sample(a) for a in args]
+
+    dat = pd.concat(tables)
+    del tables
+    if not dat.index.is_unique:
+        raise ValueError(
+            'Some sequence_ids occur in several samples. Please read them with `prefix=True`.')
+    if compact:
+        dat = compact_data(dat)
+    return(_try_initialize(data=dat))
+
+
+def _read_sample(args: Tuple) -> pd.DataFrame:
+    # reads one file for `read_samples`
+    file, sample_id, prefix, sep, usecols = args
+    if usecols is not None:
+        usecols = list(usecols) + ['cell_id', 'v_call', 'd_call', 'j_call', 'c_call', 'locus']
+    dat = load_data(file, usecols=usecols)
+    if 'locus' not in dat:
+        dat['locus'] = _infer_locus(dat)
+    if prefix:
+        dat['sequence_id'] = sample_id + sep + dat['sequence_id'].astype(str)
+        if 'cell_id' in dat:
+            dat['cell_id'] = sample_id + sep + dat['cell_id'].astype(str)
+        dat.set_index('sequence_id', drop=False, inplace=True)
+    dat['sample_id'] = sample_id
+    return(dat)
+
+
 def to_scirpy(data: Dandelion, transfer: bool = False) -> AnnData:
     """
     Converts a `Dandelion` object to scirpy's format.
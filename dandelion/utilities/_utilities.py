@@ -9,7 +9,7 @@ from collections import defaultdict, Iterable
 import pandas as pd
 import numpy as np
 from subprocess import run
-from typing import Sequence, Tuple, Dict
+from typing import Union, Sequence, Tuple, Dict
 try:
     from typing import Literal
 except ImportError:
@@ -152,6 +152,133 @@ def bh(pvalues: np.array) -> np.array:
     return new_pvalues
 
 
+# expected types of the AIRR rearrangement fields and of the fields added by dandelion
+AIRR_SCHEMA = {
+    **{k: 'string' for k in ['sequence_id', 'sequence', 'sequence_aa', 'rearrangement_id', 'repertoire_id', 'sample_processing_id', 'data_processing_id',
+                             'cell_id', 'clone_id', 'sample_id', 'locus', 'v_call', 'v_call_genotyped', 'd_call', 'd2_call', 'j_call', 'c_call',
+                             'sequence_alignment', 'sequence_alignment_aa', 'germline_alignment', 'germline_alignment_aa', 'germline_alignment_d_mask',
+                             'junction', 'junction_aa', 'np1', 'np1_aa', 'np2', 'np2_aa', 'np3', 'np3_aa',
+                             'cdr1', 'cdr1_aa', 'cdr2', 'cdr2_aa', 'cdr3', 'cdr3_aa', 'fwr1', 'fwr1_aa', 'fwr2', 'fwr2_aa', 'fwr3', 'fwr3_aa', 'fwr4', 'fwr4_aa',
+                             'v_cigar', 'd_cigar', 'd2_cigar', 'j_cigar', 'c_cigar',
+                             'v_sequence_alignment', 'v_sequence_alignment_aa', 'v_germline_alignment', 'v_germline_alignment_aa',
+                             'd_sequence_alignment', 'd_sequence_alignment_aa', 'd_germline_alignment', 'd_germline_alignment_aa',
+                             'j_sequence_alignment', 'j_sequence_alignment_aa', 'j_germline_alignment', 'j_germline_alignment_aa',
+                             'c_sequence_alignment', 'c_sequence_alignment_aa', 'c_germline_alignment', 'c_germline_alignment_aa']},
+    **{k: 'boolean' for k in ['productive', 'rev_comp', 'vj_in_frame', 'stop_codon', 'complete_vdj', 'v_frameshift', 'j_frameshift']},
+    **{k: 'integer' for k in ['umi_count', 'duplicate_count', 'consensus_count', 'junction_length', 'junction_aa_length', 'np1_length', 'np2_length', 'np3_length', 'mu_count'] +
+       [g+'_'+s+'_'+e for g in ['v', 'd', 'd2', 'j', 'c'] for s in ['sequence', 'germline', 'alignment'] for e in ['start', 'end']] +
+       [r+'_'+e for r in ['cdr1', 'cdr2', 'cdr3', 'fwr1', 'fwr2', 'fwr3', 'fwr4'] for e in ['start', 'end']]},
+    **{k: 'number' for k in [g+'_'+m for g in ['v', 'd', 'd2', 'j', 'c'] for m in ['score', 'identity', 'support']] + ['mu_freq']},
+}
+
+
+# compact dtypes of AIRR columns used by `compact_data`
+COMPACT_SCHEMA = {
+    'cell_id': 'category',
+    'sample_id': 'category',
+    'locus': 'category',
+    'productive': 'boolean',
+    'v_call': 'category',
+    'v_call_genotyped': 'category',
+    'd_call': 'category',
+    'j_call': 'category',
+    'c_call': 'category',
+    'vj_in_frame': 'boolean',
+    'stop_codon': 'boolean',
+    'complete_vdj': 'boolean',
+    'rev_comp': 'boolean',
+    'v_frameshift': 'boolean',
+    'umi_count': 'integer',
+    'duplicate_count': 'integer',
+    'consensus_count': 'integer',
+}
+
+
+def compact_data(data: pd.DataFrame, schema: Union[None, Dict] = None) -> pd.DataFrame:
+    """
+    Stores AIRR columns in compact dtypes.
+
+    Repeated strings such as gene calls, loci and cell barcodes are stored as categoricals, boolean columns with missing values as nullable booleans, and integer counts as 32-bit integers. Columns that do not fit the declared dtype are left as they are.
+
+    Parameters
+    ----------
+    data : DataFrame
+        AIRR table.
+    schema : dict, optional
+        mapping of column names to 'category', 'boolean' or 'integer'. Defaults to `COMPACT_SCHEMA`.
+
+    Returns
+    -------
+    pandas DataFrame object.
+    """
+    if schema is None:
+        schema = COMPACT_SCHEMA
+    data = data.copy()
+    for col, kind in schema.items():
+        if col in data:
+            data[col] = _compact_column(data[col], kind)
+    return(data)
+
+
+def _compact_column(values: pd.Series, kind: Literal['category', 'boolean', 'integer']) -> pd.Series:
+    if kind == 'boolean':
+        if values.dtype == object and values.dropna().map(type).isin([bool, np.bool_]).all():
+            return(values.astype('boolean'))
+        # e.g. 'T'/'F' strings
+        kind = 'category'
+    if kind == 'category':
+        if values.dtype == object:
+            return(values.astype('category'))
+    elif kind == 'integer':
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values) and not values.isna().any():
+            # int32 rather than smaller types so that sums of counts cannot overflow
+            info = np.iinfo(np.int32)
+            if (values == np.floor(values)).all() and values.min() >= info.min and values.max() <= info.max:
+                return(values.astype(np.int32))
+    return(values)
+
+
+def _plain_dtypes(data: pd.DataFrame) -> Tuple[pd.DataFrame, Dict]:
+    # compact columns as object columns for formats that cannot store them, and the dtypes to restore
+    kinds = {}
+    for col in data.columns:
+        if is_categorical(data[col]):
+            kinds[col] = 'category'
+        elif data[col].dtype.name == 'boolean':
+            kinds[col] = 'boolean'
+    if len(kinds) > 0:
+        data = data.astype({col: object for col in kinds})
+    return(data, kinds)
+
+
+def _restore_dtypes(data: pd.DataFrame, kinds: Dict) -> pd.DataFrame:
+    # missing values are written as ''
+    for col, kind in kinds.items():
+        if col in data:
+            data[col] = _compact_column(data[col].replace('', np.nan), kind)
+    return(data)
+
+
+def _h5_dtypes(data: pd.DataFrame, schema: Union[None, Dict] = None) -> pd.DataFrame:
+    # column-wise casts so that each column holds a single type for `write_h5`, with missing strings written as ''
+    if schema is None:
+        schema = AIRR_SCHEMA
+    data = data.copy()
+    for col in data.columns:
+        values = data[col]
+        if values.dtype != object or values.isna().all():
+            continue
+        kind = schema.get(col)
+        if kind in ['integer', 'number']:
+            numbers = pd.to_numeric(values.replace('', np.nan), errors='coerce')
+            if numbers.notna().sum() == values.replace('', np.nan).notna().sum():
+                data[col] = numbers
+                continue
+        if kind == 'string' or pd.api.types.infer_dtype(values, skipna=False).startswith('mixed'):
+            data[col] = values.where(values.notna(), '')
+    return(data)
+
+
 def is_categorical(array_like) -> bool:
     return array_like.dtype.name == 'category'
 
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# tests of the Dandelion class on the small AIRR table in tests/airr_small.tsv, which run without downloading data
+import os
+import numpy as np
+import pandas as pd
+import dandelion as ddl
+from dandelion.utilities._core import _Shared
+
+AIRR = os.path.join(os.path.dirname(__file__), "airr_small.tsv")
+
+
+def test_copy_on_write():
+    vdj = ddl.Dandelion(AIRR)
+    copied = vdj.copy()
+    # the slots are shared until one of the objects hands them out
+    assert isinstance(vdj.__dict__["_data"], _Shared)
+    assert vdj.__dict__["_data"] is copied.__dict__["_data"]
+    shared = vdj.__dict__["_data"].value
+    original = shared.copy()
+    # building the metadata only reads the contigs
+    vdj.metadata
+    copied.metadata
+    assert copied.__dict__["_data"] is vdj.__dict__["_data"]
+    copied.data.loc[copied.data.index[0], "umi_count"] = 1000
+    assert copied.__dict__["_data"] is not shared
+    # the last object holding the slot takes it without copying
+    assert vdj.data is shared
+    pd.testing.assert_frame_equal(vdj.data, original)
+
+
+def test_copy_handed_out():
+    vdj = ddl.Dandelion(AIRR)
+    data = vdj.data
+    original = data.copy()
+    # frames handed out before the copy are not shared with it
+    copied = vdj.copy()
+    assert not isinstance(copied.__dict__["_data"], _Shared)
+    data.loc[data.index[0], "umi_count"] = 1000
+    pd.testing.assert_frame_equal(copied.data, original)
+    deep = vdj.copy(deep=True)
+    deep.metadata.loc[deep.metadata.index[0], "clone_id"] = "x"
+    assert vdj.metadata["clone_id"].iloc[0] != "x"
+
+
+def _edge_cases():
+    # a cell with two heavy contigs, one with light contigs only, one with a heavy contig only, one without a clone and one with an unproductive light contig
+    data = pd.read_csv(AIRR, sep="\t")
+    cells = data["cell_id"].unique()[:5]
+    extra = data[(data["cell_id"] == cells[0]) & (data["locus"] == "IGH")].copy()
+    extra["sequence_id"] = extra["sequence_id"] + "_x"
+    extra["v_call"] = "IGHV3-23*01"
+    extra["umi_count"] = 2
+    data = data[~((data["cell_id"] == cells[1]) & (data["locus"] == "IGH"))]
+    data = data[~((data["cell_id"] == cells[2]) & (data["locus"] != "IGH"))]
+    data.loc[data["cell_id"] == cells[3], "clone_id"] = np.nan
+    data.loc[(data["cell_id"] == cells[4]) & (data["locus"] != "IGH"), "productive"] = "F"
+    return pd.concat([data, extra], ignore_index=True), cells
+
+
+def test_initialize_metadata():
+    data, cells = _edge_cases()
+    metadata = ddl.Dandelion(data).metadata
+    assert list(metadata.columns) == [
+        "clone_id", "clone_id_by_size", "sample_id", "locus_heavy", "locus_light", "productive_heavy", "productive_light",
+        "v_call_heavy", "v_call_light", "j_call_heavy", "j_call_light", "c_call_heavy", "c_call_light",
+        "umi_count_heavy_0", "umi_count_heavy_1", "umi_count_light_0", "junction_aa_heavy", "junction_aa_light",
+        "status", "status_summary", "productive", "productive_summary", "isotype", "isotype_summary",
+        "vdj_status", "vdj_status_summary", "heavychain_status_summary"]
+    assert metadata.shape[0] == data["cell_id"].nunique() - 1 and cells[1] not in metadata.index
+    expected = {
+        cells[0]: {"umi_count_heavy_0": 10, "umi_count_heavy_1": 2, "status": "IGH + IGK",
+                   "vdj_status": "Multi_heavy_v + Single", "vdj_status_summary": "Multi", "isotype": "IgM"},
+        cells[2]: {"locus_light": "", "v_call_light": "", "status": "IGH_only", "productive": "T", "isotype": "IgG"},
+        cells[3]: {"clone_id": "", "clone_id_by_size": "unassigned", "status": "IGH + IGL"},
+        cells[4]: {"productive_light": "F", "productive": "T + F", "productive_summary": "T + F", "isotype": "IgA"},
+    }
+    for cell, values in expected.items():
+        for column, value in values.items():
+            assert metadata.loc[cell, column] == value, (cell, column)
+    # collapsed alleles are joined in set order
+    assert set(metadata.loc[cells[0], "v_call_heavy"].split("|")) == {"IGHV1-2", "IGHV3-23"}
+    assert np.isnan(metadata.loc[cells[2], "umi_count_light_0"])
+
+
+def test_retrieve_metadata():
+    data, cells = _edge_cases()
+    vdj = ddl.Dandelion(data)
+    data = vdj.data
+    umi = ddl.utl.retrieve_metadata(data, "umi_count", split=True, collapse=True)
+    assert list(umi.columns) == ["umi_count_heavy_0", "umi_count_heavy_1", "umi_count_light_0"]
+    assert umi.loc[cells[0]].tolist() == [10, 2, 19]
+    assert umi.loc[cells[2], "umi_count_heavy_0"] == 19 and np.isnan(umi.loc[cells[2], "umi_count_light_0"])
+    junction = ddl.utl.retrieve_metadata(data, "junction_aa", split=False, collapse=True)
+    assert junction.loc[[cells[0], cells[2]], "junction_aa"].tolist() == ["CAR0|CQQ0", "CAR1"]
+    junction = ddl.utl.retrieve_metadata(data, "junction_aa", split=True, collapse=True, split_locus=True)
+    assert list(junction.columns) == ["junction_aa_IGH", "junction_aa_IGK", "junction_aa_IGL"]
+    assert junction.loc[cells[4]].tolist() == ["CAR5", "", "CQQ5"]
+    productive = ddl.utl.retrieve_metadata(data, "productive", split=True, collapse=True, combine=True)
+    assert productive.loc[[cells[2], cells[4]]].values.tolist() == [["T", ""], ["T", "F"]]
+    # several columns in one pass are the same as one at a time, and the index of a Dandelion object is reused
+    query = ["umi_count", "junction_aa", "productive"]
+    for kwargs in [dict(split=True, collapse=True), dict(split=False, collapse=True, combine=True), dict(split_locus=True)]:
+        expected = pd.concat([ddl.utl.retrieve_metadata(data, q, **kwargs) for q in query], axis=1)
+        pd.testing.assert_frame_equal(ddl.utl.retrieve_metadata(data, query, **kwargs), expected)
+        pd.testing.assert_frame_equal(ddl.utl.retrieve_metadata(vdj, query, **kwargs), expected)
+
+
+def test_contig_index():
+    data, cells = _edge_cases()
+    vdj = ddl.Dandelion(data)
+    index = vdj.contig_index
+    data = vdj.data
+    for cell in data["cell_id"].unique():
+        rows = index.rows(cell)
+        assert sorted(rows) == list(np.flatnonzero(data["cell_id"] == cell))
+        heavy = index.rows(cell, loci=["IGH"])
+        assert sorted(heavy) == list(np.flatnonzero((data["cell_id"] == cell) & (data["locus"] == "IGH")))
+    assert len(index.rows(cells[0], loci=["IGH"])) == 2 and len(index.rows(cells[1], loci=["IGH", "TRB"])) == 0
+    assert index.chains() is index.chains()
+    # kept while .data only changes in place, rebuilt when it is replaced or its cells or loci change
+    vdj.data.loc[vdj.data.index[0], "umi_count"] = 1000
+    assert vdj.contig_index is index
+    vdj.data["locus"] = vdj.data["locus"].copy()
+    assert vdj.contig_index is not index
+    index = vdj.contig_index
+    vdj.data = vdj.data.iloc[:-1]
+    assert vdj.contig_index is not index and vdj.contig_index.n_contigs == data.shape[0] - 1
+
+
+def test_lazy_metadata():
+    vdj = ddl.Dandelion(AIRR)
+    # nothing is computed until the metadata is used
+    assert vdj.__dict__["_metadata"] is None and vdj._metadata_init is not None
+    assert vdj.n_contigs == 76
+    assert vdj.__dict__["_metadata"] is None
+    full = ddl.Dandelion(AIRR, initialize=False)
+    assert full.metadata is None
+    ddl.update_metadata(full, reinitialize=True)
+    pd.testing.assert_frame_equal(vdj.metadata, full.metadata)
+    assert vdj.n_obs == 40
+
+
+def test_initialize_fallback(tmp_path):
+    # contigs the metadata cannot be computed from are read without metadata
+    data = ddl.load_data(AIRR).drop(columns="locus")
+    filename = str(tmp_path / "test.h5")
+    ddl.Dandelion(data, initialize=False).write_h5(filename)
+    for vdj in [ddl.read_h5(filename), ddl.read_h5(filename, lazy=True), ddl.concat([data])]:
+        assert vdj.metadata is None
+        assert vdj.n_obs == 0
+        assert vdj.n_contigs == data.shape[0]
+    # while creating an object from them fails straight away, as before the metadata was computed lazily
+    try:
+        ddl.Dandelion(data)
+        raise AssertionError("missing columns were not reported")
+    except ValueError:
+        pass
+
+
+def test_incremental_metadata(monkeypatch):
+    dirty = []
+    find = ddl.utl._core._dirty_cells
+    monkeypatch.setattr(ddl.utl._core, "_dirty_cells", lambda old, new: dirty.append(find(old, new)) or dirty[-1])
+    vdj = ddl.Dandelion(AIRR)
+    vdj.metadata["group"] = "a"
+    data = vdj.data.copy()
+    # remove the cells of a sample, change a contig of one cell and add the contigs of another
+    extra = data[data["cell_id"] == data["cell_id"].iloc[0]].copy()
+    extra["cell_id"] = "new_cell"
+    extra["sequence_id"] = "new_cell_" + extra["sequence_id"]
+    data = data[data["sample_id"] != "S2"]
+    changed = data["cell_id"].iloc[-1]
+    data.loc[data["cell_id"] == changed, "c_call"] = data.loc[data["cell_id"] == changed, "c_call"].str.replace("IGH[A-Z0-9]+cf", "IGHEmm", regex=True)
+    vdj.data = pd.concat([data, extra])
+    metadata = vdj.metadata
+    # only the changed cells were recomputed
+    removed = set(ddl.load_data(AIRR).query("sample_id == 'S2'")["cell_id"])
+    assert len(dirty) == 1 and set(dirty[0]) == {changed, "new_cell"} | removed
+    rebuilt = ddl.Dandelion(vdj.data.copy())
+    pd.testing.assert_frame_equal(metadata.drop(columns="group"), rebuilt.metadata)
+    assert metadata.loc[changed, "isotype"] == "IgE"
+    # the columns added by the user are kept, and are missing for new cells
+    assert (metadata["group"].drop("new_cell") == "a").all() and pd.isna(metadata.loc["new_cell", "group"])
+
+
+def test_concat(monkeypatch):
+    data = ddl.load_data(AIRR)
+    parts = [ddl.Dandelion(data[data["sample_id"] == s].copy()) for s in ["S0", "S1", "S2"]]
+    for part in parts:
+        part.metadata["group"] = part.metadata["sample_id"].iloc[0]
+    calls = []
+    initialize = ddl.utl._core.initialize_metadata
+    monkeypatch.setattr(ddl.utl._core, "initialize_metadata", lambda *args, **kwargs: calls.append(1) or initialize(*args, **kwargs))
+    vdj = ddl.concat(parts)
+    # the metadata of the parts are merged, and only the clone size ranks are recomputed
+    metadata = vdj.metadata
+    assert len(calls) == 0
+    assert (metadata["group"] == metadata["sample_id"]).all()
+    pd.testing.assert_frame_equal(metadata.drop(columns="group"), ddl.Dandelion(vdj.data.copy()).metadata)
+    assert vdj.n_contigs == data.shape[0]
+    # otherwise it is computed again
+    parts[0].metadata = parts[0].metadata.drop(columns="group")
+    vdj = ddl.concat(parts)
+    pd.testing.assert_frame_equal(vdj.metadata, ddl.Dandelion(vdj.data.copy()).metadata)
+    assert len(calls) > 0
+    pd.testing.assert_frame_equal(ddl.concat([p.data for p in parts]).data, vdj.data)
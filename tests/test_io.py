@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# reading and writing on the small AIRR table in tests/airr_small.tsv, which run without downloading data
+import bz2
+import json
+import os
+import pickle
+import numpy as np
+import networkx as nx
+import pandas as pd
+import dandelion as ddl
+
+AIRR = os.path.join(os.path.dirname(__file__), "airr_small.tsv")
+
+
+def _network():
+    vdj = ddl.Dandelion(AIRR)
+    ddl.tl.generate_network(vdj, verbose=False)
+    return vdj
+
+
+def _check(vdj, res):
+    # `.h5` files store missing strings as empty strings
+    pd.testing.assert_frame_equal(res.data.fillna({"d_call": ""}), vdj.data.fillna({"d_call": ""}))
+    pd.testing.assert_frame_equal(res.metadata, vdj.metadata)
+    for g, h in zip(vdj.graph, res.graph):
+        assert set(g.nodes()) == set(h.nodes())
+        assert nx.utils.edges_equal(g.edges(data=True), h.edges(data=True))
+    for k in vdj.distance:
+        assert (vdj.distance[k] != res.distance[k]).nnz == 0
+
+
+def test_store(tmp_path):
+    vdj = _network()
+    dirname = str(tmp_path / "test.ddl")
+    vdj.write_store(dirname)
+    res = ddl.read_store(dirname)
+    _check(vdj, res)
+    vdj.write_h5(str(tmp_path / "test.h5"))
+    _check(vdj, ddl.read_store(ddl.convert_to_store(str(tmp_path / "test.h5"))))
+
+
+def test_store_columns(tmp_path):
+    vdj = ddl.Dandelion(AIRR)
+    metadata = vdj.metadata.copy()
+    metadata["group"] = pd.Categorical(np.where(np.arange(metadata.shape[0]) % 2 == 0, "a", "b"))
+    metadata["mixed"] = ([1, "a", 2.5, True, None] * metadata.shape[0])[:metadata.shape[0]]
+    vdj.metadata = metadata
+    dirname = str(tmp_path / "test.ddl")
+    vdj.write_store(dirname)
+    res = ddl.read_store(dirname)
+    pd.testing.assert_series_equal(res.metadata["group"], metadata["group"])
+    # the category codes are memory-mapped
+    codes = res.metadata["group"].values.codes
+    while codes.base is not None and not isinstance(codes, np.memmap):
+        codes = codes.base
+    assert isinstance(codes, np.memmap) or type(codes).__name__ == "mmap"
+    for a, b in zip(res.metadata["mixed"], metadata["mixed"]):
+        assert (pd.isna(a) and pd.isna(b)) or (a == b and type(a) == type(b))
+    # other python objects are pickled, and only read when allowed
+    metadata["lists"] = [[1]] * metadata.shape[0]
+    vdj.metadata = metadata
+    vdj.write_store(dirname)
+    try:
+        ddl.read_store(dirname, lazy=False)
+        raise AssertionError("a pickled column was read")
+    except ValueError:
+        pass
+    assert ddl.read_store(dirname, allow_pickle=True).metadata["lists"].iloc[0] == [1]
+
+
+def test_h5_lazy(tmp_path):
+    vdj = _network()
+    vdj.threshold = 0.25
+    filename = str(tmp_path / "test.h5")
+    vdj.write_h5(filename)
+    lazy = ddl.read_h5(filename, lazy=True)
+    assert lazy.threshold == 0.25
+    # printing reads the row counts from the file, not the slots
+    assert repr(lazy).splitlines()[0] == repr(vdj).splitlines()[0]
+    assert isinstance(lazy.__dict__["_data"], ddl.utl._core._LazySlot)
+    assert isinstance(lazy.__dict__["_metadata"], ddl.utl._core._LazySlot)
+    _check(vdj, lazy)
+    selected = ddl.read_h5(filename, slots=["metadata"])
+    assert selected.data is None and selected.graph is None
+    pd.testing.assert_frame_equal(selected.metadata, vdj.metadata)
+    assert ddl.read_h5(filename).threshold == 0.25
+
+
+def test_pkl(tmp_path, monkeypatch):
+    vdj = _network()
+    for ext in ["pkl", "pkl.pbz2", "pkl.gz"]:
+        filename = str(tmp_path / ("test." + ext))
+        vdj.write_pkl(filename)
+        _check(vdj, ddl.read_pkl(filename))
+    # the pickle stream and the out-of-band arrays are cut into many blocks
+    monkeypatch.setattr(ddl.utl._core, "PKL_BLOCK_SIZE", 1000)
+    filename = str(tmp_path / "blocks.pkl.gz")
+    vdj.write_pkl(filename, ncpu=2)
+    with open(filename, "rb") as f:
+        f.seek(-len(ddl.utl._core.PKL_MAGIC) - 8, 2)
+        length = int.from_bytes(f.read(8), "little")
+        f.seek(-len(ddl.utl._core.PKL_MAGIC) - 8 - length, 2)
+        index = json.loads(f.read(length))
+    assert len(index["segments"]) > 1 and index["segments"][0] > 1000
+    assert len(index["blocks"]) == sum(-(-n // 1000) for n in index["segments"])
+    _check(vdj, ddl.read_pkl(filename, ncpu=2))
+    # files written as a single bz2 stream
+    filename = str(tmp_path / "legacy.pkl.pbz2")
+    with bz2.BZ2File(filename, "wb") as f:
+        pickle.dump(vdj, f)
+    _check(vdj, ddl.read_pkl(filename))
+
+
+def test_h5_update(tmp_path, monkeypatch):
+    filename = str(tmp_path / "test.h5")
+    vdj = _network()
+    vdj.edges = vdj.edges.reset_index()
+    edges = vdj.edges
+    versions = dict(vdj._versions)
+    vdj.write_h5(filename)
+    # writing neither changes the slots nor counts as a change of them
+    assert vdj._versions == versions and not any(vdj._changed("_" + slot) for slot in ddl.utl._core.H5_SLOTS)
+    assert vdj._peek("_edges") is edges and "index" in edges.columns
+    written = []
+    write = ddl.utl._core._write_h5_slot
+    monkeypatch.setattr(ddl.utl._core, "_write_h5_slot", lambda self, filename, slot, *args, **kwargs: (
+        written.append(slot), write(self, filename, slot, *args, **kwargs)))
+    vdj.data = vdj.data[vdj.data["sample_id"] != "S2"]
+    vdj.write_h5(filename, mode="update")
+    assert written == ["data"]
+    res = ddl.read_h5(filename)
+    pd.testing.assert_frame_equal(res.data.fillna({"d_call": ""}), vdj.data.fillna({"d_call": ""}))
+    pd.testing.assert_frame_equal(res.metadata, vdj.metadata)
+    pd.testing.assert_frame_equal(res.edges, edges.drop("index", axis=1))
+    # the metadata computed from .data changes with it
+    vdj = ddl.Dandelion(AIRR)
+    vdj.write_h5(filename)
+    vdj.data = vdj.data[vdj.data["sample_id"] != "S2"]
+    written.clear()
+    vdj.write_h5(filename, mode="update")
+    assert written == ["data", "metadata"]
+    res = ddl.read_h5(filename)
+    pd.testing.assert_frame_equal(res.metadata, vdj.metadata)
+    assert "S2" not in set(res.metadata["sample_id"])
+
+
+def test_h5_append(tmp_path):
+    data = ddl.load_data(AIRR)
+    first = ddl.Dandelion(data[data["sample_id"] != "S2"].copy())
+    second = data[data["sample_id"] == "S2"].copy()
+    second["cell_id"] = second["cell_id"] + "_longer_barcode"
+    second["sequence_id"] = second["cell_id"] + "_contig_" + second["sequence_id"].str[-1]
+    second = ddl.Dandelion(ddl.load_data(second))
+    filename = str(tmp_path / "test.h5")
+    first.write_h5(filename, indexed=True)
+    try:
+        second.write_h5(filename, mode="append")
+        raise AssertionError("longer strings were appended")
+    except ValueError:
+        pass
+    assert ddl.read_h5(filename).n_contigs == first.n_contigs
+    first.write_h5(filename, indexed=True, min_itemsize=64)
+    second.write_h5(filename, mode="append")
+    res = ddl.read_h5(filename)
+    assert res.n_contigs == first.n_contigs + second.n_contigs
+    assert res.n_obs == first.n_obs + second.n_obs
+
+
+def test_compact(tmp_path):
+    plain = ddl.load_data(AIRR)
+    data = ddl.load_data(AIRR, compact=True)
+    data["flag"] = pd.array([True, None] * (data.shape[0] // 2), dtype="boolean")
+    assert data["v_call"].dtype == "category" and data["umi_count"].dtype == np.int32
+    vdj = ddl.Dandelion(data)
+    pd.testing.assert_frame_equal(vdj.metadata, ddl.Dandelion(plain).metadata)
+    # the dtypes are restored by read_h5, and writing does not change them
+    dtypes = vdj.data.dtypes.copy()
+    filename = str(tmp_path / "test.h5")
+    vdj.write_h5(filename)
+    pd.testing.assert_series_equal(vdj.data.dtypes, dtypes)
+    for lazy in [False, True]:
+        res = ddl.read_h5(filename, lazy=lazy)
+        pd.testing.assert_frame_equal(res.data, vdj.data)
+        pd.testing.assert_frame_equal(res.metadata, vdj.metadata)
+    # concat keeps the columns categorical
+    data = data.drop(columns="flag")
+    s0 = data["sample_id"] == "S0"
+    res = ddl.concat([ddl.Dandelion(data[s0]), ddl.Dandelion(data[~s0])])
+    expected = ddl.concat([ddl.Dandelion(plain[s0]), ddl.Dandelion(plain[~s0])])
+    pd.testing.assert_frame_equal(res.data, ddl.utl.compact_data(expected.data))
+    pd.testing.assert_frame_equal(res.metadata, expected.metadata)
+
+
+def test_h5(tmp_path):
+    import h5py
+    vdj = _network()
+    filename = str(tmp_path / "test.h5")
+    vdj.write_h5(filename)
+    _check(vdj, ddl.read_h5(filename))
+    # distances are stored sparse and graphs as coded edge lists, compressed like the tables
+    with h5py.File(filename, "r") as hf:
+        assert len(vdj.distance) > 0
+        for d in vdj.distance:
+            group = hf["distance/" + str(d)]
+            assert set(group) == {"data", "indices", "indptr"}
+            assert group["data"].shape[0] == vdj.distance[d].nnz
+            assert tuple(group.attrs["shape"]) == vdj.distance[d].shape
+        graph = hf["graph/graph_0"]
+        assert set(graph) == {"nodes", "source", "target", "weight"}
+        assert graph["source"].shape[0] == vdj.graph[0].number_of_edges()
+        assert graph["nodes"].compression == "gzip"
+    vdj.write_h5(filename, compression_level=0)
+    with h5py.File(filename, "r") as hf:
+        assert hf["graph/graph_0/nodes"].compression is None
+    _check(vdj, ddl.read_h5(filename))
+
+
+def test_h5_dtypes(tmp_path):
+    from dandelion.utilities._utilities import _h5_dtypes
+    table = pd.DataFrame({
+        "d_call": ["IGHD1", np.nan, "IGHD2"],
+        "umi_count": ["3", "", 5],
+        "duplicate_count": ["3", "x", np.nan],
+        "mixed": [1, "a", np.nan],
+        "notes": ["a", np.nan, "b"],
+    })
+    res = _h5_dtypes(table)
+    # schema string fields and mixed columns get '' for missing values
+    assert res["d_call"].tolist() == ["IGHD1", "", "IGHD2"]
+    assert res["mixed"].tolist() == [1, "a", ""]
+    # schema numbers are converted when no value is lost
+    assert res["umi_count"].dtype.kind == "f" and res["umi_count"].iloc[0] == 3 and np.isnan(res["umi_count"].iloc[1])
+    assert res["duplicate_count"].dtype == object
+    # strings with missing values are mixed too, and the input is not changed
+    assert res["notes"].tolist() == ["a", "", "b"] and pd.isna(table["d_call"].iloc[1])
+    # without a schema, types are only inferred
+    res = _h5_dtypes(table, schema={})
+    assert res["umi_count"].tolist() == ["3", "", 5] and res["d_call"].tolist() == ["IGHD1", "", "IGHD2"]
+    vdj = ddl.Dandelion(AIRR)
+    missing = vdj.data["d_call"].isna().sum()
+    vdj.write_h5(str(tmp_path / "test.h5"))
+    assert missing > 0 and vdj.data["d_call"].isna().sum() == missing
+
+
+def test_h5_indexed(tmp_path):
+    vdj = ddl.Dandelion(AIRR)
+    filename = str(tmp_path / "test.h5")
+    vdj.write_h5(filename, indexed=True)
+    pd.testing.assert_frame_equal(ddl.read_h5(filename).metadata, vdj.metadata)
+    res = ddl.read_h5(filename, samples=["S0"])
+    assert set(res.data["sample_id"]) == {"S0"}
+    assert set(res.metadata.index) == set(vdj.metadata.index[vdj.metadata["sample_id"] == "S0"])
+    cells = list(vdj.metadata.index[:5])
+    res = ddl.read_h5(filename, cells=cells)
+    assert list(res.metadata.index) == cells and set(res.data["cell_id"]) == set(cells)
+    query = ddl.query_h5(filename, "locus == 'IGH'")
+    assert query.shape[0] == (vdj.data["locus"] == "IGH").sum()
+    # files without the index are read in full and filtered
+    vdj.write_h5(filename)
+    assert set(ddl.read_h5(filename, samples=["S0"]).data["sample_id"]) == {"S0"}
+
+
+def test_load_data(tmp_path):
+    data = ddl.load_data(AIRR)
+    assert data.index.equals(pd.Index(data["sequence_id"]))
+    compact = ddl.load_data(AIRR, compact=True)
+    pd.testing.assert_frame_equal(compact, ddl.utl.compact_data(data))
+    usecols = ddl.load_data(AIRR, usecols=["locus", "not_a_column"])
+    assert list(usecols.columns) == ["sequence_id", "locus"]
+    chunks = list(ddl.load_data(AIRR, chunksize=20))
+    assert [c.shape[0] for c in chunks[:-1]] == [20] * (len(chunks) - 1)
+    pd.testing.assert_frame_equal(pd.concat(chunks), data)
+    # string fields are read as strings, also when they look like numbers
+    table = pd.read_csv(AIRR, sep="\t")
+    table["clone_id"] = pd.factorize(table["clone_id"])[0].astype(str)
+    filename = str(tmp_path / "numbers.tsv.gz")
+    table.to_csv(filename, sep="\t", index=False)
+    res = ddl.load_data(filename)
+    assert res["clone_id"].tolist() == table["clone_id"].tolist()
+    assert res["umi_count"].dtype.kind == "i"
+
+
+def test_read_samples(tmp_path):
+    data = ddl.load_data(AIRR)
+    files = {}
+    for sample, table in data.groupby("sample_id"):
+        table = table.drop(columns=["sample_id", "locus"])
+        filename = str(tmp_path / (sample + ".tsv"))
+        table.to_csv(filename, sep="\t", index=False)
+        files["P" + sample] = filename
+    vdj = ddl.read_samples(files, ncpu=1)
+    assert vdj.n_contigs == data.shape[0] and vdj.n_obs == data["cell_id"].nunique()
+    assert set(vdj.data["sample_id"]) == set(files)
+    assert (vdj.data["cell_id"].str.split("_").str[0] == vdj.data["sample_id"]).all()
+    # the locus is inferred from the gene calls
+    locus = data.set_index("P" + data["sample_id"] + "_" + data["sequence_id"])["locus"]
+    assert (vdj.data["locus"] == locus.reindex(vdj.data.index)).all()
+    # reading in several processes gives the same object, and sample ids default to the file names
+    parallel = ddl.read_samples(list(files.values()), prefix=False, ncpu=2)
+    assert set(parallel.data["sample_id"]) == {"S0", "S1", "S2"}
+    pd.testing.assert_frame_equal(parallel.data, ddl.read_samples(list(files.values()), prefix=False, ncpu=1).data)
+    assert parallel.data.index.isin(data.index).all()
+    try:
+        ddl.read_samples(list(files.values()), sample_ids=["a", "a", "b"])
+        raise AssertionError("duplicated sample ids were accepted")
+    except ValueError:
+        pass
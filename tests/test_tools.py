@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# tests of the network and diversity tools on the small AIRR table in tests/airr_small.tsv, which run without downloading data
+import os
+import numpy as np
+import networkx as nx
+import pandas as pd
+import dandelion as ddl
+from dandelion.tools._network import _induced_network, _induces_groups
+
+AIRR = os.path.join(os.path.dirname(__file__), "airr_small.tsv")
+
+
+def _network():
+    vdj = ddl.Dandelion(AIRR)
+    ddl.tl.generate_network(vdj, verbose=False)
+    return vdj
+
+
+def test_induced_network():
+    vdj = _network()
+    assert _induces_groups(vdj, "sample_id", "clone_id")
+    for sample in vdj.metadata["sample_id"].unique():
+        cells = vdj.metadata.index[vdj.metadata["sample_id"] == sample]
+        induced = _induced_network(vdj, cells)
+        regenerated = ddl.Dandelion(vdj.data[vdj.data["cell_id"].isin(cells)])
+        ddl.tl.generate_network(regenerated, verbose=False)
+        for g, h in zip(induced.graph, regenerated.graph):
+            assert set(g.nodes()) == set(h.nodes())
+            assert nx.utils.edges_equal(g.edges(data=True), h.edges(data=True))
+    # the gini indices are the same as when every group's network is regenerated
+    res = ddl.tl.clone_diversity(vdj, groupby="sample_id", method="gini", update_obs_meta=False)
+    vdj.graph = None
+    expected = ddl.tl.clone_diversity(vdj, groupby="sample_id", method="gini", update_obs_meta=False)
+    pd.testing.assert_frame_equal(res, expected)
+
+
+def test_induces_groups():
+    vdj = _network()
+    metadata = vdj.metadata.copy()
+    clone = metadata["clone_id"].value_counts().index[0]
+    cells = metadata.index[metadata["clone_id"] == clone]
+    # a clone with cells in two groups
+    metadata["group"] = metadata["sample_id"].astype(object)
+    metadata.loc[cells[0], "group"] = "other"
+    vdj.metadata = metadata
+    assert not _induces_groups(vdj, "group", "clone_id")
+    # or with a cell in no group
+    metadata.loc[cells[0], "group"] = np.nan
+    vdj.metadata = metadata
+    assert not _induces_groups(vdj, "group", "clone_id")
+    assert not _induces_groups(vdj, "sample_id", "other_clone_id")
+
+
+def test_resample_counts():
+    from skbio.diversity.alpha import chao1, shannon
+    from dandelion.tools._diversity import _chao1_rows, _clone_counts, _resample_counts, _shannon_rows
+    vdj = ddl.Dandelion(AIRR)
+    counts, n_missing = _clone_counts(vdj.metadata["clone_id"])
+    draws = _resample_counts(counts, n_missing, 10, 20, np.random.default_rng(0))
+    assert draws.shape == (20, len(counts))
+    assert (draws.sum(axis=1) <= 10).all() and (draws <= counts).all()
+    # each row is the same as computing the draw on its own
+    for base in [2, np.e]:
+        np.testing.assert_allclose(_shannon_rows(draws, normalize=False, base=base), [
+            shannon(d[d > 0], base=base) for d in draws])
+    np.testing.assert_allclose(_chao1_rows(draws), [chao1(d[d > 0], bias_corrected=True) for d in draws])
+    res = ddl.tl.clone_diversity(vdj, groupby="sample_id", method="shannon", normalize=False,
+                                 update_obs_meta=False, resample=True, n_resample=5, random_state=0)
+    same = ddl.tl.clone_diversity(vdj, groupby="sample_id", method="shannon", normalize=False,
+                                  update_obs_meta=False, resample=True, n_resample=5, random_state=0)
+    pd.testing.assert_frame_equal(res, same)
+    # without resampling it is the entropy of all cells in the group
+    res = ddl.tl.clone_diversity(vdj, groupby="sample_id", method="shannon", normalize=False, update_obs_meta=False)
+    for sample, value in res["clone_size_shannon"].items():
+        clones = vdj.metadata.loc[vdj.metadata["sample_id"] == sample, "clone_id"].value_counts()
+        assert np.isclose(value, shannon(clones.values, base=2))
+
+
+def test_resampled_network():
+    from dandelion.tools._diversity import clone_networkstats, _network_gini, _network_sizes, _network_structure, _resampled_network
+    vdj = ddl.Dandelion(AIRR)
+    structure = _network_structure(vdj, vdj.metadata.index)
+    rng = np.random.default_rng(0)
+    for _ in range(5):
+        sample = np.sort(rng.choice(len(structure["cells"]), 25, replace=False))
+        cells = structure["cells"][sample]
+        source, target, weight = _resampled_network(structure, sample)
+        cluster, vertex_cluster, vertex_sizes, cluster_sizes = _network_sizes(len(sample), source, target, weight)
+        vertex_gini, cluster_gini = _network_gini(cluster, vertex_cluster, vertex_sizes, cluster_sizes)
+        # the same as generating the network of the sampled cells
+        regenerated = ddl.Dandelion(vdj.data[vdj.data["cell_id"].isin(cells)])
+        ddl.tl.generate_network(regenerated, verbose=False)
+        nodes, *sizes = clone_networkstats(regenerated, verbose=False)
+        expected_vertex, expected_cluster = _network_gini(nodes.values, *sizes)
+        assert np.isclose(cluster_gini, expected_cluster)
+        pd.testing.assert_series_equal(pd.Series(vertex_gini, index=cells),
+                                       pd.Series(expected_vertex, index=nodes.index).reindex(cells), check_names=False)
+
+
+def _networkx_sizes(G, network_clustersize):
+    # vertex sizes and cluster size of the cluster of each node, contracting the nodes with networkx
+    sizes = {}
+    for nodes in nx.connected_components(G):
+        if len(nodes) == 1:
+            vertices, size = [1], 1
+        else:
+            H = G.subgraph(nodes).copy()
+            H.remove_edges_from([(u, v) for u, v, w in H.edges(data="weight") if w > 0])
+            if H.number_of_edges() < G.subgraph(nodes).number_of_edges():
+                vertices = [len(c) for c in nx.connected_components(H)]
+            else:
+                vertices = [1] * H.number_of_edges()
+            size = len(vertices) if network_clustersize else len(nodes)
+        for n in nodes:
+            sizes[n] = (sorted(vertices), size)
+    return sizes
+
+
+def test_clone_networkstats():
+    from dandelion.tools._diversity import clone_networkstats
+    vdj = ddl.Dandelion(AIRR)
+    ddl.tl.generate_network(vdj, verbose=False)
+    for expanded_only in [False, True]:
+        for network_clustersize in [False, True]:
+            nodes, vertex_cluster, vertex_sizes, cluster_sizes = clone_networkstats(
+                vdj, expanded_only=expanded_only, network_clustersize=network_clustersize, verbose=False)
+            expected = _networkx_sizes(vdj.graph[1 if expanded_only else 0], network_clustersize)
+            assert set(nodes.index) == set(expected)
+            for n, c in nodes.items():
+                assert (sorted(vertex_sizes[vertex_cluster == c]), cluster_sizes[c]) == expected[n]
+
+
+def _rarefy_scalar(y, n):
+    # expected number of clones and its variance, one clone and one pair of clones at a time as in vegan's rarefy
+    from dandelion.tools._diversity import chooseln
+    y = y[y > 0]
+    J = y.sum()
+
+    def missed(d):
+        return 0 if d < n else np.exp(chooseln(d, n) - chooseln(J, n))
+
+    p1 = np.array([missed(J - a) for a in y])
+    variance = np.sum(p1 * (1 - p1))
+    for i in range(len(y)):
+        for j in range(i + 1, len(y)):
+            variance += 2 * (missed(J - y[i] - y[j]) - p1[i] * p1[j])
+    return np.sum(1 - p1), variance
+
+
+def test_rarefy():
+    from dandelion.tools._diversity import rarefy, rarefaction_curves
+    vdj = ddl.Dandelion(AIRR)
+    res = rarefaction_curves(vdj.metadata, groupby="sample_id", step=3)
+    small = rarefaction_curves(vdj.metadata, groupby="sample_id", step=3, chunk_size=7)
+    for sample in res["rarefaction_clones_y"]:
+        y = vdj.metadata.loc[vdj.metadata["sample_id"] == sample, "clone_id"].value_counts().values
+        n = res["rarefaction_cells_x"][sample].dropna().values
+        expected = np.array([_rarefy_scalar(y, k) for k in n])
+        np.testing.assert_allclose(res["rarefaction_clones_y"][sample].dropna(), expected[:, 0])
+        np.testing.assert_allclose(res["rarefaction_clones_var"][sample].dropna(), expected[:, 1], atol=1e-9)
+        np.testing.assert_allclose(small["rarefaction_clones_y"][sample].dropna(), expected[:, 0])
+    # clones of the same size and empty clones
+    y = np.array([5, 1, 1, 0, 2, 2, 2, 7, 1])
+    richness, variance = rarefy(y, np.arange(1, y.sum() + 1))
+    expected = np.array([_rarefy_scalar(y, k) for k in range(1, y.sum() + 1)])
+    np.testing.assert_allclose(richness, expected[:, 0])
+    np.testing.assert_allclose(variance, expected[:, 1], atol=1e-9)
+    assert np.isclose(richness[-1], 8) and np.isclose(variance[-1], 0)
+
+
+def test_transfer_diversity_results():
+    from anndata import AnnData
+    from dandelion.tools._diversity import _transfer_diversity_results
+    vdj = ddl.Dandelion(AIRR)
+    metadata = vdj.metadata.copy()
+    metadata["group"] = metadata["sample_id"].astype(object)
+    metadata.loc[metadata.index[:3], "group"] = np.nan
+    metadata["group"] = metadata["group"].astype("category")
+    vdj.metadata = metadata
+    # a group without results and a result without cells
+    results = pd.DataFrame({"a": [0.1, 0.2, 0.3], "b": [1, 2, 3]}, index=["S0", "S1", "S3"])
+    adata = AnnData(obs=metadata.copy())
+    for obj in [vdj, adata]:
+        _transfer_diversity_results(obj, results, "group")
+        obs = obj.obs if isinstance(obj, AnnData) else obj.metadata
+        for cell, group in obs["group"].items():
+            for c in results:
+                expected = results.loc[group, c] if group in ["S0", "S1"] else np.nan
+                assert (np.isnan(expected) and np.isnan(obs.loc[cell, c])) or obs.loc[cell, c] == expected
+
+
+def test_clone_diversity_profile():
+    from skbio.diversity.alpha import gini_index, simpson
+    vdj = ddl.Dandelion(AIRR)
+    for normalize in [True, False]:
+        res = ddl.tl.clone_diversity_profile(vdj, groupby="sample_id", normalize=normalize)
+        shannon = ddl.tl.clone_diversity(vdj, groupby="sample_id", method="shannon",
+                                         normalize=normalize, update_obs_meta=False)
+        # the groups of clone_diversity are in set order
+        pd.testing.assert_series_equal(res[shannon.columns[0]], shannon.loc[res.index, shannon.columns[0]], check_names=False)
+    chao1 = ddl.tl.clone_diversity(vdj, groupby="sample_id", method="chao1", update_obs_meta=False)
+    np.testing.assert_allclose(res["clone_size_chao1"], chao1.loc[res.index].iloc[:, 0])
+    for sample in res.index:
+        counts = vdj.metadata.loc[vdj.metadata["sample_id"] == sample, "clone_id"].value_counts().values
+        freqs = counts / counts.sum()
+        assert np.isclose(res.loc[sample, "clone_size_hill_q0"], len(counts))
+        assert np.isclose(res.loc[sample, "clone_size_hill_q1"], np.exp(-np.sum(freqs * np.log(freqs))))
+        assert np.isclose(res.loc[sample, "clone_size_hill_q2"], 1 / np.sum(freqs ** 2))
+        assert np.isclose(res.loc[sample, "clone_size_simpson"], simpson(counts))
+        assert np.isclose(res.loc[sample, "clone_size_gini"], gini_index(np.append(np.sort(counts), 0), method="trapezoids"))
+    # the same subsamples for every metric
+    resampled = ddl.tl.clone_diversity_profile(vdj, groupby="sample_id", resample=True, n_resample=10, random_state=0)
+    same = ddl.tl.clone_diversity_profile(vdj, groupby="sample_id", resample=True, n_resample=10, random_state=0)
+    pd.testing.assert_frame_equal(resampled, same)
+    assert (resampled["clone_size_hill_q0"] <= res["clone_size_hill_q0"]).all()
+
+
+def test_clone_diversity_sketch():
+    data = ddl.load_data(AIRR)
+    heavy = data[data["locus"] == "IGH"]
+    exact = {}
+    for sample, table in heavy.groupby("sample_id"):
+        counts = table["clone_id"].value_counts().values
+        freqs = counts / counts.sum()
+        exact[sample] = (len(table), len(counts), -np.sum(freqs * np.log2(freqs)))
+    for kwargs in [{"chunksize": 7}, {"top_k": 2, "sample_size": 3}]:
+        res = ddl.tl.clone_diversity_sketch(AIRR, groupby="sample_id", normalize=False, **kwargs)
+        assert set(res.index) == set(exact)
+        for sample, (n_cells, richness, shannon) in exact.items():
+            assert res.loc[sample, "n_cells"] == n_cells
+            assert abs(res.loc[sample, "clone_size_richness"] - richness) <= 3 * res.loc[sample, "clone_size_richness_se"] + 0.01
+            assert abs(res.loc[sample, "clone_size_shannon"] - shannon) <= 3 * res.loc[sample, "clone_size_shannon_se"] + 0.01
+    # each cell is counted once, whether from the contigs or the metadata
+    res = ddl.tl.clone_diversity_sketch(ddl.Dandelion(AIRR), groupby="sample_id")
+    expected = ddl.tl.clone_diversity_sketch(AIRR, groupby="sample_id")
+    pd.testing.assert_frame_equal(res.loc[expected.index], expected)